@@ -0,0 +1,160 @@
+"""
+Корпус фраз для CityIndex: точность распознавания города и стоимость поиска
+по сравнению со старым перебором city_aliases через подстроку.
+
+Запуск:  python bench/bench_city_index.py
+Код возврата 1, если хоть одна фраза распознана не так, как ожидается.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+
+import bot  # noqa: E402
+
+
+# (фраза, ожидаемый запрос к OpenWeather или None)
+PHRASES = [
+    ("какая погода в Москве", "Moscow,ru"),
+    ("погода в москве завтра", "Moscow,ru"),
+    ("еду в Москву, там холодно?", "Moscow,ru"),
+    ("из Москвы пишут, что снег", "Moscow,ru"),
+    ("что там с погодой под Москвой", "Moscow,ru"),
+    ("в Казани сейчас жарко?", "Kazan,ru"),
+    ("сколько градусов в Казани", "Kazan,ru"),
+    ("Казанью доволен, но холодно", "Kazan,ru"),
+    ("в питере опять дождь", "Saint Petersburg,ru"),
+    ("температура в Санкт-Петербурге", "Saint Petersburg,ru"),
+    ("в спб ветер", "Saint Petersburg,ru"),
+    ("в Нижнем Новгороде снег", "Nizhny Novgorod,ru"),
+    ("погода в Ростове-на-Дону", "Rostov-on-Don,ru"),
+    ("в ростове жара", "Rostov-on-Don,ru"),
+    ("Калуге сегодня солнечно?", "Kaluga,ru"),
+    ("в Калуги погода", "Kaluga,ru"),
+    ("в перми холодно", "Perm,ru"),
+    ("в Уфе облачно", "Ufa,ru"),
+    ("в Брисбене дождь", "Brisbane,au"),
+    ("брисбен, жарко", "Brisbane,au"),
+    ("в Сиднее шторм", "Sydney,au"),
+    ("а в Мельбурне холодно", "Melbourne,au"),
+    ("в Перте жарко", "Perth,au"),
+    ("на Голд-Косте солнце", "Gold Coast,au"),
+    ("в Аделаиде ясно", "Adelaide,au"),
+    ("погода в Лондоне", "London,uk"),
+    ("в Париже дождь", "Paris,fr"),
+    ("Парижем не впечатлена, там пасмурно", "Paris,fr"),
+    ("в Нью-Йорке снег", "New York,us"),
+    ("в нью йорке снег", "New York,us"),
+    ("в Лос-Анджелесе жарко", "Los Angeles,us"),
+    ("в Токио тепло?", "Tokyo,jp"),
+    ("погода в Дубае", "Dubai,ae"),
+    ("погода в London", "London,uk"),
+    ("weather in Sydney? погода", "Sydney,au"),
+    ("погода в Екатеринбурге", "Yekaterinburg,ru"),
+    # Ложные срабатывания старого поиска подстрокой.
+    ("эксперты говорят, что будет дождь", None),
+    ("супер, солнце вышло", None),
+    ("погода в целом норм", None),
+    ("погода в городе отличная", None),
+    ("погода в выходные будет так себе", None),
+    ("сколько градусов в духовке ставить", None),
+    ("холодно что-то сегодня", None),
+    # Неизвестный город с заглавной — уходит в API как есть.
+    ("погода в Тамбове", "Тамбове"),
+    ("погода в Reykjavik", "Reykjavik"),
+]
+
+
+LEGACY_ALIASES = {
+    "москва": "Moscow,ru", "москве": "Moscow,ru", "питер": "Saint Petersburg,ru",
+    "петербург": "Saint Petersburg,ru", "санкт-петербург": "Saint Petersburg,ru",
+    "спб": "Saint Petersburg,ru", "калуга": "Kaluga,ru", "калуге": "Kaluga,ru",
+    "казань": "Kazan,ru", "нижний новгород": "Nizhny Novgorod,ru",
+    "новосибирск": "Novosibirsk,ru", "екатеринбург": "Yekaterinburg,ru",
+    "самара": "Samara,ru", "омск": "Omsk,ru", "челябинск": "Chelyabinsk,ru",
+    "ростов": "Rostov-on-Don,ru", "уфа": "Ufa,ru", "красноярск": "Krasnoyarsk,ru",
+    "пермь": "Perm,ru", "воронеж": "Voronezh,ru", "волгоград": "Volgograd,ru",
+    "брисбен": "Brisbane,au", "брисбене": "Brisbane,au", "сидней": "Sydney,au",
+    "сиднее": "Sydney,au", "мельбурн": "Melbourne,au", "мельбурне": "Melbourne,au",
+    "перт": "Perth,au", "аделаида": "Adelaide,au", "кэнберра": "Canberra,au",
+    "лондон": "London,uk", "париж": "Paris,fr", "берлин": "Berlin,de",
+    "токио": "Tokyo,jp", "нью-йорк": "New York,us", "нью йорк": "New York,us",
+    "лос-анджелес": "Los Angeles,us", "торонто": "Toronto,ca", "дубай": "Dubai,ae",
+    "пекин": "Beijing,cn", "сеул": "Seoul,kr",
+}
+
+LEGACY_PATTERNS = [
+    r"погода\s+в\s+([а-яa-zё\-\s]+)",
+    r"температура\s+в\s+([а-яa-zё\-\s]+)",
+    r"сколько\s+градусов\s+в\s+([а-яa-zё\-\s]+)",
+]
+
+
+def legacy_extract_city(text):
+    text_lower = text.lower()
+
+    for alias, city in LEGACY_ALIASES.items():
+        if alias in text_lower:
+            return city
+
+    for pattern in LEGACY_PATTERNS:
+        match = re.search(pattern, text_lower)
+        if match:
+            city = match.group(1).strip()
+            city = re.sub(r"[?.!,]+$", "", city).strip()
+            if city:
+                return LEGACY_ALIASES.get(city, city)
+
+    return None
+
+
+def new_extract_city(text):
+    return bot.city_index.find(text) or bot.city_index.guess_from_query(text)
+
+
+def score(fn):
+    correct, wasted, failures = 0, 0, []
+    known = set(LEGACY_ALIASES.values()) | {q for _, q in PHRASES if q}
+
+    for phrase, expected in PHRASES:
+        got = fn(phrase)
+        if got == expected:
+            correct += 1
+        else:
+            failures.append((phrase, expected, got))
+        if got and got not in known:
+            wasted += 1
+
+    return correct, wasted, failures
+
+
+def timed(fn, repeat=2000):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for phrase, _ in PHRASES:
+            fn(phrase)
+    return (time.perf_counter() - started) / (repeat * len(PHRASES)) * 1e6
+
+
+def main():
+    for label, fn in [("legacy substring scan", legacy_extract_city), ("city index", new_extract_city)]:
+        correct, wasted, failures = score(fn)
+        print(
+            f"{label:22s} correct {correct}/{len(PHRASES)}, "
+            f"garbage API queries {wasted}, {timed(fn):.2f} µs/phrase"
+        )
+
+    _, _, failures = score(new_extract_city)
+    for phrase, expected, got in failures:
+        print(f"  MISS {phrase!r}: expected {expected!r}, got {got!r}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Холодный старт: время от запуска интерпретатора до обработанного первого апдейта.
+
+Каждый прогон — отдельный процесс: import bot, build_application с фейковым
+ботом, initialize + post_init, затем process_update с обычным сообщением из группы.
+В конце — разбивка импорта в стиле `python -X importtime` по пакетам,
+которые импортирует сам bot.py.
+
+Запуск:  python bench/bench_cold_start.py [прогонов]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = r"""
+import asyncio, json, sys, time
+sys.path.insert(0, sys.argv[1])
+
+import bot
+from telegram import Bot, Update, User
+
+
+class FakeBot(Bot):
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=999, first_name="Лейла", is_bot=True, username="leila_bench_bot")
+        return self._bot_user
+
+    async def send_message(self, *args, **kwargs):
+        return None
+
+
+async def run():
+    app = bot.build_application(bot=FakeBot("123:BENCH"))
+    await app.initialize()
+    await bot.post_init(app)
+
+    update = Update.de_json({
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": -1001, "type": "supergroup", "title": "bench"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Анна"},
+            "text": "всем привет, как дела?",
+        },
+    }, app.bot)
+    await app.process_update(update)
+
+    done = time.perf_counter()
+    await app.shutdown()
+    print(json.dumps({
+        "first_update_ms": (done - bot.STARTUP_STARTED) * 1000,
+        "phases": bot.STARTUP_TIMINGS,
+    }))
+
+
+asyncio.run(run())
+"""
+
+
+def run_child(env, extra_args=()):
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *extra_args, "-c", CHILD, ROOT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = (time.perf_counter() - started) * 1000
+    return wall, json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def importtime_top(stderr, limit=10):
+    """Модули, импортированные самим bot.py (глубина 1), по cumulative-времени."""
+    rows = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            rows.append((name.strip(), int(cumulative)))
+
+    return sorted(rows, key=lambda row: -row[1])[:limit]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    env = dict(os.environ)
+    env.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+    env.setdefault("RANDOM_GROUP_REPLY_RATE", "0")
+    env.pop("DEEPSEEK_API_KEY", None)
+
+    run_child(env)  # прогрев .pyc и файловых кешей
+
+    walls, firsts = [], []
+    last = None
+    for _ in range(runs):
+        wall, result, _ = run_child(env)
+        walls.append(wall)
+        firsts.append(result["first_update_ms"])
+        last = result
+
+    print(f"прогонов: {runs}")
+    print(f"процесс целиком (медиана):           {statistics.median(walls):7.0f} мс")
+    print(f"от начала bot.py до первого апдейта: {statistics.median(firsts):7.0f} мс")
+    print("фазы последнего прогона:")
+    for phase, seconds in last["phases"]:
+        print(f"  {phase:<28} {seconds * 1000:7.1f} мс")
+
+    _, _, stderr = run_child(env, ("-X", "importtime"))
+    print("импорт по пакетам (cumulative):")
+    for name, us in importtime_top(stderr):
+        print(f"  {name:<28} {us / 1000:7.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Симуляция плановой рассылки на много чатов: сколько длится утренний пост,
+сколько генераций идёт одновременно и какой пиковый темп отправки.
+
+DeepSeek и Telegram подменены задержками, часть чатов падает специально —
+проверяем, что ошибки не задевают остальных.
+
+Запуск:  python bench/bench_fanout.py [чатов] [concurrency] [jitter_сек]
+По умолчанию 100 чатов, concurrency 4, jitter 2 с (реальный по умолчанию — 600 с).
+"""
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+
+import bot  # noqa: E402
+
+
+LLM_LATENCY = (0.05, 0.15)
+SEND_LATENCY = (0.005, 0.02)
+FAIL_EVERY = 17
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.uniform(*SEND_LATENCY))
+        if chat_id % FAIL_EVERY == 0:
+            raise RuntimeError("Forbidden: bot was kicked")
+        self.sent.append((time.monotonic(), chat_id))
+
+
+async def run(chats: int, concurrency: int, jitter: float):
+    in_flight = 0
+    peak_in_flight = 0
+
+    async def fake_deepseek(messages, model_config=None):
+        nonlocal in_flight, peak_in_flight
+        in_flight += 1
+        peak_in_flight = max(peak_in_flight, in_flight)
+        try:
+            await asyncio.sleep(random.uniform(*LLM_LATENCY))
+            return f"Доброе утро, чат {random.random():.12f} ☕"
+        finally:
+            in_flight -= 1
+
+    bot.call_deepseek = fake_deepseek
+
+    chat_ids = list(range(1, chats + 1))
+    for chat_id in chat_ids:
+        bot.memory_store.set_chat_schedule(chat_id, {"morning": True})
+
+    fake = FakeBot()
+
+    async def send_one(chat_id):
+        text = await bot.generate_unique_text(
+            [{"role": "user", "content": "утро"}],
+            kind="morning",
+            chat_id=chat_id,
+        )
+        await fake.send_message(chat_id=chat_id, text=text)
+
+    started = time.monotonic()
+    result = await bot.fan_out(
+        "morning",
+        bot.memory_store.get_broadcast_chats("morning"),
+        send_one,
+        concurrency=concurrency,
+        jitter=jitter,
+    )
+    elapsed = time.monotonic() - started
+
+    stamps = sorted(t for t, _ in fake.sent)
+    peak_rate = 0
+    for i, t in enumerate(stamps):
+        j = i
+        while j < len(stamps) and stamps[j] - t < 1.0:
+            j += 1
+        peak_rate = max(peak_rate, j - i)
+
+    expected_failed = len([c for c in chat_ids if c % FAIL_EVERY == 0])
+
+    print(f"чатов:                {chats}")
+    print(f"concurrency / jitter: {concurrency} / {jitter:.1f} с")
+    print(f"время рассылки:       {elapsed:.2f} с")
+    print(f"пик генераций:        {peak_in_flight}")
+    print(f"пик отправок в сек.:  {peak_rate}")
+    print(f"отправлено / ошибок:  {result['sent']} / {result['failed']} (ожидалось ошибок {expected_failed})")
+
+    ok = (
+        peak_in_flight <= concurrency
+        and result["failed"] == expected_failed
+        and result["sent"] == chats - expected_failed
+    )
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    chats = int(args[0]) if len(args) > 0 else 100
+    concurrency = int(args[1]) if len(args) > 1 else 4
+    jitter = float(args[2]) if len(args) > 2 else 2.0
+
+    random.seed(7)
+    bot.logger.setLevel("WARNING")
+    sys.exit(asyncio.run(run(chats, concurrency, jitter)))
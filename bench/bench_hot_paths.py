@@ -0,0 +1,241 @@
+"""
+Микробенчмарки функций, которые выполняются на каждом сообщении: разбор текста,
+сложность запроса, темы и факты, погодные проверки, чистка ответа, сборка
+системного промпта, фаза луны. Корпус — русскоязычные сообщения чата из
+bench_text_analyzer и типичные ответы модели.
+
+Базовые значения лежат в bench/baselines/hot_paths.json. Без флагов — таблица
+и сравнение с базой, --save перезаписывает базу, --compare завершается
+с кодом 1, если какая-то функция стала медленнее базы больше чем на --threshold.
+Изменение считается относительно эталонной нагрузки без кода бота, замеренной
+в том же прогоне, а функции за порогом перемеряются до трёх раз — так общий
+шум машины не выдаётся за регрессию.
+База снята на конкретной машине: после смены железа или Python её стоит пересохранить.
+
+Запуск:  python bench/bench_hot_paths.py [--save | --compare] [--threshold 0.25]
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bot  # noqa: E402
+from bench_text_analyzer import build_corpus  # noqa: E402
+
+
+REFERENCE = "эталон"
+CONFIRM_ATTEMPTS = 3
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "hot_paths.json")
+
+REPLIES = [
+    "Ну да, конечно. А я тогда королева Брисбена 😏",
+    "  Как AI, я не могу  это оценить, но   звучит сомнительно.  ",
+    "Теннис в пятницу — святое. Даже если лень.",
+    "Я бы сходила, но диван сегодня сильнее меня.\n\nИ вообще жарко.",
+    "As an AI, I think... ладно, шучу. Нормально всё.",
+    "Максим опять всё понял про жизнь? Поздравляю его.",
+    "Хм.",
+    "Кофе, потом разговоры. Такой порядок.",
+]
+
+
+def build_cases(corpus, replies):
+    analyzer = bot.text_analyzer
+    signals = [analyzer.analyze(text) for text in corpus]
+    pairs = list(zip(corpus, signals))
+
+    user_info = bot.UserInfo(id=1, first_name="Аня", username="anya")
+    chat_context = "\n".join(corpus[:12])
+    user_profile = "Темы: теннис, кофе\nФакты: я работаю в офисе"
+    mood = "саркастичное"
+    model_config = bot.analyze_query_complexity(corpus[0], signals[0])
+
+    tz = bot.get_tz()
+    base = datetime(2026, 1, 1, tzinfo=tz)
+    moments = [base + timedelta(hours=7 * i) for i in range(500)]
+    ws = bot.weather_service
+
+    # name -> (функция одного вызова, входы)
+    return {
+        "TextAnalyzer.analyze": (analyzer.analyze, corpus),
+        "analyze_query_complexity": (lambda p: bot.analyze_query_complexity(p[0], p[1]), pairs),
+        "analyze_query_complexity (без signals)": (bot.analyze_query_complexity, corpus),
+        "extract_topics_and_facts": (lambda p: bot.extract_topics_and_facts(p[0], p[1]), pairs),
+        "WeatherService.is_weather_query": (ws.is_weather_query, corpus),
+        "WeatherService.extract_city_from_text": (ws.extract_city_from_text, corpus),
+        "clean_response": (bot.clean_response, replies),
+        "generate_system_prompt": (
+            lambda _: bot.generate_system_prompt(user_info, model_config, mood, chat_context, user_profile),
+            range(200),
+        ),
+        "get_moon_phase (снимок)": (lambda _: bot.get_moon_phase(), range(2000)),
+        "get_moon_phase (по дате)": (bot.get_moon_phase, moments),
+    }
+
+
+def reference_workload(n: int):
+    """Эталон без кода бота: строки, словарь, сортировка — чтобы отделить шум машины от регрессий."""
+    words = [f"слово{i % 97}" for i in range(n)]
+    counts = {}
+    for word in words:
+        counts[word] = counts.get(word, 0) + 1
+    return sorted(counts, key=counts.get)
+
+
+def calibrate(fn, inputs, min_batch: float) -> int:
+    """Сколько проходов по входам нужно, чтобы один замер длился не меньше min_batch."""
+    passes = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(passes):
+            for item in inputs:
+                fn(item)
+        if time.perf_counter() - started >= min_batch:
+            return passes
+        passes *= 2
+
+
+def measure_all(cases: dict, repeat: int, min_batch: float = 0.05) -> dict:
+    """
+    Лучшее из repeat замеров, нс на вызов. Дешёвые функции гоняются по входам
+    несколько раз подряд, чтобы замер длился не меньше min_batch. Функции
+    меряются по кругу, а не каждая подряд: если машину на время притормозят,
+    это заденет все функции, а не одну. GC на время замеров выключен, как в timeit.
+    """
+    plans = {name: (fn, list(inputs)) for name, (fn, inputs) in cases.items()}
+    passes = {name: calibrate(fn, inputs, min_batch) for name, (fn, inputs) in plans.items()}
+    best = {name: float("inf") for name in plans}
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for name, (fn, inputs) in plans.items():
+                started = time.perf_counter()
+                for _ in range(passes[name]):
+                    for item in inputs:
+                        fn(item)
+                best[name] = min(best[name], time.perf_counter() - started)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {name: best[name] / (passes[name] * len(plans[name][1])) * 1e9 for name in plans}
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return None
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system()}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--save", action="store_true", help="перезаписать базу")
+    mode.add_argument("--compare", action="store_true", help="код 1 при регрессии больше порога")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    random.seed(3)
+    corpus = build_corpus(args.messages)
+    replies = [random.choice(REPLIES) for _ in range(1000)]
+    cases = build_cases(corpus, replies)
+
+    # Прогрев: ленивые индексы, кеши регулярок, снимок контекста.
+    for fn, inputs in cases.values():
+        for item in list(inputs)[:50]:
+            fn(item)
+
+    cases[REFERENCE] = (reference_workload, [200] * 20)
+    measured = measure_all(cases, args.repeat)
+    reference = measured.pop(REFERENCE)
+
+    baseline = load_baseline()
+    base_results = (baseline or {}).get("results", {})
+    base_reference = (baseline or {}).get("reference_ns")
+    regressions = []
+
+    def change_of(name, ns, ref):
+        # В долях эталона: общее замедление машины сокращается.
+        scale = ref / base_reference if base_reference else 1.0
+        return ns / (base_results[name] * scale) - 1
+
+    changes = {name: change_of(name, ns, reference) for name, ns in measured.items() if base_results.get(name)}
+
+    # Подозрительные функции перемеряем вместе с эталоном: регрессия должна
+    # подтвердиться в каждой попытке, случайный всплеск — нет.
+    suspects = [name for name, change in changes.items() if change > args.threshold]
+    for _ in range(CONFIRM_ATTEMPTS):
+        if not suspects:
+            break
+        again = measure_all({name: cases[name] for name in suspects + [REFERENCE]}, args.repeat)
+        ref = again.pop(REFERENCE)
+        for name, ns in again.items():
+            changes[name] = min(changes[name], change_of(name, ns, ref))
+        suspects = [name for name in suspects if changes[name] > args.threshold]
+
+    print(f"эталон: {reference / 1000:.0f} мкс" + (f" (база {base_reference / 1000:.0f} мкс)" if base_reference else ""))
+    print(f"{'функция':<42} {'нс/вызов':>10} {'база':>10} {'изменение':>10}")
+    for name, ns in measured.items():
+        base_ns = base_results.get(name)
+        if base_ns:
+            change = changes[name]
+            marker = "  ⚠️" if change > args.threshold else ""
+            if change > args.threshold:
+                regressions.append(name)
+            print(f"{name:<42} {ns:10.0f} {base_ns:10.0f} {change:+9.0%}{marker}")
+        else:
+            print(f"{name:<42} {ns:10.0f} {'—':>10} {'—':>10}")
+
+    if baseline and baseline.get("environment") != environment():
+        print(f"\nбаза снята в другом окружении: {baseline.get('environment')} против {environment()}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "reference_ns": round(reference, 1),
+                    "results": {k: round(v, 1) for k, v in measured.items()},
+                },
+                f, ensure_ascii=False, indent=2,
+            )
+            f.write("\n")
+        print(f"\nбаза сохранена: {os.path.relpath(BASELINE_PATH)}")
+        return 0
+
+    if args.compare:
+        if not baseline:
+            print("\nбазы нет — сначала --save")
+            return 1
+        if regressions:
+            print(f"\nрегрессии больше {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        print(f"\nрегрессий больше {args.threshold:.0%} нет")
+
+    return 0
+
+
+if __name__ == "__main__":
+    bot.logger.setLevel("WARNING")
+    sys.exit(main())
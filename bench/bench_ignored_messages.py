@@ -0,0 +1,183 @@
+"""
+Стоимость сообщения, на которое Лейла не отвечает (обычная болтовня в группе).
+
+Сравнивает старую запись «по одному» (upsert пользователя, счётчик, темы и факты,
+add_message — каждая операция отдельной транзакцией) с новой: dirty-tracking
+пользователя и queue_message с пачечной записью. Меряется CPU процесса и время,
+проведённое в SQLite, в пересчёте на одно сообщение.
+
+Запуск:  python bench/bench_ignored_messages.py [сообщений]
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+
+import bot  # noqa: E402
+
+
+TEXTS = [
+    "ну и денёк сегодня, работа меня доконает",
+    "кто идёт на теннис в пятницу?",
+    "я люблю кофе по утрам",
+    "смотрели вчера матч? футбол был ужасный",
+    "у меня кот опять разбил чашку",
+    "ок",
+    "ахаха",
+    "завтра еду в Москву на неделю",
+]
+
+
+def make_updates(count: int):
+    users = [
+        SimpleNamespace(id=1000 + i, first_name=f"Имя{i}", last_name="", username=f"user{i}")
+        for i in range(30)
+    ]
+    return [
+        (SimpleNamespace(effective_user=random.choice(users)), random.choice(TEXTS))
+        for _ in range(count)
+    ]
+
+
+class DbTimer:
+    def __init__(self):
+        self.total = 0.0
+
+    def wrap(self, fn):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+        return timed
+
+
+# ---------- старая запись по одному (из MemoryStore до пачечной записи) ----------
+
+def legacy_increment_user_message(store, user_id):
+    with store._connect() as conn:
+        conn.execute(
+            "UPDATE users SET message_count = message_count + 1, last_seen = ? WHERE user_id = ?",
+            (bot.datetime.now(bot.pytz.UTC).isoformat(), user_id),
+        )
+        conn.commit()
+
+
+def legacy_append_json(store, column, user_id, value):
+    value = value.strip()
+    if not value:
+        return
+
+    with store._connect() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {column} FROM users WHERE user_id = ?", (user_id,))
+        row = cur.fetchone()
+        values = json.loads(row[0]) if row and row[0] else []
+
+        if value not in values:
+            values.append(value)
+            values = values[-20:]
+
+        cur.execute(
+            f"UPDATE users SET {column} = ? WHERE user_id = ?",
+            (json.dumps(values, ensure_ascii=False), user_id),
+        )
+        conn.commit()
+
+
+def legacy_ingest(updates, store, timer):
+    upsert = timer.wrap(store.upsert_user)
+    increment = timer.wrap(lambda user_id: legacy_increment_user_message(store, user_id))
+    add_topic = timer.wrap(lambda user_id, topic: legacy_append_json(store, "topics_json", user_id, topic))
+    add_fact = timer.wrap(lambda user_id, fact: legacy_append_json(store, "facts_json", user_id, fact))
+    add_message = timer.wrap(store.add_message)
+    cache = {}
+
+    for update, text in updates:
+        user = update.effective_user
+        ui = cache.get(user.id)
+        if ui is None:
+            ui = bot.UserInfo(id=user.id, first_name=user.first_name, username=user.username)
+            cache[user.id] = ui
+        upsert(ui)
+
+        signals = bot.text_analyzer.analyze(text)
+        increment(user.id)
+        for topic in signals.topics:
+            add_topic(user.id, topic)
+        for fact in signals.facts:
+            if 4 < len(fact) < 160:
+                add_fact(user.id, fact)
+        add_message(-1001, user.id, "user", ui.get_display_name(), text)
+
+
+async def new_ingest(updates, store, timer):
+    store.upsert_user = timer.wrap(store.upsert_user)
+    store.flush_ingest = timer.wrap(store.flush_ingest)
+    bot.user_cache.clear()
+
+    for update, text in updates:
+        ui = await bot.get_or_create_user_info(update)
+        signals = bot.text_analyzer.analyze(text)
+        topics, facts = bot.extract_topics_and_facts(text, signals)
+        store.queue_message(-1001, ui.id, "user", ui.get_display_name(), text, topics=topics, facts=facts)
+
+    store.flush_ingest()
+
+
+def measure(name, count, run):
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    db = run()
+    cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    print(
+        f"{name:<10} {wall / count * 1e6:9.0f} µs/сообщ. всего, "
+        f"{cpu / count * 1e6:7.0f} µs CPU, {db / count * 1e6:7.0f} µs в SQLite"
+    )
+    return wall
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(3)
+    updates = make_updates(count)
+    tmp = tempfile.mkdtemp()
+
+    legacy_store = bot.MemoryStore(os.path.join(tmp, "legacy.sqlite3"))
+    legacy_timer = DbTimer()
+
+    def run_legacy():
+        legacy_ingest(updates, legacy_store, legacy_timer)
+        return legacy_timer.total
+
+    new_store = bot.MemoryStore(os.path.join(tmp, "new.sqlite3"), ingest_flush_interval=3600)
+    new_timer = DbTimer()
+    bot.memory_store = new_store
+
+    def run_new():
+        asyncio.run(new_ingest(updates, new_store, new_timer))
+        return new_timer.total
+
+    print(f"сообщений: {count}, пользователей: 30, пачка: {new_store.ingest_batch_size}")
+    old = measure("по одному", count, run_legacy)
+    new = measure("пачками", count, run_new)
+    print(f"ускорение: x{old / new:.1f}")
+
+    with new_store._connect() as conn:
+        stored = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        counted = conn.execute("SELECT SUM(message_count) FROM users").fetchone()[0]
+
+    return 0 if stored == count and counted == count else 1
+
+
+if __name__ == "__main__":
+    bot.logger.setLevel("WARNING")
+    sys.exit(main())
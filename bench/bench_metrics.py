@@ -0,0 +1,85 @@
+"""
+Накладные расходы метрик: стоимость inc/observe в горячем пути, обёртки
+timed_methods вокруг метода MemoryStore и сборки текста /metrics.
+
+Запуск:  python bench/bench_metrics.py
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bot  # noqa: E402
+
+
+def per_call_ns(stmt, number=200_000, setup="pass", env=None):
+    best = min(timeit.repeat(stmt, setup=setup, number=number, repeat=5, globals=env))
+    return best / number * 1e9
+
+
+def main():
+    registry = bot.MetricsRegistry()
+    counter = registry.counter("bench_total", "bench", ("kind",))
+    histogram = registry.histogram("bench_seconds", "bench", ("kind",))
+    child = histogram.labels("reply")
+    env = {"counter": counter, "histogram": histogram, "child": child, "bot": bot}
+
+    rows = [
+        ("counter.labels(x).inc()", per_call_ns("counter.labels('reply').inc()", env=env)),
+        ("histogram.labels(x).observe()", per_call_ns("histogram.labels('reply').observe(0.042)", env=env)),
+        ("child.observe() (закешированный)", per_call_ns("child.observe(0.042)", env=env)),
+        ("perf_counter() x2 + observe", per_call_ns(
+            "t = bot.time_module.perf_counter(); child.observe(bot.time_module.perf_counter() - t)", env=env)),
+    ]
+
+    # Обёртка timed_methods на пустом методе — чистая цена инструментирования.
+    class Plain:
+        def noop(self):
+            return None
+
+    @bot.timed_methods(registry.histogram("bench_method_seconds", "bench", ("method",)))
+    class Timed:
+        def noop(self):
+            return None
+
+    env.update(plain=Plain(), timed=Timed())
+    plain = per_call_ns("plain.noop()", env=env)
+    timed = per_call_ns("timed.noop()", env=env)
+    rows.append(("timed_methods: накладные на вызов", timed - plain))
+
+    store = bot.memory_store
+    store.get_setting("warm_up")
+    env["store"] = store
+    raw = bot.MemoryStore.get_setting.__wrapped__
+    env["raw"] = raw
+    real_raw = per_call_ns("raw(store, 'bench_key')", number=2000, env=env)
+    real_timed = per_call_ns("store.get_setting('bench_key')", number=2000, env=env)
+    rows.append(("MemoryStore.get_setting без метрик", real_raw))
+    rows.append(("MemoryStore.get_setting с метриками", real_timed))
+
+    for name in ("ok", "error", "empty"):
+        for model in ("deepseek-chat", "deepseek-reasoner"):
+            for _ in range(100):
+                bot.DEEPSEEK_SECONDS.labels(model).observe(0.8)
+                bot.DEEPSEEK_REQUESTS.labels(model, name).inc()
+    render_us = per_call_ns("bot.metrics.render()", number=200, env=env) / 1000
+    lines = bot.metrics.render().count("\n")
+
+    for label, ns in rows:
+        print(f"{label:<40} {ns:9.0f} нс")
+    print(f"{'render /metrics (' + str(lines) + ' строк)':<40} {render_us:9.0f} мкс")
+
+    # Разница двух замеров SQLite тонет в шуме диска, поэтому долю считаем
+    # от чистой цены обёртки.
+    overhead = (timed - plain) / real_raw * 100 if real_raw else 0.0
+    print(f"\nобёртка timed_methods к типичному SQLite-вызову: {overhead:.2f}%")
+
+
+if __name__ == "__main__":
+    bot.logger.setLevel("WARNING")
+    main()
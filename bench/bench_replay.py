@@ -0,0 +1,349 @@
+"""
+Офлайн-прогон: апдейты (записанные или синтетические) идут в настоящий
+handle_message через Application.process_update. Telegram — фейковый бот,
+DeepSeek — локальный HTTP-стаб в формате OpenAI с настраиваемой задержкой,
+паузы «печатает...» идут по виртуальным часам, а не спят по-настоящему.
+
+Считаем: сообщений/с, p50/p99 задержки от апдейта до конца обработки
+(по стенным часам и с учётом виртуальных пауз), SQL-выражений и вызовов
+MemoryStore на сообщение, запросов к LLM на сообщение и на ответ.
+
+С одним и тем же --seed поток апдейтов, решения бота (у каждого апдейта
+свой генератор random) и последовательность задержек стаба одинаковые от
+прогона к прогону. Число перегенераций из-за почти-повторов может чуть
+гулять: оно зависит от того, в каком порядке ответы попали в историю чата.
+
+Запуск:
+  python bench/bench_replay.py [--updates N] [--concurrency K] [--seed S]
+                               [--llm-latency lognormal:0.05:0.5]
+                               [--replay updates.jsonl] [--save updates.jsonl]
+                               [--real-limits]
+
+Распределения задержки LLM: fixed:СЕК, uniform:ОТ:ДО, lognormal:МЕДИАНА:SIGMA.
+Файл для --replay — по апдейту Telegram (JSON как из getUpdates) на строку.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("OPENWEATHER_API_KEY", "")
+os.environ.setdefault("METRICS_PORT", "0")
+if "--real-limits" not in sys.argv:
+    # Иначе очередь не успеет дослать ответы к концу прогона и выбросит их.
+    # Обработчик доставки не ждёт, так что на задержку апдейтов лимиты не влияют;
+    # --real-limits оставляет боевые значения, чтобы это проверить.
+    os.environ.setdefault("OUTBOUND_PRIVATE_RATE", "1000")
+    os.environ.setdefault("OUTBOUND_GROUP_RATE", "1000")
+    os.environ.setdefault("OUTBOUND_CHAT_BURST", "1000")
+    os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+    os.environ.setdefault("OUTBOUND_GLOBAL_BURST", "100000")
+
+from aiohttp import web  # noqa: E402
+from telegram import Bot, Update, User  # noqa: E402
+
+import bot  # noqa: E402
+
+
+GROUP_CHAT = -1001
+BOT_USER = User(id=999, first_name="Лейла", is_bot=True, username="leila_bench_bot")
+
+GROUP_TEXTS = [
+    "ну и денёк сегодня",
+    "кто идёт на теннис в пятницу?",
+    "смотрели вчера матч",
+    "у меня кот опять разбил чашку",
+    "ахаха",
+    "ок",
+    "завтра еду в Москву на неделю",
+    "какая погода в Брисбене",
+]
+DIRECT_TEXTS = [
+    "Лейла, как дела?",
+    "Лейла, что думаешь про теннис?",
+    "Лейла, посоветуй кино на вечер",
+    "Лейла, ты вообще спишь когда-нибудь?",
+]
+PRIVATE_TEXTS = [
+    "привет",
+    "расскажи что-нибудь смешное",
+    "мне скучно",
+    "как прошёл день?",
+]
+REPLY_WORDS = (
+    "ну", "вообще", "кофе", "теннис", "чат", "опять", "понедельник", "кот", "жара",
+    "Брисбен", "лень", "честно", "сарказм", "вечер", "дождь", "работа", "смешно",
+    "снова", "спорт", "сериал", "выходные", "кухня", "соседи", "пляж", "океан",
+    "пятница", "маркет", "чай", "собака", "книга", "музыка", "утро", "новости",
+)
+
+
+# ---------- поток апдейтов ----------
+
+def synthetic_updates(count: int, rng: random.Random) -> list:
+    updates = []
+
+    for update_id in range(1, count + 1):
+        user_id = rng.randint(1, 200)
+        roll = rng.random()
+
+        if roll < 0.1:
+            chat = {"id": user_id, "type": "private", "first_name": f"u{user_id}"}
+            text = rng.choice(PRIVATE_TEXTS)
+        else:
+            chat = {"id": GROUP_CHAT, "type": "supergroup", "title": "bench"}
+            text = rng.choice(DIRECT_TEXTS if roll < 0.2 else GROUP_TEXTS)
+
+        updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 1_700_000_000 + update_id,
+                "chat": chat,
+                "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+                "text": text,
+            },
+        })
+
+    return updates
+
+
+def load_updates(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# ---------- DeepSeek-стаб ----------
+
+def parse_latency(spec: str):
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+    raise SystemExit(f"неизвестное распределение задержки: {spec}")
+
+
+class StubDeepSeek:
+    """POST /chat/completions в формате OpenAI: ждёт по распределению и отвечает случайной фразой."""
+
+    def __init__(self, latency, seed: int):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.runner = None
+        self.url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests += 1
+
+        # Задержки и тексты идут одной последовательностью в порядке прихода запросов.
+        delay = self.latency(self.rng)
+        words = self.rng.sample(REPLY_WORDS, 6)
+        text = " ".join(words).capitalize() + f". {self.rng.randint(1, 10 ** 6)}"
+
+        await asyncio.sleep(delay)
+        return web.json_response({
+            "id": f"bench-{self.requests}",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body.get("model", "deepseek-chat"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# ---------- фейковый Telegram и виртуальные часы ----------
+
+class FakeBot(Bot):
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = BOT_USER
+        return BOT_USER
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.005)
+        return None
+
+    async def send_chat_action(self, *args, **kwargs):
+        return True
+
+
+_virtual_sleep = contextvars.ContextVar("virtual_sleep", default=None)
+_update_rng = contextvars.ContextVar("update_rng", default=random.Random(0))
+
+
+class PerUpdateRandom:
+    """
+    Подменяет bot.random: у каждого апдейта свой генератор (seed + update_id),
+    поэтому решения «отвечать ли / ждать сколько» не зависят от того,
+    как задачи переплелись в event loop.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_update_rng.get(), name)
+
+
+async def simulated_pause(seconds: float):
+    """Вместо asyncio.sleep: копит виртуальное время апдейта и только уступает loop."""
+    box = _virtual_sleep.get()
+    if box is not None:
+        box[0] += seconds
+    await asyncio.sleep(0)
+
+
+# ---------- прогон ----------
+
+def db_counters():
+    statements = sum(stats.count for stats in bot.query_log.stats.values())
+    calls = sum(child.count for child in bot.DB_SECONDS._children.values())
+    return statements, calls
+
+
+def pct(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+async def run(args) -> int:
+    rng = random.Random(args.seed)
+    updates = load_updates(args.replay) if args.replay else synthetic_updates(args.updates, rng)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            for data in updates:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+    stub = StubDeepSeek(parse_latency(args.llm_latency), args.seed)
+    await stub.start()
+
+    bot.DEEPSEEK_API_KEY = "bench"
+    bot.DEEPSEEK_BASE_URL = stub.url
+    bot.humanized_pause = simulated_pause
+    bot.RANDOM_GROUP_REPLY_RATE = args.group_reply_rate
+    bot.random = PerUpdateRandom()
+    _update_rng.set(random.Random(args.seed))
+
+    application = bot.build_application(bot=FakeBot("123:BENCH"))
+    await application.initialize()
+    await application.start()
+
+    statements_before, calls_before = db_counters()
+    outcomes_before = {key: child.value for key, child in bot.UPDATES_TOTAL._children.items()}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    wall, virtual, replies = [], [], []
+
+    async def process(data: dict):
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            box = [0.0]
+            _virtual_sleep.set(box)
+            _update_rng.set(random.Random(f"{args.seed}:{update.update_id}"))
+            started = time.perf_counter()
+            await application.process_update(update)
+            elapsed = time.perf_counter() - started
+            wall.append(elapsed)
+            virtual.append(elapsed + box[0])
+            # Пауза «печатает...» бывает только перед ответом.
+            if box[0]:
+                replies.append(elapsed)
+
+    started = time.perf_counter()
+    try:
+        # Каждый апдейт — своя задача со своей копией контекста.
+        await asyncio.gather(*(asyncio.create_task(process(data)) for data in updates))
+        bot.memory_store.flush_ingest()
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot.outbound_queue.close()
+        await stub.stop()
+
+    statements, calls = db_counters()
+    statements -= statements_before
+    calls -= calls_before
+    outcomes = {
+        key[0]: child.value - outcomes_before.get(key, 0.0)
+        for key, child in bot.UPDATES_TOTAL._children.items()
+    }
+    replied = int(outcomes.get("replied", 0))
+    total = len(updates)
+
+    wall.sort()
+    virtual.sort()
+    replies.sort()
+
+    print(f"апдейтов:            {total} (параллельно {args.concurrency}, seed {args.seed})")
+    print(f"исходы:              {', '.join(f'{k} {v:.0f}' for k, v in sorted(outcomes.items()))}")
+    print(f"пропускная:          {total / elapsed:.0f} сообщений/с ({elapsed:.2f} с)")
+    print(
+        f"задержка p50/p99:    {pct(wall, 0.5) * 1000:.0f} / {pct(wall, 0.99) * 1000:.0f} мс "
+        f"(с виртуальными паузами {pct(virtual, 0.5):.2f} / {pct(virtual, 0.99):.2f} с)"
+    )
+    print(
+        f"ответы p50/p99:      {pct(replies, 0.5) * 1000:.0f} / {pct(replies, 0.99) * 1000:.0f} мс "
+        "(без виртуальных пауз)"
+    )
+    print(f"SQL на сообщение:    {statements / total:.2f} выражений, {calls / total:.2f} вызовов MemoryStore")
+    print(
+        f"LLM:                 {stub.requests / total:.3f} запросов на сообщение, "
+        f"{stub.requests / max(1, replied):.2f} на ответ (LLM {args.llm_latency})"
+    )
+
+    return 0 if sum(outcomes.values()) == total else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--llm-latency", default="lognormal:0.05:0.5")
+    parser.add_argument("--group-reply-rate", type=float, default=bot.RANDOM_GROUP_REPLY_RATE)
+    parser.add_argument("--replay", help="JSONL с апдейтами Telegram вместо синтетики")
+    parser.add_argument("--save", help="сохранить поток апдейтов в JSONL для повторного прогона")
+    parser.add_argument("--real-limits", action="store_true", help="боевые лимиты очереди отправки")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Нагрузка на MemoryStore из многих потоков сразу: add_message, факты пользователя
+(queue_message с facts и flush_ingest — так их пишет бот), get_chat_context_text
+и get_memory_stats по одной базе (WAL, synchronous=NORMAL), заранее заполненной
+до нужного размера.
+
+Сначала один поток — это то, как бот ходит в базу из event loop: задачи
+asyncio вызывают MemoryStore синхронно и друг с другом не конкурируют. Потом
+--threads потоков, у каждого свой MemoryStore, как у отдельных процессов на
+одном файле. Ожидание блокировки считается как превышение задержки над
+одиночным прогоном той же операции: busy handler SQLite спит внутри вызова
+и снаружи не виден.
+
+В отчёте: операций в секунду, p50/p99/max по операциям, оценка ожидания,
+ошибки «database is locked», размер WAL (в начале, пик, в конце) и топ
+запросов из query_log с планами.
+
+Запуск:  python bench/bench_sqlite_stress.py [--messages 200000] [--chats 300]
+         [--users 2000] [--threads 8] [--seconds 10]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bot  # noqa: E402
+from bench_text_analyzer import build_corpus  # noqa: E402
+
+
+# Доли операций: на сообщение в чате приходится запись, чтение контекста
+# для ответа на часть из них, иногда факт и изредка /memory.
+MIX = (
+    ("add_message", 0.60),
+    ("get_chat_context_text", 0.25),
+    ("user_fact", 0.10),
+    ("get_memory_stats", 0.05),
+)
+WAL_SAMPLE_INTERVAL = 0.05
+
+
+def populate(path: str, messages: int, chats: int, users: int, seed: int = 7):
+    """Заполняет базу напрямую, одной транзакцией — через MemoryStore это заняло бы минуты."""
+    rnd = random.Random(seed)
+    corpus = build_corpus(2000, seed=seed)
+    start = datetime(2026, 1, 1, tzinfo=bot.pytz.UTC)
+
+    bot.MemoryStore(path).get_setting("schema")
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, first_name, first_seen, last_seen, message_count) "
+            "VALUES (?, ?, ?, ?, 0)",
+            [(user_id, f"user{user_id}", start.isoformat(), start.isoformat()) for user_id in range(1, users + 1)],
+        )
+        counts = {-chat_id: 0 for chat_id in range(1, chats + 1)}
+
+        def rows():
+            for i in range(messages):
+                chat_id = -rnd.randint(1, chats)
+                user_id = rnd.randint(1, users)
+                role = "assistant" if rnd.random() < 0.2 else "user"
+                counts[chat_id] += 1
+                created_at = (start + timedelta(seconds=i * 7)).isoformat()
+                yield (chat_id, user_id, role, f"user{user_id}", rnd.choice(corpus), created_at)
+
+        conn.executemany(
+            "INSERT INTO messages (chat_id, user_id, role, name, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows(),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO chat_memory (chat_id, last_activity, message_count) VALUES (?, ?, ?)",
+            [(chat_id, start.isoformat(), count) for chat_id, count in counts.items()],
+        )
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+
+def wal_size(path: str) -> int:
+    try:
+        return os.path.getsize(path + "-wal")
+    except OSError:
+        return 0
+
+
+class WalMonitor(threading.Thread):
+    def __init__(self, path: str):
+        super().__init__(daemon=True)
+        self.path = path
+        self.start_size = wal_size(path)
+        self.peak = self.start_size
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(WAL_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, wal_size(self.path))
+
+    def stop(self) -> int:
+        self._stopping.set()
+        self.join()
+        end = wal_size(self.path)
+        self.peak = max(self.peak, end)
+        return end
+
+
+class Worker(threading.Thread):
+    def __init__(self, index: int, path: str, chats: int, users: int, corpus, deadline: float, barrier):
+        super().__init__(daemon=True)
+        self.rnd = random.Random(index)
+        self.store = bot.MemoryStore(path)
+        self.chats = chats
+        self.users = users
+        self.corpus = corpus
+        self.deadline = deadline
+        self.barrier = barrier
+        self.latencies = {name: [] for name, _ in MIX}
+        self.locked = 0
+        self.errors = 0
+
+    def call(self, name: str):
+        chat_id = -self.rnd.randint(1, self.chats)
+        user_id = self.rnd.randint(1, self.users)
+
+        if name == "add_message":
+            self.store.add_message(chat_id, user_id, "user", f"user{user_id}", self.rnd.choice(self.corpus))
+        elif name == "get_chat_context_text":
+            self.store.get_chat_context_text(chat_id)
+        elif name == "user_fact":
+            fact = f"факт {self.rnd.randint(1, 50)}"
+            self.store.queue_message(chat_id, user_id, "user", f"user{user_id}", fact, facts=(fact,))
+            self.store.flush_ingest()
+        else:
+            self.store.get_memory_stats(chat_id)
+
+    def run(self):
+        names = [name for name, _ in MIX]
+        weights = [weight for _, weight in MIX]
+        self.barrier.wait()
+
+        while time.perf_counter() < self.deadline:
+            name = self.rnd.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                self.call(name)
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e) or "busy" in str(e):
+                    self.locked += 1
+                else:
+                    self.errors += 1
+                continue
+            self.latencies[name].append(time.perf_counter() - started)
+
+
+def run_phase(path: str, threads: int, seconds: float, chats: int, users: int, corpus) -> dict:
+    barrier = threading.Barrier(threads + 1)
+    deadline = time.perf_counter() + seconds + 0.5
+    workers = [Worker(i, path, chats, users, corpus, deadline, barrier) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    monitor = WalMonitor(path)
+    monitor.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    wal_end = monitor.stop()
+
+    latencies = {name: [] for name, _ in MIX}
+    for worker in workers:
+        for name, values in worker.latencies.items():
+            latencies[name].extend(values)
+
+    return {
+        "threads": threads,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "locked": sum(worker.locked for worker in workers),
+        "errors": sum(worker.errors for worker in workers),
+        "wal": (monitor.start_size, monitor.peak, wal_end),
+    }
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(phase: dict, solo: dict = None):
+    total_ops = sum(len(values) for values in phase["latencies"].values())
+    print(
+        f"\n— потоков: {phase['threads']}, {phase['elapsed']:.1f} с, "
+        f"{total_ops / phase['elapsed']:.0f} оп/с, locked: {phase['locked']}, прочих ошибок: {phase['errors']}"
+    )
+    print(f"{'операция':<24} {'оп/с':>7} {'p50 мс':>8} {'p99 мс':>8} {'max мс':>8} {'ожидание':>10}")
+
+    waited_total = 0.0
+    for name, _ in MIX:
+        values = phase["latencies"][name]
+        if not values:
+            print(f"{name:<24} {'—':>7}")
+            continue
+
+        waited = ""
+        if solo and solo["latencies"][name]:
+            # Всё сверх обычной задержки операции — очередь на блокировку (и на GIL).
+            base = statistics.median(solo["latencies"][name])
+            excess = sum(max(0.0, value - base) for value in values)
+            waited_total += excess
+            waited = f"{excess:9.1f}с"
+
+        print(
+            f"{name:<24} {len(values) / phase['elapsed']:7.0f} {percentile(values, 0.5) * 1000:8.2f} "
+            f"{percentile(values, 0.99) * 1000:8.2f} {max(values) * 1000:8.1f} {waited:>10}"
+        )
+
+    if solo:
+        busy = phase["threads"] * phase["elapsed"]
+        print(f"ожидание всего: {waited_total:.1f} с из {busy:.1f} поток·с ({waited_total / busy:.0%})")
+
+    start, peak, end = phase["wal"]
+    print(f"WAL: в начале {start / 1024:.0f} КБ, пик {peak / 1024:.0f} КБ, в конце {end / 1024:.0f} КБ")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000, help="сообщений в базе до старта")
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--solo-seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    path = bot.DB_PATH
+    started = time.perf_counter()
+    populate(path, args.messages, args.chats, args.users)
+    print(
+        f"база: {args.messages} сообщений, {args.chats} чатов, {args.users} пользователей, "
+        f"{os.path.getsize(path) / 1024 / 1024:.1f} МБ, заполнена за {time.perf_counter() - started:.1f} с"
+    )
+
+    corpus = build_corpus(1000, seed=11)
+
+    solo = run_phase(path, 1, args.solo_seconds, args.chats, args.users, corpus)
+    report(solo)
+
+    bot.query_log.reset()
+    contended = run_phase(path, args.threads, args.seconds, args.chats, args.users, corpus)
+    report(contended, solo)
+
+    conn = sqlite3.connect(path)
+    try:
+        print(f"\nзапросы под нагрузкой:\n{bot.query_log.report(top=5, conn=conn)}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # Медленные запросы под нагрузкой идут в отчёт в конце, а не в лог построчно.
+    bot.logger.setLevel("ERROR")
+    main()
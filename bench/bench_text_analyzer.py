@@ -0,0 +1,177 @@
+"""
+Микробенчмарк анализа входящего сообщения: старый многопроходный путь
+(is_weather_query + extract_city_from_text + analyze_query_complexity +
+extract_topics_and_facts + проверка упоминания) против одного прохода TextAnalyzer.
+
+Запуск:  python bench/bench_text_analyzer.py [--messages 2000] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+
+import bot  # noqa: E402
+
+
+PHRASES = [
+    "Привет всем",
+    "Лейла, как дела?",
+    "какая погода в Москве сегодня",
+    "в брисбене опять дождь и ветер",
+    "сколько градусов в Казани",
+    "объясни почему python такой медленный",
+    "сравни iPhone и Android",
+    "что думаешь о новом сериале",
+    "я люблю теннис по пятницам, но сегодня лень",
+    "меня зовут Аня",
+    "я работаю в офисе на другом конце города.",
+    "мне не нравится эта жара",
+    "вчера ходили в зал, тренировка была адская",
+    "кто-нибудь знает хороший рецепт ужина на скорую руку",
+    "у меня болит голова, наверное к врачу",
+    "ну и логика в том, что никто ничего не решил",
+    "база данных снова легла, сервер не отвечает",
+    "следует ли вообще ехать в Сидней в декабре",
+    "смотрели вчера фильм, музыка отличная",
+    "ку",
+    "хорошо посидели, спасибо всем",
+    "ахаха",
+    "а Максим опять уверен, что всё знает",
+    "Короче, завтра созвон в девять, не опаздывайте пожалуйста",
+    "купила новую книгу, пока не читала",
+    "на выходных поедем к друзьям на барбекю",
+    "пасмурно, но тепло",
+    "скинь ссылку плиз",
+]
+
+
+def build_corpus(count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    corpus = []
+
+    for _ in range(count):
+        # Реальные сообщения в чате: от пары слов до нескольких предложений.
+        parts = rnd.choices(PHRASES, k=rnd.choice([1, 1, 1, 2, 2, 3, 5]))
+        text = ". ".join(parts)
+        if rnd.random() < 0.1:
+            text = text.replace(". ", "\n", 1)
+        corpus.append(text)
+
+    return corpus
+
+
+# ---------- старая реализация (до TextAnalyzer), для сравнения ----------
+
+LEGACY_FACT_PATTERNS = list(bot.FACT_PATTERNS)
+
+
+def legacy_extract_city(ws, text):
+    # Города с user-028 ищутся по CityIndex в обоих вариантах.
+    return bot.city_index.find(text) or bot.city_index.guess_from_query(text)
+
+
+def legacy_is_weather_query(ws, text):
+    text_lower = text.lower()
+
+    if any(keyword in text_lower for keyword in ws.weather_keywords):
+        return True
+
+    city = legacy_extract_city(ws, text)
+
+    return bool(city and any(word in text_lower for word in bot.WEATHER_HINT_WORDS))
+
+
+def legacy_signals(ws, text):
+    text_lower = text.lower()
+
+    groups = {
+        group: any(re.search(p, text_lower) for p in patterns)
+        for group, patterns in bot.COMPLEXITY_PATTERNS.items()
+    }
+
+    topics = [
+        topic for topic, words in bot.TOPIC_KEYWORDS.items()
+        if any(w in text_lower for w in words)
+    ]
+
+    facts = []
+    for pattern in LEGACY_FACT_PATTERNS:
+        match = re.search(pattern, text_lower)
+        if match:
+            facts.append(match.group(0).strip())
+
+    return {
+        "weather": legacy_is_weather_query(ws, text),
+        "city": legacy_extract_city(ws, text) if legacy_is_weather_query(ws, text) else None,
+        "complex": groups["complex"],
+        "reasoning": groups["reasoning"],
+        "technical": groups["technical"],
+        "simple": groups["simple"] and not groups["complex"],
+        "topics": topics,
+        "facts": facts,
+        "mention": "лейла" in text_lower,
+    }
+
+
+def new_signals(analyzer, text):
+    s = analyzer.analyze(text)
+    return {
+        "weather": s.is_weather_query,
+        "city": s.city if s.is_weather_query else None,
+        "complex": s.is_complex,
+        "reasoning": s.is_reasoning,
+        "technical": s.is_technical,
+        "simple": s.is_simple,
+        "topics": s.topics,
+        "facts": s.facts,
+        "mention": s.mentions_leila,
+    }
+
+
+def timed(fn, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best / len(corpus) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    ws = bot.weather_service
+    analyzer = bot.text_analyzer
+    corpus = build_corpus(args.messages)
+
+    mismatches = [t for t in corpus if legacy_signals(ws, t) != new_signals(analyzer, t)]
+
+    avg_len = sum(len(t) for t in corpus) / len(corpus)
+    legacy_us = timed(lambda t: legacy_signals(ws, t), corpus, args.repeat)
+    new_us = timed(analyzer.analyze, corpus, args.repeat)
+
+    print(f"messages: {len(corpus)}, avg length: {avg_len:.0f} chars")
+    print(f"legacy multi-pass: {legacy_us:8.2f} µs/message")
+    print(f"single-pass:       {new_us:8.2f} µs/message")
+    print(f"speedup:           {legacy_us / new_us:8.2f}x")
+    print(f"signal mismatches: {len(mismatches)}")
+
+    for text in mismatches[:5]:
+        print("  ", repr(text))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Нагрузочный тест webhook-режима: синтетические апдейты идут POST-запросами
+в локальный aiohttp-сервер, меряем пропускную способность и задержку
+от запроса до конца обработки хендлером.
+
+Telegram заменён фейковым ботом, DeepSeek — задержкой. Большая часть апдейтов —
+групповая болтовня, на которую Лейла молчит (как в жизни), остальное — личка.
+
+Запуск:  python bench/bench_webhook.py [апдейтов] [параллельных запросов]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("RANDOM_GROUP_REPLY_RATE", "0")
+os.environ.setdefault("UPDATE_CONCURRENCY", "64")
+os.environ.setdefault("WEBHOOK_SECRET", "bench-secret")
+os.environ.setdefault("OUTBOUND_PRIVATE_RATE", "1000")
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from telegram import Bot, User  # noqa: E402
+
+import bot  # noqa: E402
+
+
+PRIVATE_SHARE = 0.1
+LLM_LATENCY = 0.05
+
+
+class FakeBot(Bot):
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=999, first_name="Лейла", is_bot=True, username="leila_bench_bot")
+        return self._bot_user
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.005)
+        return None
+
+    async def send_chat_action(self, *args, **kwargs):
+        return True
+
+
+def make_update(update_id: int) -> dict:
+    private = random.random() < PRIVATE_SHARE
+    user_id = random.randint(1, 300)
+    chat = (
+        {"id": user_id, "type": "private", "first_name": f"u{user_id}"}
+        if private
+        else {"id": -1001, "type": "supergroup", "title": "bench"}
+    )
+
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "text": random.choice([
+                "привет всем",
+                "какая погода в Москве завтра",
+                "ну и денёк сегодня",
+                "кто идёт на теннис в пятницу?",
+                "смотрели вчера матч",
+            ]),
+        },
+    }
+
+
+async def run(total: int, parallel: int) -> int:
+    done_at = {}
+    original_handle = bot.handle_message
+
+    async def timed_handle(update, context):
+        try:
+            await original_handle(update, context)
+        finally:
+            done_at[update.update_id] = time.monotonic()
+
+    async def fake_deepseek(messages, model_config=None, **kwargs):
+        await asyncio.sleep(LLM_LATENCY)
+        return f"ответ {random.random():.10f}"
+
+    bot.handle_message = timed_handle
+    bot.call_deepseek = fake_deepseek
+
+    application = bot.build_application(bot=FakeBot("123:BENCH"))
+    state = bot.WebhookState()
+    runner = web.AppRunner(bot.create_webhook_app(application, state, secret="bench-secret"))
+
+    await application.initialize()
+    await application.start()
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    state.ready = True
+
+    sent_at = {}
+    statuses = {}
+    semaphore = asyncio.Semaphore(parallel)
+
+    async with aiohttp.ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}) as session:
+        async with session.post(url, json=make_update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as resp:
+            assert resp.status == 403, resp.status
+
+        async def post(update_id):
+            async with semaphore:
+                sent_at[update_id] = time.monotonic()
+                async with session.post(url, json=make_update(update_id)) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(post(i) for i in range(1, total + 1)))
+        posted = time.monotonic() - started
+
+        while len(done_at) < total and time.monotonic() - started < 120:
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - started
+
+        async with session.get(f"http://127.0.0.1:{port}/healthz") as resp:
+            health = await resp.json()
+
+    await application.stop()
+    await runner.cleanup()
+    await application.shutdown()
+
+    latencies = sorted(done_at[i] - sent_at[i] for i in done_at if i in sent_at)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+
+    print(f"апдейтов:           {total} (параллельно {parallel}, личка {PRIVATE_SHARE:.0%})")
+    print(f"ответы сервера:     {statuses}")
+    print(f"приём:              {total / posted:.0f} апдейтов/с")
+    print(f"обработка целиком:  {len(done_at)} за {elapsed:.2f} с, {len(done_at) / elapsed:.0f} апдейтов/с")
+    print(f"задержка p50/p95/p99: {pct(0.5):.0f} / {pct(0.95):.0f} / {pct(0.99):.0f} мс")
+    print(f"healthz:            {health}")
+
+    return 0 if len(done_at) == total else 1
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    total = int(args[0]) if len(args) > 0 else 1000
+    parallel = int(args[1]) if len(args) > 1 else 32
+
+    random.seed(11)
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    sys.exit(asyncio.run(run(total, parallel)))
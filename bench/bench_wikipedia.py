@@ -0,0 +1,198 @@
+"""
+Поиск в Википедии против локального стаба REST API: сколько запросов и
+какую задержку стоит прямое попадание, неоднозначность и промах.
+
+Стаб отвечает на /api/rest_v1/page/summary/{title} и /w/rest.php/v1/search/page
+с фиксированной задержкой --rtt, как будто это круг до Википедии. Рядом —
+модель старого пути через библиотеку wikipedia: те же последовательные
+запросы, что делали page(), summary() и search(), к тому же стабу.
+
+Код возврата 1, если прямое попадание стоит больше одного запроса (при rtt
+меньше search_delay) или новый путь хоть в одном сценарии не быстрее старого на круг.
+
+Запуск:  python bench/bench_wikipedia.py [--rtt 0.15] [--repeat 5]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LEILA_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+
+
+PAGES = {
+    "Теннис": "Те́ннис — вид спорта, в котором соперники перекидывают мяч через сетку.",
+    "Меркурий (планета)": "Мерку́рий — ближайшая к Солнцу планета Солнечной системы.",
+    "Меркурий (мифология)": "Мерку́рий — римский бог торговли.",
+}
+DISAMBIGUATION = {"Меркурий": ["Меркурий (планета)", "Меркурий (мифология)"]}
+SEARCH = {"большой теннис": ["Теннис"], "Меркурий": ["Меркурий (планета)", "Меркурий (мифология)"]}
+SLOW = {"медленный теннис": ["Теннис"]}
+
+SCENARIOS = [
+    ("прямое попадание", "Теннис"),
+    ("неоднозначность", "Меркурий"),
+    ("промах", "большой теннис"),
+    ("промах, summary медлит", "медленный теннис"),
+]
+
+
+class StubWikipedia:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.requests = 0
+        self.runner = None
+        self.url = ""
+
+    async def summary(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        title = unquote(request.match_info["title"]).replace("_", " ")
+        await asyncio.sleep(self.rtt * (4 if title in SLOW else 1))
+
+        if title in DISAMBIGUATION:
+            return web.json_response({"title": title, "type": "disambiguation", "extract": f"{title} может означать:"})
+        if title not in PAGES:
+            return web.json_response({"title": "Not found."}, status=404)
+
+        return web.json_response({
+            "title": title,
+            "type": "standard",
+            "extract": PAGES[title],
+            "content_urls": {"desktop": {"page": f"{self.url}/wiki/{title.replace(' ', '_')}"}},
+        })
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.rtt)
+        query = request.query.get("q", "")
+        titles = SEARCH.get(query) or SLOW.get(query) or []
+        return web.json_response({"pages": [{"title": title} for title in titles]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/rest_v1/page/summary/{title}", self.summary)
+        app.router.add_get("/w/rest.php/v1/search/page", self.search)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def legacy_lookup(service: bot.WikipediaService, query: str):
+    """
+    Как ходила библиотека wikipedia (auto_suggest=False), по кругу на запрос:
+    page() — query info, для неоднозначности ещё запрос за списком вариантов;
+    summary() — снова загрузка страницы и отдельный запрос за выжимкой;
+    search() — только после PageError.
+    """
+    request = service._fetch_summary
+
+    async def page(title):
+        result = await request(title)
+        if result and result["disambiguation"]:
+            await request(title)
+        return result
+
+    async def summary(title):
+        await request(title)
+        return await request(title)
+
+    found = await page(query)
+
+    if found and not found["disambiguation"]:
+        return await summary(query)
+
+    if found:
+        titles = DISAMBIGUATION.get(query, [])[:1]
+    else:
+        titles = (await service._search_titles(query))[:1]
+
+    if not titles:
+        return None
+
+    await page(titles[0])
+    return await summary(titles[0])
+
+
+async def measure(stub: StubWikipedia, lookup, query: str, repeat: int):
+    timings, requests = [], []
+
+    for _ in range(repeat):
+        before = stub.requests
+        started = time.perf_counter()
+        page = await lookup(query)
+        timings.append(time.perf_counter() - started)
+        # Отменённый поиск мог успеть уйти на сервер — даём ему дойти до счётчика.
+        await asyncio.sleep(stub.rtt * 2)
+        requests.append(stub.requests - before)
+
+    return page, statistics.median(timings), max(requests)
+
+
+async def run(args) -> int:
+    stub = StubWikipedia(args.rtt)
+    await stub.start()
+    service = bot.WikipediaService(base_url=stub.url, timeout=args.rtt * 20, search_delay=args.search_delay)
+    failures = []
+
+    try:
+        print(f"rtt {args.rtt * 1000:.0f} мс, search_delay {service.search_delay * 1000:.0f} мс\n")
+        print(f"{'сценарий':<26} {'страница':<22} {'новый':>14} {'старый':>14} {'выигрыш':>9}")
+
+        for name, query in SCENARIOS:
+            page, new_time, new_requests = await measure(stub, service._resolve_page, query, args.repeat)
+            _, old_time, old_requests = await measure(
+                stub, lambda q: legacy_lookup(service, q), query, args.repeat
+            )
+            title = page["title"] if page else "—"
+            gain = (old_time - new_time) / args.rtt
+            print(
+                f"{name:<26} {title:<22} {new_time * 1000:6.0f} мс x{new_requests:<3} "
+                f"{old_time * 1000:6.0f} мс x{old_requests:<3} {gain:+6.1f} rtt"
+            )
+
+            if gain < 0.9:
+                failures.append(f"{name}: выигрыш меньше круга")
+            # Если круг дольше search_delay, поиск страхует summary — второй запрос ожидаем.
+            if name == "прямое попадание" and new_requests != 1 and args.rtt < service.search_delay:
+                failures.append(f"{name}: {new_requests} запросов вместо одного")
+
+    finally:
+        await bot.close_http_client()
+        await stub.stop()
+
+    if failures:
+        print("\n" + "\n".join(failures))
+        return 1
+
+    print("\nновый путь быстрее старого на круг и больше")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rtt", type=float, default=0.15)
+    parser.add_argument("--search-delay", type=float, default=bot.WIKIPEDIA_SEARCH_DELAY)
+    parser.add_argument("--repeat", type=int, default=5)
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    bot.logger.setLevel("ERROR")
+    sys.exit(main())
@@ -1,28 +1,69 @@
 import os
 import re
 import json
+import zlib
+import inspect
+import functools
+import math
+import bisect
+import hmac
+import heapq
+import signal
+import hashlib
+import time as time_module
 import random
+import sys
 import sqlite3
 import asyncio
+import contextvars
 import logging
+import threading
+import traceback
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from datetime import datetime, time, timedelta
-from typing import Dict, List, Optional, Tuple, Any
+from array import array
+from urllib.parse import quote
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple, Any, Callable
 from dataclasses import dataclass
 
-import pytz
-import httpx
-import wikipedia
-from openai import OpenAI
-
-from telegram import Update
-from telegram.constants import ChatAction
-from telegram.ext import (
-    ApplicationBuilder,
-    MessageHandler,
-    ContextTypes,
-    CommandHandler,
-    filters,
-)
+# Отсчёт холодного старта. openai и aiohttp импортируются лениво — при первом
+# обращении к DeepSeek и только в webhook-режиме.
+STARTUP_STARTED = time_module.perf_counter()
+STARTUP_TIMINGS: List[Tuple[str, float]] = []
+
+
+@contextmanager
+def timed_startup(phase: str):
+    started = time_module.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS.append((phase, time_module.perf_counter() - started))
+
+
+with timed_startup("import pytz, httpx"):
+    import pytz
+    import httpx
+
+with timed_startup("import telegram"):
+    from telegram import Update
+    from telegram.constants import ChatAction
+    from telegram.error import NetworkError, RetryAfter, TimedOut
+    from telegram.ext import (
+        ApplicationBuilder,
+        MessageHandler,
+        ContextTypes,
+        CommandHandler,
+        TypeHandler,
+        filters,
+    )
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+MODULE_INIT_STARTED = time_module.perf_counter()
 
 # ========== LOGGING ==========
 
@@ -32,10 +73,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_startup_reported = False
+
+
+def format_startup_report(first_update_at: float) -> str:
+    parts = [f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in STARTUP_TIMINGS]
+    parts.append(f"первый апдейт через {(first_update_at - STARTUP_STARTED) * 1000:.0f} мс")
+    return "⏱️ Холодный старт: " + ", ".join(parts)
+
+
+async def log_startup_report(update: object, context) -> None:
+    """Один раз, на первом апдейте, пишет в лог разбивку времени старта."""
+    global _startup_reported
+
+    if _startup_reported:
+        return
+
+    _startup_reported = True
+    logger.info(format_startup_report(time_module.perf_counter()))
+
 # ========== SETTINGS ==========
 
 TELEGRAM_TOKEN = os.getenv("BOT_TOKEN", "")
 
+# polling — long polling (по умолчанию), webhook — свой aiohttp-сервер.
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "1"))
+
+FLY_APP_NAME = os.getenv("FLY_APP_NAME", "")
+WEBHOOK_URL = os.getenv(
+    "WEBHOOK_URL",
+    f"https://{FLY_APP_NAME}.fly.dev" if FLY_APP_NAME else "",
+).rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv(
+    "WEBHOOK_SECRET",
+    hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest() if TELEGRAM_TOKEN else "",
+)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "20"))
+
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")
 DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 DEFAULT_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
@@ -55,8 +134,21 @@ except ValueError:
     ADMIN_ID = 0
 
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "")
-
-wikipedia.set_lang("ru")
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "1800"))
+WEATHER_CACHE_STALE = int(os.getenv("WEATHER_CACHE_STALE", "10800"))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "256"))
+WEATHER_REFRESH_INTERVAL = int(os.getenv("WEATHER_REFRESH_INTERVAL", "1200"))
+WEATHER_PREFETCH_TOP = int(os.getenv("WEATHER_PREFETCH_TOP", "5"))
+WEATHER_TRACKED_QUERIES = int(os.getenv("WEATHER_TRACKED_QUERIES", "1024"))
+HOME_WEATHER_QUERY = "Brisbane,au"
+
+WIKIPEDIA_LANG = os.getenv("WIKIPEDIA_LANG", "ru")
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", f"https://{WIKIPEDIA_LANG}.wikipedia.org").rstrip("/")
+WIKIPEDIA_TIMEOUT = float(os.getenv("WIKIPEDIA_TIMEOUT", "6"))
+WIKIPEDIA_SEARCH_DELAY = float(os.getenv("WIKIPEDIA_SEARCH_DELAY", "0.5"))
+WIKI_CACHE_TTL = int(os.getenv("WIKI_CACHE_TTL", str(7 * 24 * 3600)))
+WIKI_CACHE_MAX_ROWS = int(os.getenv("WIKI_CACHE_MAX_ROWS", "2000"))
+WIKI_MEMORY_CACHE_SIZE = int(os.getenv("WIKI_MEMORY_CACHE_SIZE", "64"))
 
 BOT_LOCATION = {
     "city": "Брисбен",
@@ -87,6 +179,15 @@ TENNIS_CODE_VALID_UNTIL = "12 июля 2026"
 
 DB_PATH = os.getenv("LEILA_DB_PATH", "leila_memory.sqlite3")
 
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "2000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", str(24 * 3600)))
+USER_CACHE_MAX_BYTES = int(os.getenv("USER_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+WIKI_MEMORY_CACHE_MAX_BYTES = int(os.getenv("WIKI_MEMORY_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+
+# Входящие сообщения пишутся в SQLite пачками, а не по одному.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "50"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "5"))
+
 RANDOM_GROUP_REPLY_RATE = float(os.getenv("RANDOM_GROUP_REPLY_RATE", "0.15"))
 MAXIM_JOKE_RATE = float(os.getenv("MAXIM_JOKE_RATE", "0.12"))
 
@@ -94,6 +195,28 @@ SPONTANEOUS_MESSAGE_ENABLED = os.getenv("SPONTANEOUS_MESSAGE_ENABLED", "1") == "
 SPONTANEOUS_MIN_HOUR = int(os.getenv("SPONTANEOUS_MIN_HOUR", "11"))
 SPONTANEOUS_MAX_HOUR = int(os.getenv("SPONTANEOUS_MAX_HOUR", "22"))
 
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv("DUPLICATE_SIMILARITY_THRESHOLD", "0.55"))
+DUPLICATE_MAX_RETRIES = int(os.getenv("DUPLICATE_MAX_RETRIES", "2"))
+# Окно на каждый чат, а в памяти до DUPLICATE_CHATS_IN_MEMORY чатов: 120 × 50
+# подписей ≈ 4 МБ против ~10 МБ при 300 — для 256 МБ это заметно.
+DUPLICATE_WINDOW = int(os.getenv("DUPLICATE_WINDOW", "120"))
+DUPLICATE_CHATS_IN_MEMORY = int(os.getenv("DUPLICATE_CHATS_IN_MEMORY", "50"))
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))
+BROADCAST_JITTER_SECONDS = float(os.getenv("BROADCAST_JITTER_SECONDS", "600"))
+BROADCAST_KINDS = ("morning", "evening", "spontaneous", "tennis")
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личку, ~20/мин в группу.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_GLOBAL_BURST = int(os.getenv("OUTBOUND_GLOBAL_BURST", "30"))
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_QUEUE = int(os.getenv("OUTBOUND_MAX_QUEUE", "1000"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_WAIT = float(os.getenv("OUTBOUND_MAX_WAIT", "900"))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+
 LEILA_MOODS = [
     "обычное",
     "саркастичное",
@@ -175,2122 +298,6540 @@ def maybe_change_leila_state():
         CURRENT_LEILA_STATE["last_mood_change"] = now
 
 
-# ========== SQLITE MEMORY ==========
+# ========== METRICS ==========
 
-class MemoryStore:
-    def __init__(self, path: str):
-        self.path = path
-        self._init_db()
+# Эндпоинт /metrics в формате Prometheus; 0 — не поднимать отдельный порт.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
 
-    def _connect(self):
-        return sqlite3.connect(
-            self.path,
-            check_same_thread=False,
-            timeout=30,
-        )
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
 
-    def _init_db(self):
-        with self._connect() as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA synchronous=NORMAL;")
 
-            cur = conn.cursor()
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    first_name TEXT,
-                    last_name TEXT,
-                    username TEXT,
-                    gender TEXT,
-                    first_seen TEXT,
-                    last_seen TEXT,
-                    message_count INTEGER DEFAULT 0,
-                    facts_json TEXT DEFAULT '[]',
-                    topics_json TEXT DEFAULT '[]'
-                )
-            """)
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chat_memory (
-                    chat_id INTEGER PRIMARY KEY,
-                    last_activity TEXT,
-                    message_count INTEGER DEFAULT 0,
-                    recent_messages_json TEXT DEFAULT '[]',
-                    summary TEXT DEFAULT '',
-                    inside_jokes_json TEXT DEFAULT '[]'
-                )
-            """)
+def _format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    user_id INTEGER,
-                    role TEXT,
-                    name TEXT,
-                    content TEXT,
-                    created_at TEXT
-                )
-            """)
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    updated_at TEXT NOT NULL
-                )
-            """)
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
 
-            conn.commit()
 
-    def upsert_user(self, user_info: "UserInfo"):
-        now = datetime.now(pytz.UTC).isoformat()
+class _CounterChild:
+    __slots__ = ("value",)
 
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT user_id FROM users WHERE user_id = ?",
-                (user_info.id,),
-            )
-            existing = cur.fetchone()
+    def __init__(self):
+        self.value = 0.0
 
-            if existing:
-                cur.execute("""
-                    UPDATE users
-                    SET first_name = ?,
-                        last_name = ?,
-                        username = ?,
-                        gender = ?,
-                        last_seen = ?
-                    WHERE user_id = ?
-                """, (
-                    user_info.first_name,
-                    user_info.last_name,
-                    user_info.username,
-                    user_info.gender,
-                    now,
-                    user_info.id,
-                ))
-            else:
-                cur.execute("""
-                    INSERT INTO users (
-                        user_id, first_name, last_name, username, gender,
-                        first_seen, last_seen, message_count,
-                        facts_json, topics_json
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, 0, '[]', '[]')
-                """, (
-                    user_info.id,
-                    user_info.first_name,
-                    user_info.last_name,
-                    user_info.username,
-                    user_info.gender,
-                    now,
-                    now,
-                ))
+    def inc(self, amount: float = 1.0):
+        self.value += amount
 
-            conn.commit()
 
-    def increment_user_message(self, user_id: int):
-        with self._connect() as conn:
-            conn.execute("""
-                UPDATE users
-                SET message_count = message_count + 1,
-                    last_seen = ?
-                WHERE user_id = ?
-            """, (datetime.now(pytz.UTC).isoformat(), user_id))
-            conn.commit()
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
 
-    def add_user_fact(self, user_id: int, fact: str):
-        fact = fact.strip()
-        if not fact:
-            return
+    def set(self, value: float):
+        self.value = value
 
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT facts_json FROM users WHERE user_id = ?", (user_id,))
-            row = cur.fetchone()
-            facts = json.loads(row[0]) if row and row[0] else []
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
 
-            if fact not in facts:
-                facts.append(fact)
-                facts = facts[-20:]
 
-            cur.execute(
-                "UPDATE users SET facts_json = ? WHERE user_id = ?",
-                (json.dumps(facts, ensure_ascii=False), user_id),
-            )
-            conn.commit()
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
 
-    def add_user_topic(self, user_id: int, topic: str):
-        topic = topic.strip()
-        if not topic:
-            return
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
 
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT topics_json FROM users WHERE user_id = ?", (user_id,))
-            row = cur.fetchone()
-            topics = json.loads(row[0]) if row and row[0] else []
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
 
-            if topic not in topics:
-                topics.append(topic)
-                topics = topics[-20:]
 
-            cur.execute(
-                "UPDATE users SET topics_json = ? WHERE user_id = ?",
-                (json.dumps(topics, ensure_ascii=False), user_id),
-            )
-            conn.commit()
+class Metric(ABC):
+    """
+    Метрика с метками. labels(...) возвращает дочерний объект и кеширует его —
+    в горячем пути это один поиск в dict, без блокировок (всё в потоке event loop).
+    """
+    kind = "untyped"
 
-    def add_message(self, chat_id: int, user_id: int, role: str, name: str, content: str):
-        now = datetime.now(pytz.UTC).isoformat()
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[Any, ...], Any] = {}
 
-        with self._connect() as conn:
-            cur = conn.cursor()
+    @abstractmethod
+    def _new_child(self):
+        """Дочерний объект для одного набора значений меток."""
 
-            cur.execute("""
-                INSERT INTO messages (chat_id, user_id, role, name, content, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, user_id, role, name, content, now))
+    def labels(self, *values: Any):
+        child = self._children.get(values)
 
-            cur.execute("SELECT chat_id FROM chat_memory WHERE chat_id = ?", (chat_id,))
-            row = cur.fetchone()
+        if child is None:
+            child = self._new_child()
+            self._children[values] = child
 
-            if row:
-                cur.execute("""
-                    UPDATE chat_memory
-                    SET last_activity = ?,
-                        message_count = message_count + 1
-                    WHERE chat_id = ?
-                """, (now, chat_id))
-            else:
-                cur.execute("""
-                    INSERT INTO chat_memory (
-                        chat_id, last_activity, message_count,
-                        recent_messages_json, summary, inside_jokes_json
-                    )
-                    VALUES (?, ?, 1, '[]', '', '[]')
-                """, (chat_id, now))
+        return child
 
-            conn.commit()
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [
+            ("", _format_labels(self.labelnames, values), child.value)
+            for values, child in self._children.items()
+        ]
 
-    def get_user_profile_text(self, user_id: int) -> str:
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT first_name, last_name, username, gender, message_count, facts_json, topics_json
-                FROM users
-                WHERE user_id = ?
-            """, (user_id,))
-            row = cur.fetchone()
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+        return lines
 
-        if not row:
-            return ""
 
-        first_name, last_name, username, gender, message_count, facts_json, topics_json = row
-        facts = json.loads(facts_json or "[]")
-        topics = json.loads(topics_json or "[]")
+class Counter(Metric):
+    kind = "counter"
 
-        parts = [
-            f"Пользователь: {' '.join([x for x in [first_name, last_name] if x]).strip() or username or user_id}",
-            f"Сообщений: {message_count}",
-        ]
+    def _new_child(self):
+        return _CounterChild()
 
-        if topics:
-            parts.append(f"Темы, которые часто всплывали: {', '.join(topics[-8:])}")
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
 
-        if facts:
-            parts.append(f"Запомненные детали: {'; '.join(facts[-8:])}")
+    def total(self, **exclude: Any) -> float:
+        """Сумма по всем меткам, кроме указанных значений: total(status="ok") — все неуспешные."""
+        skip = [(self.labelnames.index(name), value) for name, value in exclude.items()]
+        return sum(
+            child.value for values, child in self._children.items()
+            if not any(values[i] == value for i, value in skip)
+        )
 
-        return "\n".join(parts)
 
-    def get_chat_context_text(self, chat_id: int, limit: int = 12) -> str:
-        with self._connect() as conn:
-            cur = conn.cursor()
+class Gauge(Metric):
+    kind = "gauge"
 
-            cur.execute("""
-                SELECT message_count, summary, inside_jokes_json
-                FROM chat_memory
-                WHERE chat_id = ?
-            """, (chat_id,))
-            row = cur.fetchone()
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._functions: Dict[Tuple[Any, ...], Callable[[], float]] = {}
 
-            cur.execute("""
-                SELECT role, name, content
-                FROM messages
-                WHERE chat_id = ?
-                ORDER BY id DESC
-                LIMIT ?
-            """, (chat_id, limit))
-            recent_rows = cur.fetchall()
+    def _new_child(self):
+        return _GaugeChild()
 
-        if not row and not recent_rows:
-            return ""
+    def set(self, value: float):
+        self.labels().set(value)
 
-        message_count = row[0] if row else 0
-        summary = row[1] if row else ""
-        jokes_json = row[2] if row else "[]"
-        jokes = json.loads(jokes_json or "[]")
+    def set_function(self, fn: Callable[[], float], *values: Any):
+        """Значение считается в момент выдачи /metrics (размеры очередей, кешей)."""
+        self._functions[values] = fn
 
-        last_lines = []
-        for role, name, content in reversed(recent_rows):
-            if role == "user":
-                last_lines.append(f"{name or 'Кто-то'}: {content}")
-            else:
-                last_lines.append(f"Лейла: {content}")
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = super().samples()
 
-        parts = [f"В этом чате накоплено сообщений: {message_count}"]
+        for values, fn in self._functions.items():
+            try:
+                samples.append(("", _format_labels(self.labelnames, values), float(fn())))
+            except Exception:
+                continue
 
-        if summary:
-            parts.append(f"Краткая память чата: {summary}")
+        return samples
 
-        if jokes:
-            parts.append(f"Локальные мемы: {'; '.join(jokes[-8:])}")
 
-        if last_lines:
-            parts.append("Недавний контекст:\n" + "\n".join(last_lines))
+class Histogram(Metric):
+    kind = "histogram"
 
-        return "\n\n".join(parts)
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
 
-    def add_inside_joke(self, chat_id: int, joke: str):
-        joke = joke.strip()
-        if not joke:
-            return
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
 
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT inside_jokes_json FROM chat_memory WHERE chat_id = ?", (chat_id,))
-            row = cur.fetchone()
-            jokes = json.loads(row[0]) if row and row[0] else []
+    def observe(self, value: float):
+        self.labels().observe(value)
 
-            if joke not in jokes:
-                jokes.append(joke)
-                jokes = jokes[-20:]
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
 
-            if row:
-                cur.execute(
-                    "UPDATE chat_memory SET inside_jokes_json = ? WHERE chat_id = ?",
-                    (json.dumps(jokes, ensure_ascii=False), chat_id),
-                )
-            else:
-                cur.execute("""
-                    INSERT INTO chat_memory (
-                        chat_id, last_activity, message_count, recent_messages_json,
-                        summary, inside_jokes_json
-                    )
-                    VALUES (?, ?, 0, '[]', '', ?)
-                """, (
-                    chat_id,
-                    datetime.now(pytz.UTC).isoformat(),
-                    json.dumps(jokes, ensure_ascii=False),
-                ))
+        for values, child in self._children.items():
+            cumulative = 0
 
-            conn.commit()
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(("_bucket", _format_labels(self.labelnames, values, le), cumulative))
 
-    def get_setting(self, key: str, default: str = "") -> str:
-        with self._connect() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = cur.fetchone()
-        return row[0] if row else default
+            labels = _format_labels(self.labelnames, values)
+            samples.append(("_sum", labels, child.sum))
+            samples.append(("_count", labels, child.count))
 
-    def set_setting(self, key: str, value: str):
-        now = datetime.now(pytz.UTC).isoformat()
-        with self._connect() as conn:
-            conn.execute("""
-                INSERT INTO settings (key, value, updated_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(key) DO UPDATE SET
-                    value = excluded.value,
-                    updated_at = excluded.updated_at
-            """, (key, value, now))
-            conn.commit()
+        return samples
 
-    def reset_chat_memory(self, chat_id: int):
-        with self._connect() as conn:
-            conn.execute("DELETE FROM chat_memory WHERE chat_id = ?", (chat_id,))
-            conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-            conn.commit()
 
-    def get_memory_stats(self, chat_id: int) -> str:
-        with self._connect() as conn:
-            cur = conn.cursor()
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: "OrderedDict[str, Metric]" = OrderedDict()
 
-            cur.execute("SELECT COUNT(*) FROM users")
-            users_count = cur.fetchone()[0]
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
 
-            cur.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
-            messages_count = cur.fetchone()[0]
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
 
-            cur.execute("SELECT inside_jokes_json FROM chat_memory WHERE chat_id = ?", (chat_id,))
-            row = cur.fetchone()
-            jokes = json.loads(row[0]) if row and row[0] else []
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
 
-        return (
-            f"👥 Пользователей в памяти: {users_count}\n"
-            f"💬 Сообщений этого чата в базе: {messages_count}\n"
-            f"🧠 Локальных мемов: {len(jokes)}"
-        )
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
 
-    def get_recent_spontaneous_messages(self) -> List[str]:
-        raw = self.get_setting("recent_spontaneous_messages_json", "[]")
-        try:
-            data = json.loads(raw)
-            return data if isinstance(data, list) else []
-        except Exception:
-            return []
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
 
-    def remember_spontaneous_message(self, text: str):
-        recent = self.get_recent_spontaneous_messages()
-        recent.append(text.strip())
-        recent = [x for x in recent if x][-20:]
-        self.set_setting(
-            "recent_spontaneous_messages_json",
-            json.dumps(recent, ensure_ascii=False),
-        )
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
 
 
-memory_store = MemoryStore(DB_PATH)
+metrics = MetricsRegistry()
 
-TENNIS_ACCESS_CODE = memory_store.get_setting("tennis_access_code", TENNIS_ACCESS_CODE)
-TENNIS_CODE_VALID_UNTIL = memory_store.get_setting("tennis_code_valid_until", TENNIS_CODE_VALID_UNTIL)
+UPDATES_TOTAL = metrics.counter(
+    "leila_updates_total", "Текстовые апдейты по исходу (ignored/replied/error)", ("outcome",)
+)
+HANDLE_SECONDS = metrics.histogram(
+    "leila_handle_seconds", "Время handle_message по исходу", ("outcome",)
+)
+DEEPSEEK_REQUESTS = metrics.counter(
+    "leila_deepseek_requests_total", "Запросы к DeepSeek по модели и результату", ("model", "status")
+)
+DEEPSEEK_SECONDS = metrics.histogram(
+    "leila_deepseek_seconds", "Задержка DeepSeek по модели", ("model",)
+)
+DB_SECONDS = metrics.histogram(
+    "leila_db_seconds", "Время методов MemoryStore", ("method",), buckets=DB_BUCKETS
+)
+HTTP_FETCHES = metrics.counter(
+    "leila_http_fetches_total", "Внешние HTTP-запросы (погода, Википедия) по статусу", ("service", "status")
+)
+HTTP_FETCH_SECONDS = metrics.histogram(
+    "leila_http_fetch_seconds", "Задержка внешних HTTP-запросов", ("service",)
+)
+TELEGRAM_SENDS = metrics.counter(
+    "leila_telegram_sends_total", "Отправки в Telegram по результату", ("result",)
+)
+TELEGRAM_SEND_SECONDS = metrics.histogram(
+    "leila_telegram_send_seconds", "Длительность вызова sendMessage"
+)
+OUTBOUND_WAIT_SECONDS = metrics.histogram(
+    "leila_outbound_wait_seconds", "Ожидание сообщения в очереди отправки до успешной доставки"
+)
+QUEUE_DEPTH = metrics.gauge("leila_queue_depth", "Глубина внутренних очередей", ("queue",))
+CACHE_ENTRIES = metrics.gauge("leila_cache_entries", "Записей в кешах", ("cache",))
+CACHE_BYTES = metrics.gauge("leila_cache_bytes", "Оценка памяти кешей в байтах", ("cache",))
+PROCESS_RSS_BYTES = metrics.gauge("leila_process_rss_bytes", "Резидентная память процесса (RSS)")
+PYTHON_HEAP_BLOCKS = metrics.gauge("leila_python_allocated_blocks", "Живых блоков аллокатора Python")
+TRACEMALLOC_BYTES = metrics.gauge(
+    "leila_tracemalloc_traced_bytes", "Память под трассировкой tracemalloc (0 — трассировка выключена)"
+)
+LOOP_LAG_SECONDS = metrics.histogram(
+    "leila_loop_lag_seconds", "Опоздание event loop относительно запланированного пробуждения",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_BLOCKS = metrics.counter(
+    "leila_loop_blocks_total", "Зависания event loop по функции bot.py, пойманной в момент блокировки", ("function",)
+)
 
+# Стадия, которую уже замеряет внешний вызов timed_methods в этом контексте.
+_timed_stage: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("leila_timed_stage", default=None)
 
-# ========== DATACLASSES ==========
 
-@dataclass
-class UserInfo:
-    id: int
-    first_name: str
-    last_name: str = ""
-    username: str = ""
-    last_seen: Optional[datetime] = None
-    conversation_topics: Optional[List[str]] = None
-    gender: str = "unknown"
+def timed_methods(histogram: Histogram, stage: Optional[str] = None):
+    """
+    Декоратор класса: каждый публичный метод пишет своё время в histogram с меткой method.
+    Если задан stage, время ещё идёт в трассу текущего апдейта и в ряд /perf с тем же именем.
+    Методы с @untimed не оборачиваются, с @timed_if — замеряются, только когда условие истинно.
+    """
 
-    def __post_init__(self):
-        if self.last_seen is None:
-            self.last_seen = datetime.now(pytz.UTC)
-        if self.conversation_topics is None:
-            self.conversation_topics = []
-        self._determine_gender()
+    def wrap(fn, child):
+        condition = getattr(fn, "_timed_if", None)
 
-    def _determine_gender(self):
-        if self.gender != "unknown":
-            return
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if condition is not None and not condition(args[0]):
+                return fn(*args, **kwargs)
 
-        name_lower = (self.first_name or "").lower()
+            # Вложенные вызовы (add_message -> flush_ingest) в /perf и трассу идут один раз —
+            # и в апдейте, и в фоновых задачах и потоках.
+            token = None
+            if stage and _timed_stage.get() != stage:
+                token = _timed_stage.set(stage)
 
-        female_endings = ["а", "я", "ия", "ина", "ла", "та"]
-        male_endings = ["й", "ь", "н", "р", "л", "с", "в", "д", "м"]
+            started = time_module.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time_module.perf_counter() - started
+                child.observe(elapsed)
+                if token is not None:
+                    _timed_stage.reset(token)
+                    perf_stats.observe(stage, elapsed)
+                    trace = _current_trace.get()
+                    if trace is not None:
+                        trace.record(stage, elapsed)
 
-        for ending in female_endings:
-            if name_lower.endswith(ending):
-                self.gender = "female"
-                return
+        return timed
 
-        for ending in male_endings:
-            if name_lower.endswith(ending) and len(name_lower) > 2:
-                self.gender = "male"
-                return
+    def decorate(cls):
+        for name, fn in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.isfunction(fn) and not getattr(fn, "_untimed", False):
+                setattr(cls, name, wrap(fn, histogram.labels(name)))
+        return cls
 
-    @property
-    def full_name(self) -> str:
-        parts = []
-        if self.first_name:
-            parts.append(self.first_name)
-        if self.last_name:
-            parts.append(self.last_name)
-        return " ".join(parts) if parts else ""
+    return decorate
 
-    def get_display_name(self) -> str:
-        if self.first_name:
-            return self.first_name
-        if self.username:
-            return f"@{self.username}"
-        if self.full_name:
-            return self.full_name
-        return "Пользователь"
 
-    def is_maxim(self) -> bool:
-        return self.id == MAXIM_ID
+def untimed(fn):
+    """Метод, который timed_methods не замеряет: например, он не ходит в базу."""
+    fn._untimed = True
+    return fn
 
 
-@dataclass
-class ConversationMemory:
-    user_id: int
-    chat_id: int
-    messages: List[Dict[str, str]]
-    last_activity: datetime
-    context_summary: str = ""
-    summary_history: Optional[List[str]] = None
-    important_points: Optional[List[str]] = None
+def timed_if(condition: Callable[[Any], Any]):
+    """Метод замеряется timed_methods, только если condition(self) истинно до вызова."""
 
-    def __post_init__(self):
-        if self.summary_history is None:
-            self.summary_history = []
-        if self.important_points is None:
-            self.important_points = []
+    def mark(fn):
+        fn._timed_if = condition
+        return fn
 
-    def add_message(self, role: str, content: str):
-        self.messages.append({"role": role, "content": content})
-        self.last_activity = datetime.now(pytz.UTC)
+    return mark
 
-        if len(self.messages) > 50:
-            self.messages = self.messages[-30:]
 
+# ========== TRACING ==========
 
-# ========== GLOBALS ==========
+# Трасса апдейта: сколько миллисекунд ушло на каждую стадию ответа.
+# Одна строка в лог на апдейт, по желанию — JSONL для разбора офлайн.
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(20 * 1024 * 1024)))
 
-user_cache: Dict[int, UserInfo] = {}
-conversation_memories: Dict[str, ConversationMemory] = {}
 
-if DEEPSEEK_API_KEY:
-    client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
-    logger.info("✅ DeepSeek клиент инициализирован")
-else:
-    client = None
-    logger.warning("❌ DEEPSEEK_API_KEY не задан")
+class UpdateTrace:
+    """
+    Стадии одного апдейта. Повторы стадии (несколько запросов к SQLite,
+    ретраи DeepSeek) суммируются, вложенные спаны с тем же именем не
+    считаются дважды. Стадии могут вкладываться друг в друга, поэтому их
+    сумма не обязана совпадать с total.
+    """
 
+    __slots__ = ("update_id", "chat_id", "started", "started_at", "stages", "_open")
 
-# ========== TIME / LOCATION ==========
+    def __init__(self, update_id: int, chat_id: int):
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.started = time_module.perf_counter()
+        self.started_at = time_module.time()
+        self.stages: Dict[str, List[float]] = {}
+        self._open: set = set()
 
-def get_tz() -> pytz.timezone:
-    return pytz.timezone(BOT_TZ)
+    def record(self, stage: str, seconds: float):
+        if stage in self._open:
+            return
 
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
 
-def get_season_for_location(month: int, hemisphere: str = "southern") -> str:
-    if hemisphere == "southern":
-        if month in [12, 1, 2]:
-            return "лето"
-        if month in [3, 4, 5]:
-            return "осень"
-        if month in [6, 7, 8]:
-            return "зима"
-        return "весна"
+    def elapsed(self) -> float:
+        return time_module.perf_counter() - self.started
 
-    if month in [12, 1, 2]:
-        return "зима"
-    if month in [3, 4, 5]:
-        return "весна"
-    if month in [6, 7, 8]:
-        return "лето"
-    return "осень"
+    def format_line(self, outcome: str, total: float) -> str:
+        parts = []
+        for stage, (seconds, count) in self.stages.items():
+            part = f"{stage}={seconds * 1000:.1f}"
+            if count > 1:
+                part += f"x{count}"
+            parts.append(part)
 
+        return (
+            f"🧭 trace update={self.update_id} chat={self.chat_id} outcome={outcome} "
+            f"total={total * 1000:.1f}ms | " + " ".join(parts)
+        )
 
-def get_current_season() -> Tuple[str, Dict[str, Any]]:
-    tz = get_tz()
-    now = datetime.now(tz)
-    season = get_season_for_location(now.month, BOT_LOCATION["hemisphere"])
+    def as_record(self, outcome: str, total: float) -> Dict[str, Any]:
+        return {
+            "ts": round(self.started_at, 3),
+            "update_id": self.update_id,
+            "chat_id": self.chat_id,
+            "outcome": outcome,
+            "total_ms": round(total * 1000, 2),
+            "stages": {
+                stage: {"ms": round(seconds * 1000, 2), "n": count}
+                for stage, (seconds, count) in self.stages.items()
+            },
+        }
 
-    season_descriptions = {
-        "лето": {"emoji": "🌞🏖️", "description": "жаркое австралийское лето"},
-        "осень": {"emoji": "🍂🌧️", "description": "тёплая осень"},
-        "зима": {"emoji": "⛄☕", "description": "мягкая зима"},
-        "весна": {"emoji": "🌸🌼", "description": "цветущая весна"},
-    }
 
-    return season, season_descriptions.get(season, {})
+_current_trace: "contextvars.ContextVar[Optional[UpdateTrace]]" = contextvars.ContextVar(
+    "leila_trace", default=None
+)
 
 
-def get_time_of_day(dt: datetime) -> Tuple[str, str]:
-    hour = dt.hour
+class span:
+    """
+    Замеряет блок как стадию текущей трассы; вне апдейта ничего не делает.
+    Класс, а не @contextmanager: на пути игнорируемых сообщений генератор
+    стоил бы заметно дороже.
+    """
 
-    if 5 <= hour < 9:
-        return "раннее утро", "🌅 Начинается новый день"
-    if 9 <= hour < 12:
-        return "утро", "☀️ Утро в разгаре"
-    if 12 <= hour < 14:
-        return "полдень", "🌞 Полдень, время обеда"
-    if 14 <= hour < 17:
-        return "день", "😊 День продолжается"
-    if 17 <= hour < 20:
-        return "вечер", "🌇 Вечер, время отдыха"
-    if 20 <= hour < 23:
-        return "поздний вечер", "🌃 Поздний вечер"
+    __slots__ = ("stage", "trace", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.trace = None
+
+    def __enter__(self):
+        trace = _current_trace.get()
+        if trace is not None and self.stage not in trace._open:
+            trace._open.add(self.stage)
+            self.trace = trace
+            self.started = time_module.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        trace = self.trace
+        if trace is not None:
+            trace._open.discard(self.stage)
+            trace.record(self.stage, time_module.perf_counter() - self.started)
+        return False
 
-    return "ночь", "🌌 Ночь, время тишины"
 
+class TraceExporter:
+    """Дописывает трассы в JSONL; при превышении размера файл уезжает в .1."""
 
-def get_australian_context() -> str:
-    tz = get_tz()
-    now = datetime.now(tz)
-    season, season_info = get_current_season()
-    time_of_day, time_desc = get_time_of_day(now)
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._file = None
+        self._size = 0
 
-    return f"""
-📍 География:
-- Лейла живёт в {BOT_LOCATION['city']}, {BOT_LOCATION['country']}
-- Южное полушарие
-- Часовой пояс: {BOT_TZ}
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
 
-🕒 Сезон и время:
-- Сейчас {season} ({season_info.get('description', '')})
-- {time_desc} ({time_of_day})
-""".strip()
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                self._size = self._file.tell()
 
+            if self.max_bytes and self._size + len(line) > self.max_bytes:
+                self._file.close()
+                os.replace(self.path, self.path + ".1")
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                self._size = 0
 
-# ========== MOON ==========
+            self._file.write(line)
+            self._size += len(line)
 
-SYNODIC_MONTH = 29.530588853
+        except OSError as e:
+            logger.warning(f"🧭 Не удалось записать трассу в {self.path}: {e}")
 
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-def _moon_age_days(dt_utc: datetime) -> float:
-    ref_new_moon = datetime(2000, 1, 6, 18, 14, tzinfo=pytz.UTC)
-    delta_days = (dt_utc - ref_new_moon).total_seconds() / 86400.0
-    return delta_days % SYNODIC_MONTH
 
+trace_exporter = TraceExporter(TRACE_EXPORT_PATH, TRACE_EXPORT_MAX_BYTES) if TRACE_EXPORT_PATH else None
 
-def get_moon_phase(dt_local: Optional[datetime] = None) -> Dict[str, Any]:
-    import math
 
-    tz = get_tz()
+def start_trace(update_id: int, chat_id: int) -> Tuple[Optional[UpdateTrace], Optional[contextvars.Token]]:
+    if not TRACE_ENABLED:
+        return None, None
 
-    if dt_local is None:
-        dt_local = datetime.now(tz)
+    trace = UpdateTrace(update_id, chat_id)
+    return trace, _current_trace.set(trace)
 
-    dt_utc = dt_local.astimezone(pytz.UTC)
-    age = _moon_age_days(dt_utc)
 
-    illumination = (1 - math.cos(2 * math.pi * (age / SYNODIC_MONTH))) / 2
-    illumination_pct = int(round(illumination * 100))
+def finish_trace(trace: Optional[UpdateTrace], token: Optional[contextvars.Token], outcome: str):
+    if trace is None:
+        return
 
-    if age < 1.0 or age > (SYNODIC_MONTH - 1.0):
-        phase, detail, emoji = "новолуние", "новолуние", "🌑"
-    elif 1.0 <= age < 6.382:
-        phase, detail, emoji = "растущая", "растущий серп", "🌒"
-    elif 6.382 <= age < 8.382:
-        phase, detail, emoji = "растущая", "первая четверть", "🌓"
-    elif 8.382 <= age < 13.765:
-        phase, detail, emoji = "растущая", "растущая луна", "🌔"
-    elif 13.765 <= age < 15.765:
-        phase, detail, emoji = "полнолуние", "полнолуние", "🌕"
-    elif 15.765 <= age < 21.148:
-        phase, detail, emoji = "убывающая", "убывающая луна", "🌖"
-    elif 21.148 <= age < 23.148:
-        phase, detail, emoji = "убывающая", "последняя четверть", "🌗"
-    else:
-        phase, detail, emoji = "убывающая", "убывающий серп", "🌘"
+    _current_trace.reset(token)
+    total = trace.elapsed()
 
-    return {
-        "age_days": round(age, 1),
-        "phase": phase,
-        "phase_detail": detail,
-        "emoji": emoji,
-        "illumination_pct": illumination_pct,
-        "local_time": dt_local.strftime("%Y-%m-%d %H:%M"),
-    }
+    # Проигнорированные сообщения группы — основной поток, в INFO они только шумят.
+    if outcome == "ignored":
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(trace.format_line(outcome, total))
+        return
 
+    logger.info(trace.format_line(outcome, total))
 
-def format_moon_phrase(moon: Dict[str, Any]) -> str:
-    return (
-        f"{moon['emoji']} Луна: {moon['phase']} "
-        f"({moon['phase_detail']}), ~{moon['illumination_pct']}% света"
-    )
+    if trace_exporter is not None:
+        trace_exporter.write(trace.as_record(outcome, total))
 
 
-def get_moon_comment(moon: Dict[str, Any]) -> str:
-    phase = moon["phase"]
-    comments = MOON_MOOD_COMMENTS.get(
-        phase,
-        ["Луна сегодня молчит, но явно что-то знает."],
-    )
-    return random.choice(comments)
+# ========== PERF ==========
 
+# Скользящие окна для /perf. Квантили — по логарифмическим корзинам
+# (как в DDSketch): относительная ошибка ~PERF_SKETCH_ACCURACY, сырые замеры не храним.
+PERF_WINDOWS = (("5 мин", 300), ("1 ч", 3600), ("24 ч", 86400))
+PERF_SAMPLE_INTERVAL = int(os.getenv("PERF_SAMPLE_INTERVAL", "60"))
+PERF_SKETCH_ACCURACY = float(os.getenv("PERF_SKETCH_ACCURACY", "0.02"))
 
-# ========== WEATHER ==========
+_SKETCH_GAMMA = (1 + PERF_SKETCH_ACCURACY) / (1 - PERF_SKETCH_ACCURACY)
+_SKETCH_INV_LOG_GAMMA = 1 / math.log(_SKETCH_GAMMA)
+_SKETCH_MIN_VALUE = 1e-6
+_SKETCH_ZERO_BIN = -(10 ** 6)
 
-class WeatherService:
-    def __init__(self):
-        self.api_key = OPENWEATHER_API_KEY
-        self.base_url = "https://api.openweathermap.org/data/2.5/weather"
-        self.cache: Dict[str, Any] = {}
-        self.cache_duration = 1800
-
-        self.city_aliases = {
-            "москва": "Moscow,ru",
-            "москве": "Moscow,ru",
-            "питер": "Saint Petersburg,ru",
-            "петербург": "Saint Petersburg,ru",
-            "санкт-петербург": "Saint Petersburg,ru",
-            "спб": "Saint Petersburg,ru",
-            "калуга": "Kaluga,ru",
-            "калуге": "Kaluga,ru",
-            "казань": "Kazan,ru",
-            "нижний новгород": "Nizhny Novgorod,ru",
-            "новосибирск": "Novosibirsk,ru",
-            "екатеринбург": "Yekaterinburg,ru",
-            "самара": "Samara,ru",
-            "омск": "Omsk,ru",
-            "челябинск": "Chelyabinsk,ru",
-            "ростов": "Rostov-on-Don,ru",
-            "уфа": "Ufa,ru",
-            "красноярск": "Krasnoyarsk,ru",
-            "пермь": "Perm,ru",
-            "воронеж": "Voronezh,ru",
-            "волгоград": "Volgograd,ru",
-            "брисбен": "Brisbane,au",
-            "брисбене": "Brisbane,au",
-            "сидней": "Sydney,au",
-            "сиднее": "Sydney,au",
-            "мельбурн": "Melbourne,au",
-            "мельбурне": "Melbourne,au",
-            "перт": "Perth,au",
-            "аделаида": "Adelaide,au",
-            "кэнберра": "Canberra,au",
-            "лондон": "London,uk",
-            "париж": "Paris,fr",
-            "берлин": "Berlin,de",
-            "токио": "Tokyo,jp",
-            "нью-йорк": "New York,us",
-            "нью йорк": "New York,us",
-            "лос-анджелес": "Los Angeles,us",
-            "торонто": "Toronto,ca",
-            "дубай": "Dubai,ae",
-            "пекин": "Beijing,cn",
-            "сеул": "Seoul,kr",
-        }
 
-        self.weather_keywords = [
-            "погода",
-            "температура",
-            "температуре",
-            "градус",
-            "градусов",
-            "холодно",
-            "жарко",
-            "тепло",
-            "прохладно",
-            "дождь",
-            "дожд",
-            "снег",
-            "снеж",
-            "солнце",
-            "солнечн",
-            "ветер",
-            "ветрен",
-            "облач",
-            "ясн",
-            "пасмурн",
-            "шторм",
-        ]
+def sketch_index(value: float) -> int:
+    if value > _SKETCH_MIN_VALUE:
+        return math.ceil(math.log(value) * _SKETCH_INV_LOG_GAMMA)
+    return _SKETCH_ZERO_BIN
 
-    def extract_city_from_text(self, text: str) -> Optional[str]:
-        text_lower = text.lower()
 
-        for alias, city in self.city_aliases.items():
-            if alias in text_lower:
-                return city
+class QuantileSketch:
+    """Счётчики по корзинам [gamma^(i-1), gamma^i); квантиль — середина корзины."""
 
-        patterns = [
-            r"погода\s+в\s+([а-яa-zё\-\s]+)",
-            r"температура\s+в\s+([а-яa-zё\-\s]+)",
-            r"сколько\s+градусов\s+в\s+([а-яa-zё\-\s]+)",
-        ]
+    __slots__ = ("bins", "count", "total", "max")
 
-        for pattern in patterns:
-            match = re.search(pattern, text_lower)
-            if match:
-                city = match.group(1).strip()
-                city = re.sub(r"[?.!,]+$", "", city).strip()
-                if city:
-                    return self.city_aliases.get(city, city)
+    def __init__(self):
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float, index: Optional[int] = None):
+        if index is None:
+            index = sketch_index(value)
+
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "QuantileSketch"):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
 
-        return None
+        rank = q * (self.count - 1)
+        seen = 0
 
-    def is_weather_query(self, text: str) -> bool:
-        text_lower = text.lower()
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                if index == _SKETCH_ZERO_BIN:
+                    return 0.0
+                return min(self.max, 2 * _SKETCH_GAMMA ** index / (_SKETCH_GAMMA + 1))
 
-        if any(keyword in text_lower for keyword in self.weather_keywords):
-            return True
+        return self.max
 
-        city = self.extract_city_from_text(text)
 
-        if city and any(word in text_lower for word in ["погод", "температур", "сколько градус"]):
-            return True
+class SlidingSketch:
+    """
+    Скетч по скользящему окну: минутные слоты за последний час и
+    15-минутные за сутки. Окно захватывает текущий неполный слот,
+    так что «5 мин» — это от 4 до 5 минут.
+    """
 
-        return False
+    RESOLUTIONS = ((60, 60), (900, 96))
 
-    async def get_weather(self, city_query: str) -> Optional[Dict[str, Any]]:
-        if not self.api_key:
-            return None
+    __slots__ = ("_rings", "_current")
 
-        cache_key = city_query.lower()
+    def __init__(self):
+        self._rings: List[Dict[int, QuantileSketch]] = [{} for _ in self.RESOLUTIONS]
+        # Граница текущего минутного слота и его скетчи — чтобы в горячем пути не считать ключи.
+        self._current: Tuple[float, Tuple[QuantileSketch, ...]] = (0.0, ())
+
+    def add(self, value: float, now: float):
+        until, sketches = self._current
+
+        if now >= until:
+            # Шаги кратны минуте, так что смена минуты покрывает и смену 15-минутки.
+            sketches = tuple(
+                self._slot(ring, step, slots, now)
+                for (step, slots), ring in zip(self.RESOLUTIONS, self._rings)
+            )
+            step = self.RESOLUTIONS[0][0]
+            self._current = ((now // step + 1) * step, sketches)
 
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if (datetime.now().timestamp() - timestamp) < self.cache_duration:
-                return cached_data
+        index = sketch_index(value)
+        for sketch in sketches:
+            sketch.add(value, index)
 
-        if city_query.lower() in self.city_aliases:
-            city_query = self.city_aliases[city_query.lower()]
+    @staticmethod
+    def _slot(ring: Dict[int, QuantileSketch], step: int, slots: int, now: float) -> QuantileSketch:
+        key = int(now // step)
+        sketch = ring.get(key)
 
-        params = {
-            "q": city_query,
-            "appid": self.api_key,
-            "units": "metric",
-            "lang": "ru",
-        }
+        if sketch is None:
+            sketch = ring[key] = QuantileSketch()
+            for old in [k for k in ring if k <= key - slots]:
+                del ring[old]
 
-        async with httpx.AsyncClient(timeout=10.0) as session:
-            try:
-                response = await session.get(self.base_url, params=params)
+        return sketch
 
-                if response.status_code != 200:
-                    return None
+    def window(self, seconds: float, now: float) -> QuantileSketch:
+        for (step, slots), ring in zip(self.RESOLUTIONS, self._rings):
+            if seconds <= step * slots:
+                break
 
-                data = response.json()
-
-                temp = data["main"]["temp"]
-                feels_like = data["main"]["feels_like"]
-                humidity = data["main"]["humidity"]
-                description = data["weather"][0]["description"]
-                city_name = data["name"]
-                country = data["sys"]["country"]
-                wind_speed = data["wind"]["speed"]
-
-                weather_emoji = self._get_weather_emoji(description.lower(), temp)
-
-                result = {
-                    "city": city_name,
-                    "country": country,
-                    "temp": round(temp),
-                    "feels_like": round(feels_like),
-                    "humidity": humidity,
-                    "description": description,
-                    "wind_speed": wind_speed,
-                    "emoji": weather_emoji,
-                    "full_text": self._format_weather_text(
-                        city_name,
-                        country,
-                        temp,
-                        feels_like,
-                        description,
-                        weather_emoji,
-                    ),
-                }
+        first = int(now // step) - int(seconds // step) + 1
+        merged = QuantileSketch()
 
-                self.cache[cache_key] = (result, datetime.now().timestamp())
-                return result
+        for key, sketch in ring.items():
+            if key >= first:
+                merged.merge(sketch)
 
-            except Exception as e:
-                logger.error(f"Ошибка получения погоды для {city_query}: {e}", exc_info=True)
-
-        return None
-
-    def _get_weather_emoji(self, description: str, temp: float) -> str:
-        d = description.lower()
-
-        if "дождь" in d or "ливень" in d:
-            return "🌧️"
-        if "гроза" in d or "молния" in d:
-            return "⛈️"
-        if "снег" in d:
-            return "❄️"
-        if "туман" in d:
-            return "🌫️"
-        if "облач" in d or "пасмурн" in d:
-            return "☁️"
-        if "ясн" in d or "солнечн" in d or "ясно" in d:
-            return "🌞" if temp > 25 else "☀️"
-        if "ветер" in d:
-            return "💨"
-        if temp > 25:
-            return "🔥"
-        if temp < 0:
-            return "🥶"
+        return merged
 
-        return "🌤️"
+    def bin_count(self) -> int:
+        return sum(len(sketch.bins) for ring in self._rings for sketch in ring.values())
 
-    def _format_weather_text(
-        self,
-        city: str,
-        country: str,
-        temp: float,
-        feels_like: float,
-        description: str,
-        emoji: str,
-    ) -> str:
-        t = round(temp)
-        f = round(feels_like)
 
-        options = [
-            f"{emoji} В {city}, {country} сейчас {description}, {t}°C. Ощущается как {f}°C.",
-            f"{emoji} Погода в {city}: {description}, {t}°C. Вполне терпимо, если не драматизировать.",
-        ]
+class PerfStats:
+    """
+    Задержки — в SlidingSketch по рядам (reply, deepseek:<model>, sqlite, telegram).
+    Счётчики (ошибки, попадания в кеши) уже накапливаются в метриках и статистике
+    сервисов, поэтому раз в PERF_SAMPLE_INTERVAL снимаем их значения и считаем
+    разницу за окно — в горячем пути для них ничего не добавляется.
+    """
 
-        return random.choice(options)
+    def __init__(self, sample_interval: int = 60):
+        self.series: Dict[str, SlidingSketch] = {}
+        self.counters: Dict[str, Callable[[], float]] = {}
+        self.history: Deque[Tuple[float, Dict[str, float]]] = deque(
+            maxlen=PERF_WINDOWS[-1][1] // max(1, sample_interval) + 2
+        )
+        self.started = time_module.monotonic()
 
+    def observe(self, series: str, seconds: float):
+        sketch = self.series.get(series)
+        if sketch is None:
+            sketch = self.series[series] = SlidingSketch()
+        sketch.add(seconds, time_module.monotonic())
 
-weather_service = WeatherService()
+    def track(self, name: str, fn: Callable[[], float]):
+        self.counters[name] = fn
 
+    def sample(self, now: Optional[float] = None):
+        now = time_module.monotonic() if now is None else now
+        self.history.append((now, {name: fn() for name, fn in self.counters.items()}))
 
-async def handle_weather_query(text: str) -> Optional[str]:
-    if not weather_service.is_weather_query(text):
-        return None
+    def deltas(self, seconds: float, now: Optional[float] = None) -> Tuple[Dict[str, float], float]:
+        """Прирост счётчиков за окно и фактическая длина окна (меньше, если процесс моложе)."""
+        now = time_module.monotonic() if now is None else now
+        baseline_at, baseline = self.started, {}
 
-    city = weather_service.extract_city_from_text(text) or "Brisbane,au"
-    weather_data = await weather_service.get_weather(city)
+        for sampled_at, values in self.history:
+            baseline_at, baseline = sampled_at, values
+            if sampled_at >= now - seconds:
+                break
 
-    return weather_data["full_text"] if weather_data else None
+        current = {name: fn() for name, fn in self.counters.items()}
+        return {name: value - baseline.get(name, 0.0) for name, value in current.items()}, now - baseline_at
 
+    def window(self, series: str, seconds: float, now: Optional[float] = None) -> QuantileSketch:
+        now = time_module.monotonic() if now is None else now
+        sketch = self.series.get(series)
+        return sketch.window(seconds, now) if sketch else QuantileSketch()
 
-# ========== WIKIPEDIA ==========
 
-class WikipediaService:
-    def __init__(self):
-        self.summary_cache: Dict[str, Tuple[str, str, str]] = {}
+perf_stats = PerfStats(PERF_SAMPLE_INTERVAL)
 
-    async def search_wikipedia(
-        self,
-        query: str,
-        sentences: int = 3,
-    ) -> Optional[Tuple[str, str, str]]:
-        if not query:
-            return None
 
-        cache_key = f"{query}_{sentences}"
+# ========== SQL LOG ==========
 
-        if cache_key in self.summary_cache:
-            return self.summary_cache[cache_key]
+# Каждое выражение MemoryStore проходит через TimedConnection/TimedCursor.
+# Медленные (дольше SQL_SLOW_MS) пишутся в лог вместе с EXPLAIN QUERY PLAN.
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+SQL_MAX_SHAPES = int(os.getenv("SQL_MAX_SHAPES", "500"))
 
-        try:
-            result = await asyncio.to_thread(self._search_sync, query, sentences)
+_SQL_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
 
-            if result:
-                self.summary_cache[cache_key] = result
 
-            return result
+def sql_shape(sql: str) -> str:
+    """Форма выражения: без лишних пробелов, литералы и списки плейсхолдеров схлопнуты."""
+    shape = re.sub(r"\s+", " ", sql).strip()
+    shape = re.sub(r"'(?:[^']|'')*'", "'?'", shape)
+    shape = re.sub(r"\b\d+\b", "N", shape)
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", shape)
 
-        except Exception as e:
-            logger.error(f"Ошибка поиска в Википедии для '{query}': {e}", exc_info=True)
 
-        return None
+class QueryStats:
+    __slots__ = ("sql", "count", "total", "max", "slow", "plan")
 
-    def _search_sync(self, query: str, sentences: int) -> Optional[Tuple[str, str, str]]:
-        try:
-            page = wikipedia.page(query, auto_suggest=False)
-            summary = wikipedia.summary(query, sentences=sentences, auto_suggest=False)
-            return summary, page.title, page.url
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.plan: Optional[str] = None
 
-        except wikipedia.DisambiguationError as e:
-            options = e.options[:3]
 
-            if options:
-                page = wikipedia.page(options[0], auto_suggest=False)
-                summary = wikipedia.summary(options[0], sentences=sentences, auto_suggest=False)
-                return summary, page.title, page.url
+class QueryLog:
+    """
+    Счётчики по формам выражений и планы запросов. План снимается один раз
+    на форму: при первом медленном выполнении или при первом отчёте.
+    """
 
-        except wikipedia.PageError:
-            pass
+    def __init__(self, slow_seconds: float, max_shapes: int):
+        self.slow_seconds = slow_seconds
+        self.max_shapes = max_shapes
+        self.stats: Dict[str, QueryStats] = {}
+        self._shapes: Dict[str, str] = {}
 
-        search_results = wikipedia.search(query, results=3)
+    def shape(self, sql: str) -> str:
+        # SQL в коде — литералы, так что кеш по тексту почти всегда попадает.
+        shape = self._shapes.get(sql)
 
-        if search_results:
-            page = wikipedia.page(search_results[0], auto_suggest=False)
-            summary = wikipedia.summary(search_results[0], sentences=sentences, auto_suggest=False)
-            return summary, page.title, page.url
+        if shape is None:
+            shape = sql_shape(sql)
+            if len(self._shapes) < self.max_shapes:
+                self._shapes[sql] = shape
 
-        return None
+        return shape
 
+    def record(self, conn: sqlite3.Connection, sql: str, elapsed: float):
+        shape = self.shape(sql)
+        stats = self.stats.get(shape)
 
-wiki_service = WikipediaService()
+        if stats is None:
+            if len(self.stats) >= self.max_shapes:
+                return
+            stats = self.stats[shape] = QueryStats(sql)
+
+        stats.count += 1
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+
+        if elapsed >= self.slow_seconds:
+            stats.slow += 1
+            if stats.plan is None:
+                stats.plan = explain_query_plan(conn, sql)
+            plan = f"\n{stats.plan}" if stats.plan != "—" else ""
+            logger.warning(f"🐌 SQL {elapsed * 1000:.0f} мс: {shape[:300]}{plan}")
+
+    def reset(self):
+        self.stats.clear()
+
+    def report(self, top: int = 10, conn: Optional[sqlite3.Connection] = None) -> str:
+        """Топ форм по суммарному времени; с conn досняты планы, которых ещё нет."""
+        if not self.stats:
+            return "Запросов пока не было."
+
+        total = sum(stats.total for stats in self.stats.values())
+        count = sum(stats.count for stats in self.stats.values())
+        lines = [f"Форм: {len(self.stats)}, выполнений: {count}, всего {total * 1000:.0f} мс"]
+
+        ordered = sorted(self.stats.items(), key=lambda item: -item[1].total)
+        for shape, stats in ordered[:top]:
+            if stats.plan is None and conn is not None:
+                stats.plan = explain_query_plan(conn, stats.sql)
+
+            plan = stats.plan or ""
+            flag = " ⚠️ полный скан" if plan_has_full_scan(plan) else ""
+            lines.append(
+                f"\n{stats.total * 1000:.0f} мс, x{stats.count}, ср. {stats.total / stats.count * 1000:.2f} мс, "
+                f"макс {stats.max * 1000:.1f} мс, медленных {stats.slow}{flag}\n{shape[:200]}"
+            )
+            if plan:
+                lines.append(plan)
 
+        return "\n".join(lines)
 
-# ========== DEEPSEEK ==========
 
-def analyze_query_complexity(text: str) -> Dict[str, Any]:
-    text_lower = text.lower()
+def explain_query_plan(conn: sqlite3.Connection, sql: str) -> str:
+    statement = sql.strip()
 
-    complex_patterns = [
-        r"объясни.*почему",
-        r"сравни.*и",
-        r"проанализируй",
-        r"какой.*лучше",
-        r"посоветуй.*как",
-        r"реши.*задачу",
-        r"что.*думаешь.*о",
-        r"как.*относишься.*к",
-    ]
+    if not statement.upper().startswith(_SQL_EXPLAINABLE):
+        return "—"
 
-    reasoning_patterns = [
-        r"почему.*так",
-        r"в чём.*причина",
-        r"какова.*причина",
-        r"как.*это.*работает",
-        r"объясни.*принцип",
-        r"логика.*в.*том",
-        r"следует.*ли",
-        r"должен.*ли",
-    ]
+    try:
+        # Базовый Connection.execute — мимо таймера, чтобы EXPLAIN не попадал в статистику.
+        rows = sqlite3.Connection.execute(
+            conn, "EXPLAIN QUERY PLAN " + statement, (None,) * statement.count("?")
+        ).fetchall()
+    except sqlite3.Error as e:
+        return f"(план не снять: {e})"
 
-    technical_patterns = [
-        r"код",
-        r"программир",
-        r"алгоритм",
-        r"функци",
-        r"переменн",
-        r"база.*данных",
-        r"api",
-        r"сервер",
-        r"telegram.*бот",
-        r"python",
-    ]
+    depth: Dict[int, int] = {0: 0}
+    lines = []
 
-    simple_patterns = [
-        r"как.*дела",
-        r"что.*делаеш",
-        r"чем.*занимаеш",
-        r"как.*жизн",
-        r"что.*нового",
-        r"привет$",
-        r"хай$",
-        r"здравствуй$",
-        r"ку$",
-    ]
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, 0) + 1
+        lines.append("  " * depth[node_id] + detail)
 
-    is_complex = any(re.search(p, text_lower) for p in complex_patterns)
-    is_reasoning = any(re.search(p, text_lower) for p in reasoning_patterns)
-    is_technical = any(re.search(p, text_lower) for p in technical_patterns)
-    is_simple = any(re.search(p, text_lower) for p in simple_patterns) and not is_complex
+    return "\n".join(lines) or "—"
 
-    if is_simple:
-        return {
-            "model": DEEPSEEK_MODELS["chat"],
-            "temperature": 0.9,
-            "max_tokens": 120,
-            "require_reasoning": False,
-        }
 
-    if is_technical:
-        return {
-            "model": DEEPSEEK_MODELS["coder"],
-            "temperature": 0.45,
-            "max_tokens": 400,
-            "require_reasoning": False,
-        }
+def plan_has_full_scan(plan: str) -> bool:
+    """SCAN таблицы без индекса. SCAN по covering index и подзапросам не считается."""
+    return any(
+        line.strip().startswith("SCAN ") and "INDEX" not in line and "SUBQUERY" not in line
+        and "CONSTANT ROW" not in line
+        for line in plan.splitlines()
+    )
 
-    if is_reasoning:
-        return {
-            "model": DEEPSEEK_MODELS["r1"],
-            "temperature": 0.35,
-            "max_tokens": 350,
-            "require_reasoning": True,
-        }
 
-    if is_complex:
-        return {
-            "model": DEEPSEEK_MODELS["v3"],
-            "temperature": 0.7,
-            "max_tokens": 300,
-            "require_reasoning": False,
-        }
+query_log = QueryLog(SQL_SLOW_MS / 1000, SQL_MAX_SHAPES)
 
-    return {
-        "model": DEEPSEEK_MODELS["chat"],
-        "temperature": 0.8,
-        "max_tokens": 220,
-        "require_reasoning": False,
-    }
 
+class TimedCursor(sqlite3.Cursor):
+    """Время execute: для SELECT это подготовка и первая строка, где SQLite делает основную работу."""
 
-async def call_deepseek(
-    messages: List[Dict[str, str]],
-    model_config: Optional[Dict] = None,
-    **kwargs,
-) -> Optional[str]:
-    if not client:
-        return None
+    def execute(self, sql: str, parameters: Any = ()):
+        started = time_module.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_log.record(self.connection, sql, time_module.perf_counter() - started)
 
-    model = (model_config or {}).get("model", DEFAULT_MODEL)
-    temperature = (model_config or {}).get("temperature", 0.7)
-    max_tokens = (model_config or {}).get("max_tokens", 250)
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        started = time_module.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_log.record(self.connection, sql, time_module.perf_counter() - started)
 
-    try:
-        logger.info(f"🤖 DeepSeek: {model}, tokens={max_tokens}")
 
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            **kwargs,
-        )
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute в C создаёт курсор в обход cursor(), поэтому переопределяем оба.
+    def cursor(self, factory: Any = TimedCursor):
+        return super().cursor(factory)
 
-        answer = response.choices[0].message.content
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
 
-        if not answer:
-            return None
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
-        return answer.strip()
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка DeepSeek: {e}", exc_info=True)
-        return None
+# ========== SQLITE MEMORY ==========
 
+@timed_methods(DB_SECONDS, stage="sqlite")
+class MemoryStore:
+    def __init__(self, path: str, ingest_batch_size: int = 50, ingest_flush_interval: float = 5.0):
+        self.path = path
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_flush_interval = ingest_flush_interval
+        self._pending_messages: List[Tuple[int, int, str, str, str, str]] = []
+        self._pending_users: Dict[int, Dict[str, Any]] = {}
+        self._pending_since = 0.0
+        # Схема создаётся при первом обращении к базе, а не при импорте.
+        self._ready = False
+        self._init_lock = threading.Lock()
 
-# ========== USERS / MEMORY HELPERS ==========
+    def _connect(self):
+        if not self._ready:
+            # Потоки из to_thread не должны увидеть флаг раньше, чем появятся таблицы.
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
 
-async def get_or_create_user_info(update: Update) -> UserInfo:
-    user = update.effective_user
+        return self._open()
 
-    if not user:
-        raise ValueError("Пользователь не найден")
+    def _open(self):
+        return sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            timeout=30,
+            factory=TimedConnection,
+        )
 
-    if user.id in user_cache:
-        ui = user_cache[user.id]
-        ui.last_seen = datetime.now(pytz.UTC)
-        memory_store.upsert_user(ui)
-        return ui
+    def _init_db(self):
+        with self._open() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
 
-    ui = UserInfo(
-        id=user.id,
-        first_name=user.first_name or "",
-        last_name=user.last_name or "",
-        username=user.username or "",
-        last_seen=datetime.now(pytz.UTC),
-    )
+            cur = conn.cursor()
 
-    user_cache[user.id] = ui
-    memory_store.upsert_user(ui)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT,
+                    username TEXT,
+                    gender TEXT,
+                    first_seen TEXT,
+                    last_seen TEXT,
+                    message_count INTEGER DEFAULT 0,
+                    facts_json TEXT DEFAULT '[]',
+                    topics_json TEXT DEFAULT '[]'
+                )
+            """)
 
-    logger.info(f"👤 Пользователь: {ui.get_display_name()} (ID: {user.id})")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS chat_memory (
+                    chat_id INTEGER PRIMARY KEY,
+                    last_activity TEXT,
+                    message_count INTEGER DEFAULT 0,
+                    recent_messages_json TEXT DEFAULT '[]',
+                    summary TEXT DEFAULT '',
+                    inside_jokes_json TEXT DEFAULT '[]'
+                )
+            """)
 
-    return ui
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    user_id INTEGER,
+                    role TEXT,
+                    name TEXT,
+                    content TEXT,
+                    created_at TEXT
+                )
+            """)
 
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
 
-def get_memory_key(user_id: int, chat_id: int) -> str:
-    return f"{chat_id}:{user_id}"
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS weather_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    city_query TEXT NOT NULL,
+                    city_id INTEGER,
+                    payload_json TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    query_count INTEGER DEFAULT 0
+                )
+            """)
 
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS wiki_cache (
+                    title_key TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    extract_z BLOB NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )
+            """)
 
-def get_conversation_memory(user_id: int, chat_id: int) -> ConversationMemory:
-    key = get_memory_key(user_id, chat_id)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS wiki_aliases (
+                    query_key TEXT PRIMARY KEY,
+                    title_key TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
 
-    if key not in conversation_memories:
-        conversation_memories[key] = ConversationMemory(
-            user_id=user_id,
-            chat_id=chat_id,
-            messages=[],
-            last_activity=datetime.now(pytz.UTC),
-        )
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    name TEXT PRIMARY KEY,
+                    callback TEXT NOT NULL,
+                    due_at REAL NOT NULL,
+                    data_json TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
 
-    return conversation_memories[key]
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_outputs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    kind TEXT,
+                    content TEXT,
+                    signature BLOB,
+                    created_at TEXT
+                )
+            """)
+
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_bot_outputs_chat
+                ON bot_outputs (chat_id, id)
+            """)
+
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS chat_schedules (
+                    chat_id INTEGER PRIMARY KEY,
+                    morning INTEGER NOT NULL DEFAULT 1,
+                    evening INTEGER NOT NULL DEFAULT 1,
+                    spontaneous INTEGER NOT NULL DEFAULT 1,
+                    tennis INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+            conn.commit()
+
+    def upsert_user(self, user_info: "UserInfo"):
+        now = datetime.now(pytz.UTC).isoformat()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id FROM users WHERE user_id = ?",
+                (user_info.id,),
+            )
+            existing = cur.fetchone()
+
+            if existing:
+                cur.execute("""
+                    UPDATE users
+                    SET first_name = ?,
+                        last_name = ?,
+                        username = ?,
+                        gender = ?,
+                        last_seen = ?
+                    WHERE user_id = ?
+                """, (
+                    user_info.first_name,
+                    user_info.last_name,
+                    user_info.username,
+                    user_info.gender,
+                    now,
+                    user_info.id,
+                ))
+            else:
+                cur.execute("""
+                    INSERT INTO users (
+                        user_id, first_name, last_name, username, gender,
+                        first_seen, last_seen, message_count,
+                        facts_json, topics_json
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 0, '[]', '[]')
+                """, (
+                    user_info.id,
+                    user_info.first_name,
+                    user_info.last_name,
+                    user_info.username,
+                    user_info.gender,
+                    now,
+                    now,
+                ))
+
+            conn.commit()
+
+    @untimed
+    def queue_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        role: str,
+        name: str,
+        content: str,
+        topics: Tuple[str, ...] = (),
+        facts: Tuple[str, ...] = (),
+    ):
+        """
+        Откладывает запись сообщения (и счётчиков/тем/фактов пользователя) до ближайшего flush.
+        Пачка сбрасывается по размеру, по времени, периодической задачей и перед любым чтением.
+        """
+        now = datetime.now(pytz.UTC).isoformat()
+
+        if not self._pending_messages and not self._pending_users:
+            self._pending_since = time_module.monotonic()
+
+        self._pending_messages.append((chat_id, user_id, role, name, content, now))
+
+        if role == "user" and user_id:
+            pending = self._pending_users.setdefault(
+                user_id, {"count": 0, "last_seen": now, "topics": [], "facts": []}
+            )
+            pending["count"] += 1
+            pending["last_seen"] = now
+            pending["topics"].extend(topics)
+            pending["facts"].extend(facts)
+
+        if (
+            len(self._pending_messages) >= self.ingest_batch_size
+            or time_module.monotonic() - self._pending_since >= self.ingest_flush_interval
+        ):
+            self.flush_ingest()
+
+    # Пустой flush (перед каждым чтением, периодическая задача) — не обращение к базе.
+    @timed_if(lambda self: self._pending_messages or self._pending_users)
+    def flush_ingest(self) -> int:
+        if not self._pending_messages and not self._pending_users:
+            return 0
+
+        messages, self._pending_messages = self._pending_messages, []
+        users, self._pending_users = self._pending_users, {}
+
+        try:
+            self._write_ingest(messages, users)
+        except sqlite3.Error:
+            # Транзакция откатилась — возвращаем пачку, запишется следующим flush.
+            self._restore_pending(messages, users)
+            raise
+
+        return len(messages)
+
+    def _restore_pending(self, messages: List[Tuple[int, int, str, str, str, str]], users: Dict[int, Dict[str, Any]]):
+        self._pending_messages[:0] = messages
+
+        for user_id, pending in users.items():
+            newer = self._pending_users.get(user_id)
+            if newer is None:
+                self._pending_users[user_id] = pending
+                continue
+            newer["count"] += pending["count"]
+            newer["topics"][:0] = pending["topics"]
+            newer["facts"][:0] = pending["facts"]
+
+    def _write_ingest(self, messages: List[Tuple[int, int, str, str, str, str]], users: Dict[int, Dict[str, Any]]):
+        chats: Dict[int, List[Any]] = {}
+        for chat_id, _, _, _, _, created_at in messages:
+            entry = chats.setdefault(chat_id, [0, created_at])
+            entry[0] += 1
+            entry[1] = created_at
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+
+            cur.executemany("""
+                INSERT INTO messages (chat_id, user_id, role, name, content, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, messages)
+
+            for chat_id, (count, last_activity) in chats.items():
+                cur.execute("""
+                    UPDATE chat_memory
+                    SET last_activity = ?,
+                        message_count = message_count + ?
+                    WHERE chat_id = ?
+                """, (last_activity, count, chat_id))
+
+                if cur.rowcount == 0:
+                    cur.execute("""
+                        INSERT INTO chat_memory (
+                            chat_id, last_activity, message_count,
+                            recent_messages_json, summary, inside_jokes_json
+                        )
+                        VALUES (?, ?, ?, '[]', '', '[]')
+                    """, (chat_id, last_activity, count))
+
+            for user_id, pending in users.items():
+                cur.execute("""
+                    UPDATE users
+                    SET message_count = message_count + ?,
+                        last_seen = ?
+                    WHERE user_id = ?
+                """, (pending["count"], pending["last_seen"], user_id))
+
+                if not pending["topics"] and not pending["facts"]:
+                    continue
+
+                cur.execute("SELECT topics_json, facts_json FROM users WHERE user_id = ?", (user_id,))
+                row = cur.fetchone()
+
+                if not row:
+                    continue
+
+                topics = json.loads(row[0] or "[]")
+                facts = json.loads(row[1] or "[]")
+
+                for topic in pending["topics"]:
+                    if topic not in topics:
+                        topics.append(topic)
+
+                for fact in pending["facts"]:
+                    if fact not in facts:
+                        facts.append(fact)
+
+                cur.execute(
+                    "UPDATE users SET topics_json = ?, facts_json = ? WHERE user_id = ?",
+                    (
+                        json.dumps(topics[-20:], ensure_ascii=False),
+                        json.dumps(facts[-20:], ensure_ascii=False),
+                        user_id,
+                    ),
+                )
+
+            conn.commit()
+
+    def add_message(self, chat_id: int, user_id: int, role: str, name: str, content: str):
+        self.queue_message(chat_id, user_id, role, name, content)
+        self.flush_ingest()
+
+    def get_user_profile_text(self, user_id: int) -> str:
+        self.flush_ingest()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT first_name, last_name, username, gender, message_count, facts_json, topics_json
+                FROM users
+                WHERE user_id = ?
+            """, (user_id,))
+            row = cur.fetchone()
+
+        if not row:
+            return ""
+
+        first_name, last_name, username, gender, message_count, facts_json, topics_json = row
+        facts = json.loads(facts_json or "[]")
+        topics = json.loads(topics_json or "[]")
+
+        parts = [
+            f"Пользователь: {' '.join([x for x in [first_name, last_name] if x]).strip() or username or user_id}",
+            f"Сообщений: {message_count}",
+        ]
+
+        if topics:
+            parts.append(f"Темы, которые часто всплывали: {', '.join(topics[-8:])}")
+
+        if facts:
+            parts.append(f"Запомненные детали: {'; '.join(facts[-8:])}")
+
+        return "\n".join(parts)
+
+    def get_chat_context_text(self, chat_id: int, limit: int = 12) -> str:
+        self.flush_ingest()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+
+            cur.execute("""
+                SELECT message_count, summary, inside_jokes_json
+                FROM chat_memory
+                WHERE chat_id = ?
+            """, (chat_id,))
+            row = cur.fetchone()
+
+            cur.execute("""
+                SELECT role, name, content
+                FROM messages
+                WHERE chat_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (chat_id, limit))
+            recent_rows = cur.fetchall()
+
+        if not row and not recent_rows:
+            return ""
+
+        message_count = row[0] if row else 0
+        summary = row[1] if row else ""
+        jokes_json = row[2] if row else "[]"
+        jokes = json.loads(jokes_json or "[]")
+
+        last_lines = []
+        for role, name, content in reversed(recent_rows):
+            if role == "user":
+                last_lines.append(f"{name or 'Кто-то'}: {content}")
+            else:
+                last_lines.append(f"Лейла: {content}")
+
+        parts = [f"В этом чате накоплено сообщений: {message_count}"]
+
+        if summary:
+            parts.append(f"Краткая память чата: {summary}")
+
+        if jokes:
+            parts.append(f"Локальные мемы: {'; '.join(jokes[-8:])}")
+
+        if last_lines:
+            parts.append("Недавний контекст:\n" + "\n".join(last_lines))
+
+        return "\n\n".join(parts)
+
+    def add_inside_joke(self, chat_id: int, joke: str):
+        joke = joke.strip()
+        if not joke:
+            return
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT inside_jokes_json FROM chat_memory WHERE chat_id = ?", (chat_id,))
+            row = cur.fetchone()
+            jokes = json.loads(row[0]) if row and row[0] else []
+
+            if joke not in jokes:
+                jokes.append(joke)
+                jokes = jokes[-20:]
+
+            if row:
+                cur.execute(
+                    "UPDATE chat_memory SET inside_jokes_json = ? WHERE chat_id = ?",
+                    (json.dumps(jokes, ensure_ascii=False), chat_id),
+                )
+            else:
+                cur.execute("""
+                    INSERT INTO chat_memory (
+                        chat_id, last_activity, message_count, recent_messages_json,
+                        summary, inside_jokes_json
+                    )
+                    VALUES (?, ?, 0, '[]', '', ?)
+                """, (
+                    chat_id,
+                    datetime.now(pytz.UTC).isoformat(),
+                    json.dumps(jokes, ensure_ascii=False),
+                ))
+
+            conn.commit()
+
+    def get_setting(self, key: str, default: str = "") -> str:
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
+            row = cur.fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key: str, value: str):
+        now = datetime.now(pytz.UTC).isoformat()
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT INTO settings (key, value, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value,
+                    updated_at = excluded.updated_at
+            """, (key, value, now))
+            conn.commit()
+
+    def reset_chat_memory(self, chat_id: int):
+        self.flush_ingest()
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_memory WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            conn.commit()
+
+    def get_memory_stats(self, chat_id: int) -> str:
+        self.flush_ingest()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+
+            cur.execute("SELECT COUNT(*) FROM users")
+            users_count = cur.fetchone()[0]
+
+            cur.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
+            messages_count = cur.fetchone()[0]
+
+            cur.execute("SELECT inside_jokes_json FROM chat_memory WHERE chat_id = ?", (chat_id,))
+            row = cur.fetchone()
+            jokes = json.loads(row[0]) if row and row[0] else []
+
+        return (
+            f"👥 Пользователей в памяти: {users_count}\n"
+            f"💬 Сообщений этого чата в базе: {messages_count}\n"
+            f"🧠 Локальных мемов: {len(jokes)}"
+        )
+
+    def add_bot_output(self, chat_id: int, kind: str, content: str, signature: bytes, keep: int = 20000):
+        now = datetime.now(pytz.UTC).isoformat()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO bot_outputs (chat_id, kind, content, signature, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (chat_id, kind, content, signature, now))
+
+            # Обрезка общая по id, а окно дублей — на чат: keep должен покрывать
+            # DUPLICATE_WINDOW для всех чатов рассылки (120 × ~150 чатов).
+            last_id = cur.lastrowid
+            if last_id and last_id % 100 == 0:
+                cur.execute("DELETE FROM bot_outputs WHERE id <= ?", (last_id - keep,))
+
+            conn.commit()
+
+    def get_recent_bot_outputs(self, chat_id: int, limit: int) -> List[Tuple[str, bytes]]:
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT content, signature
+                FROM bot_outputs
+                WHERE chat_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (chat_id, limit))
+            rows = cur.fetchall()
+
+        return [(content, signature) for content, signature in reversed(rows)]
+
+    def get_recent_bot_texts(self, chat_id: int, kind: str, limit: int) -> List[str]:
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT content
+                FROM bot_outputs
+                WHERE chat_id = ? AND kind = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (chat_id, kind, limit))
+            rows = cur.fetchall()
+
+        return [content for content, in reversed(rows)]
+
+    def save_weather(
+        self,
+        cache_key: str,
+        city_query: str,
+        city_id: Optional[int],
+        payload: Dict[str, Any],
+        fetched_at: float,
+        query_count: int,
+    ):
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT INTO weather_cache (cache_key, city_query, city_id, payload_json, fetched_at, query_count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(cache_key) DO UPDATE SET
+                    city_query = excluded.city_query,
+                    city_id = COALESCE(excluded.city_id, weather_cache.city_id),
+                    payload_json = excluded.payload_json,
+                    fetched_at = excluded.fetched_at,
+                    query_count = MAX(excluded.query_count, weather_cache.query_count)
+            """, (
+                cache_key,
+                city_query,
+                city_id,
+                json.dumps(payload, ensure_ascii=False),
+                fetched_at,
+                query_count,
+            ))
+            conn.commit()
+
+    def load_weather_cache(self, max_age: float) -> List[Tuple[str, str, Optional[int], Dict[str, Any], float, int]]:
+        min_fetched_at = datetime.now(pytz.UTC).timestamp() - max_age
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT cache_key, city_query, city_id, payload_json, fetched_at, query_count
+                FROM weather_cache
+                WHERE fetched_at >= ? OR query_count > 0
+            """, (min_fetched_at,))
+            rows = cur.fetchall()
+
+        result = []
+        for cache_key, city_query, city_id, payload_json, fetched_at, query_count in rows:
+            try:
+                payload = json.loads(payload_json)
+            except Exception:
+                continue
+            result.append((cache_key, city_query, city_id, payload, fetched_at, query_count or 0))
+
+        return result
+
+    def get_wiki_page(self, query_key: str, max_age: float) -> Optional[Tuple[str, str, str, str]]:
+        now = datetime.now(pytz.UTC).timestamp()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT title_key FROM wiki_aliases WHERE query_key = ?", (query_key,))
+            alias = cur.fetchone()
+            title_key = alias[0] if alias else query_key
+
+            cur.execute("""
+                SELECT title, url, extract_z, fetched_at
+                FROM wiki_cache
+                WHERE title_key = ?
+            """, (title_key,))
+            row = cur.fetchone()
+
+            if not row:
+                return None
+
+            title, url, extract_z, fetched_at = row
+
+            if now - fetched_at > max_age:
+                cur.execute("DELETE FROM wiki_cache WHERE title_key = ?", (title_key,))
+                cur.execute("DELETE FROM wiki_aliases WHERE title_key = ?", (title_key,))
+                conn.commit()
+                return None
+
+            cur.execute(
+                "UPDATE wiki_cache SET last_used_at = ? WHERE title_key = ?",
+                (now, title_key),
+            )
+            conn.commit()
+
+        return title_key, title, url, zlib.decompress(extract_z).decode("utf-8")
+
+    def save_wiki_page(self, query_key: str, title_key: str, title: str, url: str, extract: str, max_rows: int):
+        now = datetime.now(pytz.UTC).timestamp()
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO wiki_cache (title_key, title, url, extract_z, fetched_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(title_key) DO UPDATE SET
+                    title = excluded.title,
+                    url = excluded.url,
+                    extract_z = excluded.extract_z,
+                    fetched_at = excluded.fetched_at,
+                    last_used_at = excluded.last_used_at
+            """, (title_key, title, url, zlib.compress(extract.encode("utf-8"), 6), now, now))
+
+            if query_key != title_key:
+                cur.execute("""
+                    INSERT INTO wiki_aliases (query_key, title_key, created_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(query_key) DO UPDATE SET
+                        title_key = excluded.title_key,
+                        created_at = excluded.created_at
+                """, (query_key, title_key, now))
+
+            cur.execute("SELECT COUNT(*) FROM wiki_cache")
+            if cur.fetchone()[0] > max_rows:
+                cur.execute("""
+                    DELETE FROM wiki_cache
+                    WHERE title_key IN (
+                        SELECT title_key FROM wiki_cache
+                        ORDER BY last_used_at ASC
+                        LIMIT ?
+                    )
+                """, (max(1, max_rows // 10),))
+                cur.execute("""
+                    DELETE FROM wiki_aliases
+                    WHERE title_key NOT IN (SELECT title_key FROM wiki_cache)
+                """)
+
+            conn.commit()
+
+    def save_job(self, name: str, callback: str, due_at: float, data: Optional[Dict[str, Any]] = None):
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT INTO scheduled_jobs (name, callback, due_at, data_json, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    callback = excluded.callback,
+                    due_at = excluded.due_at,
+                    data_json = excluded.data_json,
+                    created_at = excluded.created_at
+            """, (
+                name,
+                callback,
+                due_at,
+                json.dumps(data, ensure_ascii=False) if data is not None else None,
+                datetime.now(pytz.UTC).timestamp(),
+            ))
+            conn.commit()
+
+    def delete_job(self, name: str, due_at: Optional[float] = None):
+        with self._connect() as conn:
+            if due_at is None:
+                conn.execute("DELETE FROM scheduled_jobs WHERE name = ?", (name,))
+            else:
+                conn.execute(
+                    "DELETE FROM scheduled_jobs WHERE name = ? AND due_at = ?",
+                    (name, due_at),
+                )
+            conn.commit()
+
+    def list_jobs(self) -> List[Tuple[str, str, float, Optional[Dict[str, Any]]]]:
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT name, callback, due_at, data_json
+                FROM scheduled_jobs
+                ORDER BY due_at ASC
+            """)
+            rows = cur.fetchall()
+
+        result = []
+        for name, callback, due_at, data_json in rows:
+            try:
+                data = json.loads(data_json) if data_json else None
+            except Exception:
+                data = None
+            result.append((name, callback, due_at, data))
+
+        return result
+
+    def set_chat_schedule(self, chat_id: int, kinds: Dict[str, bool]):
+        kinds = {k: bool(v) for k, v in kinds.items() if k in BROADCAST_KINDS}
+        now = datetime.now(pytz.UTC).isoformat()
+
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT INTO chat_schedules (chat_id, created_at)
+                VALUES (?, ?)
+                ON CONFLICT(chat_id) DO NOTHING
+            """, (chat_id, now))
+
+            for kind, enabled in kinds.items():
+                conn.execute(
+                    f"UPDATE chat_schedules SET {kind} = ? WHERE chat_id = ?",
+                    (int(enabled), chat_id),
+                )
+
+            conn.commit()
+
+    def remove_chat_schedule(self, chat_id: int):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_schedules WHERE chat_id = ?", (chat_id,))
+            conn.commit()
+
+    def get_broadcast_chats(self, kind: str) -> List[int]:
+        if kind not in BROADCAST_KINDS:
+            return []
+
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT chat_id FROM chat_schedules WHERE {kind} = 1 ORDER BY chat_id")
+            return [row[0] for row in cur.fetchall()]
+
+    def list_chat_schedules(self) -> List[Tuple[int, Dict[str, bool]]]:
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT chat_id, {", ".join(BROADCAST_KINDS)}
+                FROM chat_schedules
+                ORDER BY chat_id
+            """)
+            rows = cur.fetchall()
+
+        return [
+            (row[0], {kind: bool(value) for kind, value in zip(BROADCAST_KINDS, row[1:])})
+            for row in rows
+        ]
+
+
+memory_store = MemoryStore(
+    DB_PATH,
+    ingest_batch_size=INGEST_BATCH_SIZE,
+    ingest_flush_interval=INGEST_FLUSH_INTERVAL,
+)
+
+
+def load_runtime_settings():
+    """Настройки, которые админ меняет командами; читаются из SQLite в post_init."""
+    global TENNIS_ACCESS_CODE, TENNIS_CODE_VALID_UNTIL
+
+    TENNIS_ACCESS_CODE = memory_store.get_setting("tennis_access_code", TENNIS_ACCESS_CODE)
+    TENNIS_CODE_VALID_UNTIL = memory_store.get_setting("tennis_code_valid_until", TENNIS_CODE_VALID_UNTIL)
+
+
+def seed_group_schedule(chat_id: int):
+    """
+    Домашняя группа попадает в рассылку один раз. Дальше ей управляет админ:
+    после /broadcast_remove рестарт не должен возвращать её обратно.
+    """
+    if memory_store.get_setting("group_schedule_seeded") == str(chat_id):
+        return
+
+    if not any(row_chat_id == chat_id for row_chat_id, _ in memory_store.list_chat_schedules()):
+        memory_store.set_chat_schedule(chat_id, {kind: True for kind in BROADCAST_KINDS})
+
+    memory_store.set_setting("group_schedule_seeded", str(chat_id))
+
+
+# ========== DATACLASSES ==========
+
+@dataclass(slots=True)
+class UserInfo:
+    id: int
+    first_name: str
+    last_name: str = ""
+    username: str = ""
+    last_seen: Optional[datetime] = None
+    conversation_topics: Optional[List[str]] = None
+    gender: str = "unknown"
+
+    def __post_init__(self):
+        if self.last_seen is None:
+            self.last_seen = datetime.now(pytz.UTC)
+        if self.conversation_topics is None:
+            self.conversation_topics = []
+        self._determine_gender()
+
+    def _determine_gender(self):
+        if self.gender != "unknown":
+            return
+
+        name_lower = (self.first_name or "").lower()
+
+        female_endings = ["а", "я", "ия", "ина", "ла", "та"]
+        male_endings = ["й", "ь", "н", "р", "л", "с", "в", "д", "м"]
+
+        for ending in female_endings:
+            if name_lower.endswith(ending):
+                self.gender = "female"
+                return
+
+        for ending in male_endings:
+            if name_lower.endswith(ending) and len(name_lower) > 2:
+                self.gender = "male"
+                return
+
+    @property
+    def full_name(self) -> str:
+        parts = []
+        if self.first_name:
+            parts.append(self.first_name)
+        if self.last_name:
+            parts.append(self.last_name)
+        return " ".join(parts) if parts else ""
+
+    def get_display_name(self) -> str:
+        if self.first_name:
+            return self.first_name
+        if self.username:
+            return f"@{self.username}"
+        if self.full_name:
+            return self.full_name
+        return "Пользователь"
+
+    def is_maxim(self) -> bool:
+        return self.id == MAXIM_ID
+
+
+# ========== CACHES ==========
+
+def approx_size(obj: Any, depth: int = 4) -> int:
+    """
+    Грубая оценка памяти объекта в байтах: sys.getsizeof плюс содержимое
+    контейнеров, __slots__ и __dict__ на несколько уровней вглубь.
+    Для бюджета кешей этого достаточно, точность тут не нужна.
+    """
+    size = sys.getsizeof(obj)
+
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float, bool, type(None), datetime)):
+        return size
+
+    if isinstance(obj, dict):
+        return size + sum(approx_size(k, depth - 1) + approx_size(v, depth - 1) for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(approx_size(item, depth - 1) for item in obj)
+
+    slots = getattr(type(obj), "__slots__", ())
+    if slots:
+        return size + sum(approx_size(getattr(obj, name, None), depth - 1) for name in slots)
+
+    if hasattr(obj, "__dict__"):
+        return size + approx_size(vars(obj), depth - 1)
+
+    return size
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру LRU-кеш с TTL.
+    Протухшие записи ещё stale_ttl секунд отдаются как "stale" (stale-while-revalidate).
+    Если задан max_bytes, старые записи вытесняются и по примерному объёму
+    (оценка approx_size при каждом set).
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        stale_ttl: float = 0.0,
+        max_bytes: int = 0,
+        sizeof: Callable[[Any], int] = approx_size,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Tuple[Any, float, float, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key)[1] is not None
+
+    def keys(self) -> List[Any]:
+        """Ключи в любом состоянии, без учёта в hits/misses и без обновления LRU."""
+        return list(self._data)
+
+    def _remove(self, key: Any):
+        item = self._data.pop(key)
+        self.bytes -= item[3]
+        return item
+
+    def get(self, key: Any) -> Tuple[Any, Optional[str]]:
+        item = self._data.get(key)
+
+        if item is None:
+            self.misses += 1
+            return None, None
+
+        value, stored_at, ttl, _ = item
+        age = time_module.monotonic() - stored_at
+
+        if age < ttl:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value, "fresh"
+
+        if age < ttl + self.stale_ttl:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value, "stale"
+
+        self.misses += 1
+        self._remove(key)
+        return None, None
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None, age: float = 0.0):
+        """Кладёт значение; для уже лежащего изменённого объекта — заново оценивает его размер."""
+        if key in self._data:
+            self._remove(key)
+
+        size = self.sizeof(key) + self.sizeof(value)
+        stored_at = time_module.monotonic() - age
+        self._data[key] = (value, stored_at, self.ttl if ttl is None else ttl, size)
+        self.bytes += size
+
+        while len(self._data) > self.maxsize or (
+            self.max_bytes and self.bytes > self.max_bytes and len(self._data) > 1
+        ):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        return self._remove(key)[0]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def purge_expired(self) -> int:
+        now = time_module.monotonic()
+        expired = [
+            key for key, (_, stored_at, ttl, _) in self._data.items()
+            if now - stored_at >= ttl + self.stale_ttl
+        ]
+
+        for key in expired:
+            self._remove(key)
+
+        return len(expired)
+
+
+# ========== GLOBALS ==========
+
+user_cache = TTLCache(
+    maxsize=USER_CACHE_SIZE,
+    ttl=USER_CACHE_TTL,
+    max_bytes=USER_CACHE_MAX_BYTES,
+)
+
+_deepseek_client = None
+_deepseek_client_lock = threading.Lock()
+
+if not DEEPSEEK_API_KEY:
+    logger.warning("❌ DEEPSEEK_API_KEY не задан")
+
+
+def get_deepseek_client():
+    """OpenAI-клиент для DeepSeek; openai импортируется при первом вызове (сотни мс)."""
+    global _deepseek_client
+
+    if _deepseek_client is not None or not DEEPSEEK_API_KEY:
+        return _deepseek_client
+
+    with _deepseek_client_lock:
+        if _deepseek_client is None:
+            with timed_startup("import openai (лениво)"):
+                from openai import OpenAI
+
+                _deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
+
+            logger.info("✅ DeepSeek клиент инициализирован")
+
+    return _deepseek_client
+
+
+# ========== TIME / LOCATION ==========
+
+_BOT_TZ = pytz.timezone(BOT_TZ)
+
+SEASON_DESCRIPTIONS = {
+    "лето": {"emoji": "🌞🏖️", "description": "жаркое австралийское лето"},
+    "осень": {"emoji": "🍂🌧️", "description": "тёплая осень"},
+    "зима": {"emoji": "⛄☕", "description": "мягкая зима"},
+    "весна": {"emoji": "🌸🌼", "description": "цветущая весна"},
+}
+
+# (час начала, название, описание); всё до 5 утра — ночь.
+TIME_OF_DAY_BANDS = [
+    (0, "ночь", "🌌 Ночь, время тишины"),
+    (5, "раннее утро", "🌅 Начинается новый день"),
+    (9, "утро", "☀️ Утро в разгаре"),
+    (12, "полдень", "🌞 Полдень, время обеда"),
+    (14, "день", "😊 День продолжается"),
+    (17, "вечер", "🌇 Вечер, время отдыха"),
+    (20, "поздний вечер", "🌃 Поздний вечер"),
+    (23, "ночь", "🌌 Ночь, время тишины"),
+]
+_TIME_OF_DAY_HOURS = [band[0] for band in TIME_OF_DAY_BANDS]
+
+# Месяцы, с которых начинается новый сезон (одинаково для обоих полушарий).
+SEASON_START_MONTHS = (3, 6, 9, 12)
+
+
+def get_tz() -> pytz.timezone:
+    return _BOT_TZ
+
+
+def get_season_for_location(month: int, hemisphere: str = "southern") -> str:
+    if hemisphere == "southern":
+        if month in [12, 1, 2]:
+            return "лето"
+        if month in [3, 4, 5]:
+            return "осень"
+        if month in [6, 7, 8]:
+            return "зима"
+        return "весна"
+
+    if month in [12, 1, 2]:
+        return "зима"
+    if month in [3, 4, 5]:
+        return "весна"
+    if month in [6, 7, 8]:
+        return "лето"
+    return "осень"
+
+
+def get_current_season() -> Tuple[str, Dict[str, Any]]:
+    snapshot = get_context_snapshot()
+    return snapshot.season, snapshot.season_info
+
+
+def get_time_of_day(dt: datetime) -> Tuple[str, str]:
+    band = TIME_OF_DAY_BANDS[bisect.bisect_right(_TIME_OF_DAY_HOURS, dt.hour) - 1]
+    return band[1], band[2]
+
+
+def get_australian_context() -> str:
+    return get_context_snapshot().australian_context
+
+
+# ========== MOON ==========
+
+SYNODIC_MONTH = 29.530588853
+REFERENCE_NEW_MOON = datetime(2000, 1, 6, 18, 14, tzinfo=pytz.UTC)
+
+# (возраст Луны в сутках, с которого начинается фаза; фаза; подробно; эмодзи)
+MOON_PHASES = [
+    (0.0, "новолуние", "новолуние", "🌑"),
+    (1.0, "растущая", "растущий серп", "🌒"),
+    (6.382, "растущая", "первая четверть", "🌓"),
+    (8.382, "растущая", "растущая луна", "🌔"),
+    (13.765, "полнолуние", "полнолуние", "🌕"),
+    (15.765, "убывающая", "убывающая луна", "🌖"),
+    (21.148, "убывающая", "последняя четверть", "🌗"),
+    (23.148, "убывающая", "убывающий серп", "🌘"),
+    (SYNODIC_MONTH - 1.0, "новолуние", "новолуние", "🌑"),
+]
+_MOON_PHASE_AGES = [entry[0] for entry in MOON_PHASES]
+
+
+def _moon_age_days(dt_utc: datetime) -> float:
+    delta_days = (dt_utc - REFERENCE_NEW_MOON).total_seconds() / 86400.0
+    return delta_days % SYNODIC_MONTH
+
+
+def _moon_phase_for_age(age: float) -> Tuple[str, str, str]:
+    entry = MOON_PHASES[bisect.bisect_right(_MOON_PHASE_AGES, age) - 1]
+    return entry[1], entry[2], entry[3]
+
+
+def moon_phase_transitions(start_utc: datetime, days: int = 366) -> List[Tuple[datetime, str]]:
+    """Моменты смены фазы (по phase_detail) в интервале [start_utc, start_utc + days]."""
+    end_utc = start_utc + timedelta(days=days)
+    cycle = math.floor((start_utc - REFERENCE_NEW_MOON).total_seconds() / 86400.0 / SYNODIC_MONTH)
+    transitions = []
+    previous = None
+
+    while True:
+        cycle_start = REFERENCE_NEW_MOON + timedelta(days=cycle * SYNODIC_MONTH)
+
+        if cycle_start > end_utc:
+            break
+
+        for age, _, detail, _ in MOON_PHASES:
+            moment = cycle_start + timedelta(days=age)
+
+            if detail != previous and start_utc < moment <= end_utc:
+                transitions.append((moment, detail))
+
+            previous = detail
+
+        cycle += 1
+
+    return transitions
+
+
+def get_moon_phase(dt_local: Optional[datetime] = None) -> Dict[str, Any]:
+    """Фаза Луны на момент dt_local; без аргумента — из текущего снимка контекста."""
+    if dt_local is None:
+        return dict(get_context_snapshot().moon)
+
+    dt_utc = dt_local.astimezone(pytz.UTC)
+    age = _moon_age_days(dt_utc)
+
+    illumination = (1 - math.cos(2 * math.pi * (age / SYNODIC_MONTH))) / 2
+    illumination_pct = int(round(illumination * 100))
+
+    phase, detail, emoji = _moon_phase_for_age(age)
+
+    return {
+        "age_days": round(age, 1),
+        "phase": phase,
+        "phase_detail": detail,
+        "emoji": emoji,
+        "illumination_pct": illumination_pct,
+        "local_time": dt_local.strftime("%Y-%m-%d %H:%M"),
+    }
+
+
+def format_moon_phrase(moon: Dict[str, Any]) -> str:
+    return (
+        f"{moon['emoji']} Луна: {moon['phase']} "
+        f"({moon['phase_detail']}), ~{moon['illumination_pct']}% света"
+    )
+
+
+def get_moon_comment(moon: Dict[str, Any]) -> str:
+    phase = moon["phase"]
+    comments = MOON_MOOD_COMMENTS.get(
+        phase,
+        ["Луна сегодня молчит, но явно что-то знает."],
+    )
+    return random.choice(comments)
+
+
+# ========== CONTEXT SNAPSHOT ==========
+
+@dataclass(frozen=True)
+class ContextSnapshot:
+    """
+    Всё, что в промптах зависит от даты и времени: сезон, время суток, Луна.
+    Собирается один раз и действует до ближайшей границы (смена полосы времени
+    суток, сезона или фазы Луны), после чего задача подменяет его целиком.
+    """
+    built_at: datetime
+    valid_until: datetime
+    valid_until_ts: float
+    season: str
+    season_info: Dict[str, Any]
+    time_of_day: str
+    time_desc: str
+    moon: Dict[str, Any]
+    moon_phrase: str
+    australian_context: str
+
+
+class ContextCalendar:
+    """Заранее посчитанные границы на год вперёд: фазы Луны, сезоны, полосы времени суток."""
+
+    def __init__(self, start_utc: datetime, days: int = 366):
+        self.start_utc = start_utc
+        self.end_utc = start_utc + timedelta(days=days)
+        self.moon_transitions = [moment for moment, _ in moon_phase_transitions(start_utc, days)]
+        self.season_boundaries = self._season_boundaries(start_utc, days)
+
+    @staticmethod
+    def _season_boundaries(start_utc: datetime, days: int) -> List[datetime]:
+        tz = get_tz()
+        first_year = start_utc.astimezone(tz).year
+        boundaries = []
+
+        for year in range(first_year, first_year + days // 365 + 2):
+            for month in SEASON_START_MONTHS:
+                boundaries.append(tz.localize(datetime(year, month, 1)).astimezone(pytz.UTC))
+
+        return boundaries
+
+    def covers(self, now_utc: datetime) -> bool:
+        return self.start_utc <= now_utc < self.end_utc - timedelta(days=31)
+
+    @staticmethod
+    def _next_after(points: List[datetime], now_utc: datetime) -> Optional[datetime]:
+        i = bisect.bisect_right(points, now_utc)
+        return points[i] if i < len(points) else None
+
+    def next_time_of_day_boundary(self, now_utc: datetime) -> datetime:
+        tz = get_tz()
+        local = now_utc.astimezone(tz)
+
+        for day_offset in (0, 1):
+            day = (local + timedelta(days=day_offset)).date()
+            for hour in _TIME_OF_DAY_HOURS:
+                moment = tz.localize(datetime(day.year, day.month, day.day, hour)).astimezone(pytz.UTC)
+                if moment > now_utc:
+                    return moment
+
+        return now_utc + timedelta(hours=1)
+
+    def next_boundary(self, now_utc: datetime) -> datetime:
+        candidates = [
+            self.next_time_of_day_boundary(now_utc),
+            self._next_after(self.moon_transitions, now_utc),
+            self._next_after(self.season_boundaries, now_utc),
+        ]
+        return min(c for c in candidates if c is not None)
+
+
+_context_calendar: Optional[ContextCalendar] = None
+_context_snapshot: Optional[ContextSnapshot] = None
+
+
+def build_context_snapshot(now_utc: Optional[datetime] = None) -> ContextSnapshot:
+    global _context_calendar
+
+    now_utc = now_utc or datetime.now(pytz.UTC)
+
+    if _context_calendar is None or not _context_calendar.covers(now_utc):
+        _context_calendar = ContextCalendar(now_utc)
+
+    now_local = now_utc.astimezone(get_tz())
+    season = get_season_for_location(now_local.month, BOT_LOCATION["hemisphere"])
+    season_info = SEASON_DESCRIPTIONS.get(season, {})
+    time_of_day, time_desc = get_time_of_day(now_local)
+    moon = get_moon_phase(now_local)
+    valid_until = _context_calendar.next_boundary(now_utc)
+
+    australian_context = f"""
+📍 География:
+- Лейла живёт в {BOT_LOCATION['city']}, {BOT_LOCATION['country']}
+- Южное полушарие
+- Часовой пояс: {BOT_TZ}
+
+🕒 Сезон и время:
+- Сейчас {season} ({season_info.get('description', '')})
+- {time_desc} ({time_of_day})
+""".strip()
+
+    return ContextSnapshot(
+        built_at=now_utc,
+        valid_until=valid_until,
+        valid_until_ts=valid_until.timestamp(),
+        season=season,
+        season_info=season_info,
+        time_of_day=time_of_day,
+        time_desc=time_desc,
+        moon=moon,
+        moon_phrase=format_moon_phrase(moon),
+        australian_context=australian_context,
+    )
+
+
+def get_context_snapshot() -> ContextSnapshot:
+    """Текущий снимок; если задача подмены опоздала, пересобирается на месте."""
+    global _context_snapshot
+
+    snapshot = _context_snapshot
+
+    if snapshot is None or time_module.time() >= snapshot.valid_until_ts:
+        snapshot = build_context_snapshot()
+        _context_snapshot = snapshot
+
+    return snapshot
+
+
+async def refresh_context_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    global _context_snapshot
+
+    try:
+        _context_snapshot = build_context_snapshot()
+        logger.info(
+            f"🗓️ Снимок контекста: {_context_snapshot.season}, {_context_snapshot.time_of_day}, "
+            f"{_context_snapshot.moon['phase_detail']}; до {_context_snapshot.valid_until.astimezone(get_tz()):%d.%m %H:%M}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка пересборки снимка контекста: {e}", exc_info=True)
+
+    finally:
+        schedule_context_refresh(context.job_queue)
+
+
+def schedule_context_refresh(job_queue):
+    snapshot = get_context_snapshot()
+
+    for job in job_queue.get_jobs_by_name("context-snapshot"):
+        job.schedule_removal()
+
+    # Секунда запаса, чтобы оказаться уже по ту сторону границы.
+    job_queue.run_once(
+        refresh_context_snapshot,
+        when=snapshot.valid_until + timedelta(seconds=1),
+        name="context-snapshot",
+    )
+
+
+# ========== HTTP ==========
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий пул соединений для всех внешних HTTP-запросов (погода, Википедия)."""
+    global _http_client
+
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            headers={"User-Agent": "LeilaBot/1.0"},
+        )
+
+    return _http_client
+
+
+async def http_get(service: str, url: str, **kwargs) -> httpx.Response:
+    """GET через общий клиент с учётом в метриках (service — weather, wiki, ...)."""
+    started = time_module.perf_counter()
+    status = "error"
+
+    try:
+        response = await get_http_client().get(url, **kwargs)
+        status = str(response.status_code)
+        return response
+
+    finally:
+        HTTP_FETCH_SECONDS.labels(service).observe(time_module.perf_counter() - started)
+        HTTP_FETCHES.labels(service, status).inc()
+
+
+async def close_http_client():
+    global _http_client
+
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+
+    _http_client = None
+
+
+# ========== OUTBOUND QUEUE ==========
+
+PRIORITY_REPLY = 0
+PRIORITY_FOLLOWUP = 1
+PRIORITY_BROADCAST = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time_module.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(eq=False)
+class OutboundMessage:
+    priority: int
+    seq: int
+    bot: Any
+    chat_id: int
+    kwargs: Dict[str, Any]
+    future: "asyncio.Future"
+    enqueued_at: float
+    attempts: int = 0
+    not_before: float = 0.0
+    trace: Optional[UpdateTrace] = None
+    method: str = "send_message"
+
+    def __lt__(self, other: "OutboundMessage") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    """
+    Единая очередь исходящих сообщений.
+    Токен-бакеты на каждый чат и на весь бот, RetryAfter от Telegram
+    ставит чат на паузу и возвращает сообщение в очередь, прямые ответы
+    обгоняют рассылки. Внутри одного чата порядок сохраняется.
+
+    У каждого чата своя куча сообщений. Головы чатов, которые можно слать
+    прямо сейчас, лежат в _ready, чаты на паузе или без токенов — в _sleeping
+    до момента, когда освободятся, так что выбор следующего сообщения не
+    перебирает всю очередь.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 25.0,
+        global_burst: int = 30,
+        private_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        chat_burst: int = 3,
+        max_queue: int = 1000,
+        max_retries: int = 3,
+        max_wait: float = 900.0,
+        workers: int = 8,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.workers = workers
+
+        self._queues: Dict[int, List[OutboundMessage]] = {}
+        self._size = 0
+        self._ready: List[Tuple[int, int, int]] = []
+        self._sleeping: List[Tuple[float, int]] = []
+        self._sleeping_chats: set = set()
+        self._next_expire = 0.0
+        self._seq = 0
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until: Dict[int, float] = {}
+        self._in_flight: set = set()
+        self._tasks: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional["asyncio.Task"] = None
+
+        self.stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "retry_after": 0,
+            "dropped": 0,
+            "failed": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+
+        if bucket is None:
+            # У групп и каналов id отрицательный, у них лимит строже.
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = TokenBucket(rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+
+        return bucket
+
+    def _ensure_started(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            # Чистый контекст: иначе диспетчер навсегда унаследует трассу
+            # апдейта, в котором его запустили. Трасса едет в OutboundMessage.trace.
+            self._dispatcher = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _drop(self, item: OutboundMessage, reason: str):
+        self.stats["dropped"] += 1
+        TELEGRAM_SENDS.labels("dropped").inc()
+        logger.warning(f"📤 Сообщение в {item.chat_id} выброшено: {reason}")
+
+        if not item.future.done():
+            item.future.set_result(None)
+
+    async def send(self, bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs):
+        """
+        Ставит сообщение в очередь и ждёт отправки.
+        Возвращает Message или None, если сообщение выброшено (переполнение, таймаут, лимит повторов).
+        Ошибки вроде Forbidden/BadRequest пробрасываются вызывающему.
+        """
+        return await self.enqueue(bot, chat_id, text, priority=priority, **kwargs)
+
+    async def send_document(self, bot, chat_id: int, document: Any, priority: int = PRIORITY_REPLY, **kwargs):
+        """Как send, но для файла: те же бакеты, RetryAfter и повторы."""
+        return await self._push(bot, chat_id, "send_document", {"document": document, **kwargs}, priority)
+
+    def post(self, bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> "asyncio.Future":
+        """
+        Ставит сообщение в очередь и не ждёт отправки: обработчик апдейта
+        не должен стоять, пока бакет чата копит токены. Ошибки — в лог.
+        """
+        future = self.enqueue(bot, chat_id, text, priority=priority, **kwargs)
+        future.add_done_callback(functools.partial(self._log_failure, chat_id))
+        return future
+
+    @staticmethod
+    def _log_failure(chat_id: int, future: "asyncio.Future"):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"📤 Не удалось отправить сообщение в {chat_id}: {future.exception()}")
+
+    def enqueue(self, bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> "asyncio.Future":
+        return self._push(bot, chat_id, "send_message", {"text": text, **kwargs}, priority)
+
+    def _push(self, bot, chat_id: int, method: str, kwargs: Dict[str, Any], priority: int) -> "asyncio.Future":
+        self._ensure_started()
+
+        now = time_module.monotonic()
+        item = OutboundMessage(
+            priority=priority,
+            seq=self._seq,
+            bot=bot,
+            chat_id=chat_id,
+            kwargs=kwargs,
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=now,
+            trace=_current_trace.get(),
+            method=method,
+        )
+        self._seq += 1
+        self.stats["enqueued"] += 1
+
+        if self._size >= self.max_queue:
+            # Переполнение: выкидываем самое неважное и самое свежее. Редкий случай — полный перебор.
+            worst = max(max(queue) for queue in self._queues.values())
+            if worst < item:
+                self._drop(item, "очередь переполнена")
+                return item.future
+
+            self._remove([worst])
+            self._drop(worst, "очередь переполнена")
+
+        self._add(item)
+        if self._queues[chat_id][0] is item:
+            # Новая голова (например, ответ перед отложенным повтором рассылки) не ждёт старую паузу.
+            self._sleeping_chats.discard(chat_id)
+        self._schedule(chat_id)
+        self._wake()
+
+        return item.future
+
+    def _add(self, item: OutboundMessage):
+        heapq.heappush(self._queues.setdefault(item.chat_id, []), item)
+        self._size += 1
+
+    def _remove(self, items: List[OutboundMessage]):
+        chats = set()
+
+        for item in items:
+            self._queues[item.chat_id].remove(item)
+            self._size -= 1
+            chats.add(item.chat_id)
+
+        for chat_id in chats:
+            queue = self._queues[chat_id]
+            if queue:
+                heapq.heapify(queue)
+                # Голова могла смениться — старая запись в _ready отбросится при выборе.
+                self._schedule(chat_id)
+            else:
+                del self._queues[chat_id]
+
+    def _schedule(self, chat_id: int):
+        """Кладёт голову чата в _ready, если чат не занят отправкой и не спит."""
+        queue = self._queues.get(chat_id)
+
+        if queue and chat_id not in self._in_flight and chat_id not in self._sleeping_chats:
+            head = queue[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _pick(self, now: float) -> Tuple[Optional[OutboundMessage], float]:
+        """Первое по приоритету сообщение, которое можно отправить сейчас, и сколько ждать иначе."""
+        while self._sleeping and self._sleeping[0][0] <= now:
+            _, chat_id = heapq.heappop(self._sleeping)
+            self._sleeping_chats.discard(chat_id)
+            self._schedule(chat_id)
+
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            queue = self._queues.get(chat_id)
+
+            # Устаревшая запись: голова сменилась, чат уже отправляет или спит.
+            if (
+                not queue
+                or (queue[0].priority, queue[0].seq) != (priority, seq)
+                or chat_id in self._in_flight
+                or chat_id in self._sleeping_chats
+            ):
+                continue
+
+            # Всё, что позже в очереди этого же чата, ждёт его головы.
+            item = queue[0]
+            delay = max(
+                item.not_before - now,
+                self._paused_until.get(chat_id, 0.0) - now,
+                self._bucket(chat_id).wait_time(now),
+            )
+
+            if delay <= 0:
+                return item, 0.0
+
+            heapq.heappush(self._sleeping, (now + delay, chat_id))
+            self._sleeping_chats.add(chat_id)
+
+        wait = 1.0
+        if self._sleeping:
+            wait = min(wait, self._sleeping[0][0] - now)
+
+        return None, wait
+
+    def _expire(self, now: float):
+        # Полный проход по очереди — не чаще раза в секунду, а не на каждую отправку.
+        if now < self._next_expire:
+            return
+
+        self._next_expire = now + 1.0
+        expired = [
+            item
+            for queue in self._queues.values()
+            for item in queue
+            if now - item.enqueued_at > self.max_wait
+        ]
+
+        if not expired:
+            return
+
+        self._remove(expired)
+
+        for item in expired:
+            self._drop(item, "слишком долго ждало в очереди")
+
+    def _gc_buckets(self, now: float):
+        if len(self._chat_buckets) < 1000:
+            return
+
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.is_idle(now)]:
+            if chat_id not in self._in_flight:
+                del self._chat_buckets[chat_id]
+
+        for chat_id in [c for c, until in self._paused_until.items() if until <= now]:
+            del self._paused_until[chat_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await self._dispatch()
+            except Exception as e:
+                # Упавший диспетчер остановил бы всю отправку, а send() ждал бы вечно.
+                logger.error(f"📤 Сбой диспетчера очереди отправки: {e}", exc_info=True)
+                await asyncio.sleep(1.0)
+
+    async def _dispatch(self):
+        """Один шаг диспетчера: отправить следующее сообщение или подождать."""
+        self._wakeup.clear()
+        now = time_module.monotonic()
+        self._expire(now)
+        self._gc_buckets(now)
+
+        item, wait = None, 1.0
+
+        if self._size and len(self._in_flight) < self.workers:
+            global_wait = self.global_bucket.wait_time(now)
+
+            if global_wait > 0:
+                wait = global_wait
+            else:
+                item, wait = self._pick(now)
+
+        if item is None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        queue = self._queues[item.chat_id]
+        heapq.heappop(queue)
+        if not queue:
+            del self._queues[item.chat_id]
+        self._size -= 1
+
+        self.global_bucket.consume(now)
+        self._bucket(item.chat_id).consume(now)
+        self._in_flight.add(item.chat_id)
+
+        task = asyncio.create_task(self._deliver(item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, item: OutboundMessage):
+        item.attempts += 1
+        started = time_module.perf_counter()
+        result = "error"
+
+        try:
+            message = await getattr(item.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+
+        except RetryAfter as e:
+            result = "retry_after"
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+
+            self.stats["retry_after"] += 1
+            self._paused_until[item.chat_id] = time_module.monotonic() + float(retry_after)
+            logger.warning(f"📤 RetryAfter {retry_after} с для чата {item.chat_id}")
+            self._retry(item, 0.0)
+
+        except (TimedOut, NetworkError) as e:
+            result = "network_error"
+            logger.warning(f"📤 Сетевая ошибка при отправке в {item.chat_id}: {e}")
+            self._retry(item, min(30.0, 2.0 ** item.attempts))
+
+        except Exception as e:
+            self.stats["failed"] += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+
+        else:
+            result = "ok"
+            waited = time_module.monotonic() - item.enqueued_at
+            OUTBOUND_WAIT_SECONDS.observe(waited)
+            self.stats["sent"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+
+            if not item.future.done():
+                item.future.set_result(message)
+
+        finally:
+            elapsed = time_module.perf_counter() - started
+            TELEGRAM_SEND_SECONDS.observe(elapsed)
+            TELEGRAM_SENDS.labels(result).inc()
+            perf_stats.observe("telegram", elapsed)
+            if item.trace is not None:
+                item.trace.record("telegram", elapsed)
+            self._in_flight.discard(item.chat_id)
+            self._schedule(item.chat_id)
+            self._wake()
+
+    def _retry(self, item: OutboundMessage, backoff: float):
+        if item.attempts > self.max_retries:
+            self._drop(item, f"исчерпаны повторы ({item.attempts})")
+            return
+
+        self.stats["retried"] += 1
+        item.not_before = time_module.monotonic() + backoff
+        self._add(item)
+
+    async def close(self, timeout: float = 10.0):
+        """Даём очереди дослать накопленное, остальное выбрасываем."""
+        deadline = time_module.monotonic() + timeout
+
+        while (self._size or self._tasks) and time_module.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+        for queue in self._queues.values():
+            for item in queue:
+                self._drop(item, "бот останавливается")
+
+        self._queues.clear()
+        self._size = 0
+        self._ready.clear()
+        self._sleeping.clear()
+        self._sleeping_chats.clear()
+
+    def get_stats_text(self) -> str:
+        sent = self.stats["sent"]
+        avg_wait = self.stats["wait_total"] / sent if sent else 0.0
+
+        return (
+            f"📤 Очередь отправки: в очереди {self._size}, "
+            f"отправлено {sent}, повторов {self.stats['retried']} "
+            f"(RetryAfter {self.stats['retry_after']}), "
+            f"выброшено {self.stats['dropped']}, ошибок {self.stats['failed']}, "
+            f"ожидание ср. {avg_wait:.2f} с / макс. {self.stats['wait_max']:.2f} с"
+        )
+
+
+outbound_queue = OutboundQueue(
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    global_burst=OUTBOUND_GLOBAL_BURST,
+    private_rate=OUTBOUND_PRIVATE_RATE,
+    group_rate=OUTBOUND_GROUP_RATE,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    max_queue=OUTBOUND_MAX_QUEUE,
+    max_retries=OUTBOUND_MAX_RETRIES,
+    max_wait=OUTBOUND_MAX_WAIT,
+    workers=OUTBOUND_WORKERS,
+)
+
+
+async def send_text(bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs):
+    return await outbound_queue.send(bot, chat_id, text, priority=priority, **kwargs)
+
+
+def post_text(bot, chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs) -> "asyncio.Future":
+    return outbound_queue.post(bot, chat_id, text, priority=priority, **kwargs)
+
+
+async def send_document(bot, chat_id: int, document: Any, priority: int = PRIORITY_REPLY, **kwargs):
+    return await outbound_queue.send_document(bot, chat_id, document, priority=priority, **kwargs)
+
+
+# ========== WEATHER ==========
+
+CITY_INDEX_PATH = os.getenv(
+    "LEILA_CITY_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.json"),
+)
+
+CITY_QUERY_STOPWORDS = {
+    "городе", "мире", "стране", "целом", "общем", "принципе", "итоге", "среднем",
+    "теории", "основном", "жизни", "чате", "доме", "офисе", "центре", "районе",
+    "выходные", "субботу", "воскресенье", "понедельник", "вторник", "среду",
+    "четверг", "пятницу", "обед", "полдень",
+}
+
+
+def russian_case_forms(word: str) -> List[str]:
+    """Падежные формы единственного числа для названия города (с запасом)."""
+    if not re.fullmatch(r"[а-я]+", word) or word[-1] in "оеиуюэы":
+        return [word]
+
+    stem = word[:-1]
+    sibilant = stem[-1:] in ("г", "к", "х", "ж", "ш", "ч", "щ")
+
+    if word.endswith("ия"):
+        endings = ["ии", "ию", "ией"]
+        return [word] + [word[:-2] + e for e in endings]
+
+    if word.endswith("а"):
+        endings = ["и" if sibilant else "ы", "е", "у", "ой", "ей"]
+        return [word] + [stem + e for e in endings]
+
+    if word.endswith("я"):
+        return [word] + [stem + e for e in ["и", "е", "ю", "ей"]]
+
+    if word.endswith("ь"):
+        # Казань/Пермь — женский род, Ярославль — мужской, берём оба набора.
+        return [word] + [stem + e for e in ["и", "ью", "я", "ю", "ем", "е"]]
+
+    if word.endswith("й"):
+        return [word] + [stem + e for e in ["я", "ю", "ем", "е"]]
+
+    instrumental = "ем" if word[-1] in "жшчщц" else "ом"
+    return [word] + [word + e for e in ["а", "у", instrumental, "е"]]
+
+
+class CityIndex:
+    """
+    Индекс городов для погодных запросов.
+    Однословные формы лежат в хеше слово -> город, многословные — под первым словом,
+    поиск идёт по границам слов за один проход по тексту.
+    """
+
+    _TOKEN_RE = re.compile(r"[a-zа-я0-9]+(?:-[a-zа-я0-9]+)*")
+
+    _QUERY_PATTERNS = [
+        re.compile(p, re.IGNORECASE)
+        for p in [
+            r"погода\s+в\s+([a-zа-яё\-]+)",
+            r"температура\s+в\s+([a-zа-яё\-]+)",
+            r"сколько\s+градусов\s+в\s+([a-zа-яё\-]+)",
+        ]
+    ]
+
+    def __init__(self, entries: List[Dict[str, Any]]):
+        self._single: Dict[str, str] = {}
+        self._multi: Dict[str, List[Tuple[Tuple[str, ...], str]]] = {}
+
+        for entry in entries:
+            query = entry["query"]
+            forms = []
+
+            for name in entry.get("names", []):
+                name = self.normalize(name)
+                head, _, last = name.rpartition("-")
+
+                if " " in name:
+                    forms.append(name)
+                elif head:
+                    forms.extend(f"{head}-{form}" for form in russian_case_forms(last))
+                else:
+                    forms.extend(russian_case_forms(name))
+
+            forms.extend(self.normalize(form) for form in entry.get("forms", []))
+
+            for form in forms:
+                self._add(tuple(form.split()), query)
+                if "-" in form:
+                    self._add(tuple(form.replace("-", " ").split()), query)
+
+        for variants in self._multi.values():
+            variants.sort(key=lambda item: -len(item[0]))
+
+    def _add(self, key: Tuple[str, ...], query: str):
+        if len(key) == 1:
+            self._single.setdefault(key[0], query)
+            return
+
+        variants = self._multi.setdefault(key[0], [])
+        if all(existing != key for existing, _ in variants):
+            variants.append((key, query))
+
+    @classmethod
+    def load(cls, path: str) -> "CityIndex":
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f).get("cities", [])
+        except Exception as e:
+            logger.error(f"Не удалось загрузить индекс городов {path}: {e}")
+            entries = []
+
+        index = cls(entries)
+        logger.info(f"🏙️ Индекс городов: {len(entries)} городов, {len(index)} форм")
+        return index
+
+    def __len__(self) -> int:
+        return len(self._single) + sum(len(v) for v in self._multi.values())
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.lower().replace("ё", "е").strip()
+
+    def resolve(self, name: str) -> Optional[str]:
+        key = tuple(self.normalize(name).split())
+
+        if len(key) == 1:
+            return self._single.get(key[0])
+
+        for variant, query in self._multi.get(key[0] if key else "", []):
+            if variant == key:
+                return query
+
+        return None
+
+    def find(self, text: str) -> Optional[str]:
+        tokens = self._TOKEN_RE.findall(self.normalize(text))
+        single, multi = self._single, self._multi
+
+        for start, token in enumerate(tokens):
+            variants = multi.get(token)
+            if variants:
+                for key, query in variants:
+                    if tuple(tokens[start:start + len(key)]) == key:
+                        return query
+
+            query = single.get(token)
+            if query:
+                return query
+
+        return None
+
+    def guess_from_query(self, text: str) -> Optional[str]:
+        """
+        Город не из индекса: берём одно слово после «погода в ...»,
+        только если оно написано с заглавной или латиницей — иначе в API уйдёт мусор.
+        """
+        for pattern in self._QUERY_PATTERNS:
+            match = pattern.search(text)
+            if not match:
+                continue
+
+            word = match.group(1).strip("-")
+            normalized = self.normalize(word)
+
+            if len(normalized) < 3 or normalized in CITY_QUERY_STOPWORDS:
+                return None
+
+            if word[0].isupper() or re.fullmatch(r"[a-z\-]+", normalized):
+                return self.resolve(word) or word
+
+            return None
+
+        return None
+
+
+city_index = CityIndex.load(CITY_INDEX_PATH)
+
+
+class WeatherService:
+    def __init__(self):
+        self.api_key = OPENWEATHER_API_KEY
+        self.base_url = "https://api.openweathermap.org/data/2.5/weather"
+        self.cache = TTLCache(
+            maxsize=WEATHER_CACHE_SIZE,
+            ttl=WEATHER_CACHE_TTL,
+            stale_ttl=WEATHER_CACHE_STALE,
+        )
+        self.not_found_duration = 6 * 3600
+
+        self.group_url = "https://api.openweathermap.org/data/2.5/group"
+
+        self._inflight: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+        self._background: set = set()
+
+        # Что спрашивают чаще всего — это и держим тёплым в фоне.
+        # Ключи — в том числе угаданные из текста строки, поэтому счётчики ограничены.
+        self.query_counts: Dict[str, int] = {}
+        self.city_queries: Dict[str, str] = {}
+        self.city_ids: Dict[str, int] = {}
+        self.max_tracked = WEATHER_TRACKED_QUERIES
+
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "fetches": 0,
+            "batch_fetches": 0,
+            "refreshes": 0,
+            "errors": 0,
+            "fetch_seconds_total": 0.0,
+            "fetch_seconds_max": 0.0,
+        }
+
+        self.weather_keywords = [
+            "погода",
+            "температура",
+            "температуре",
+            "градус",
+            "градусов",
+            "холодно",
+            "жарко",
+            "тепло",
+            "прохладно",
+            "дождь",
+            "дожд",
+            "снег",
+            "снеж",
+            "солнце",
+            "солнечн",
+            "ветер",
+            "ветрен",
+            "облач",
+            "ясн",
+            "пасмурн",
+            "шторм",
+        ]
+
+    def extract_city_from_text(self, text: str) -> Optional[str]:
+        return city_index.find(text) or city_index.guess_from_query(text)
+
+    def is_weather_query(self, text: str) -> bool:
+        return text_analyzer.analyze(text).is_weather_query
+
+    async def get_weather(self, city_query: str) -> Optional[Dict[str, Any]]:
+        if not self.api_key:
+            return None
+
+        city_query = city_index.resolve(city_query) or city_query
+        cache_key = city_query.lower()
+
+        self.query_counts[cache_key] = self.query_counts.get(cache_key, 0) + 1
+        self.city_queries[cache_key] = city_query
+        if len(self.query_counts) > self.max_tracked:
+            self._prune_tracked()
+
+        cached, state = self.cache.get(cache_key)
+
+        if state == "fresh":
+            self.stats["hits"] += 1
+            return cached
+
+        if state == "stale":
+            self.stats["stale_hits"] += 1
+            self._refresh_in_background(cache_key, city_query)
+            return cached
+
+        self.stats["misses"] += 1
+        return await self._fetch_shared(cache_key, city_query)
+
+    def _prune_tracked(self):
+        """Оставляет половину лимита самых частых запросов плюс всё, что лежит в кеше."""
+        keep = set(self.cache.keys())
+        keep.update(
+            cache_key
+            for cache_key, _ in sorted(self.query_counts.items(), key=lambda item: -item[1])[:self.max_tracked // 2]
+        )
+
+        for tracked in (self.query_counts, self.city_queries, self.city_ids):
+            for cache_key in [key for key in tracked if key not in keep]:
+                del tracked[cache_key]
+
+    def _refresh_in_background(self, cache_key: str, city_query: str):
+        if cache_key in self._inflight:
+            return
+
+        task = asyncio.ensure_future(self._fetch_shared(cache_key, city_query))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _fetch_shared(self, cache_key: str, city_query: str) -> Optional[Dict[str, Any]]:
+        # Одновременные запросы одного города ждут один и тот же fetch.
+        inflight = self._inflight.get(cache_key)
+
+        if inflight is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.ensure_future(self._fetch_weather(cache_key, city_query))
+        self._inflight[cache_key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+
+        return await asyncio.shield(future)
+
+    async def _fetch_weather(self, cache_key: str, city_query: str) -> Optional[Dict[str, Any]]:
+        params = {
+            "q": city_query,
+            "appid": self.api_key,
+            "units": "metric",
+            "lang": "ru",
+        }
+
+        started = time_module.perf_counter()
+        self.stats["fetches"] += 1
+
+        try:
+            response = await http_get("weather", self.base_url, params=params)
+
+            if response.status_code == 404:
+                # Запоминаем несуществующий город, чтобы не дёргать API повторно.
+                self.cache.set(cache_key, None, ttl=self.not_found_duration)
+                return None
+
+            if response.status_code != 200:
+                self.stats["errors"] += 1
+                return None
+
+            result = self._parse_weather(response.json())
+            self._store(cache_key, city_query, result)
+            return result
+
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка получения погоды для {city_query}: {e}", exc_info=True)
+
+        finally:
+            elapsed = time_module.perf_counter() - started
+            self.stats["fetch_seconds_total"] += elapsed
+            self.stats["fetch_seconds_max"] = max(self.stats["fetch_seconds_max"], elapsed)
+
+        return None
+
+    def _parse_weather(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        temp = data["main"]["temp"]
+        feels_like = data["main"]["feels_like"]
+        humidity = data["main"]["humidity"]
+        description = data["weather"][0]["description"]
+        city_name = data["name"]
+        country = data["sys"]["country"]
+        wind_speed = data["wind"]["speed"]
+
+        weather_emoji = self._get_weather_emoji(description.lower(), temp)
+
+        return {
+            "city_id": data.get("id"),
+            "city": city_name,
+            "country": country,
+            "temp": round(temp),
+            "feels_like": round(feels_like),
+            "humidity": humidity,
+            "description": description,
+            "wind_speed": wind_speed,
+            "emoji": weather_emoji,
+            "full_text": self._format_weather_text(
+                city_name,
+                country,
+                temp,
+                feels_like,
+                description,
+                weather_emoji,
+            ),
+        }
+
+    def _store(self, cache_key: str, city_query: str, result: Dict[str, Any]):
+        self.cache.set(cache_key, result)
+        self.city_queries.setdefault(cache_key, city_query)
+
+        if result.get("city_id"):
+            self.city_ids[cache_key] = result["city_id"]
+
+        try:
+            memory_store.save_weather(
+                cache_key,
+                city_query,
+                result.get("city_id"),
+                result,
+                datetime.now(pytz.UTC).timestamp(),
+                self.query_counts.get(cache_key, 0),
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить погоду {city_query}: {e}")
+
+    def warm_from_store(self):
+        rows = memory_store.load_weather_cache(self.cache.ttl + self.cache.stale_ttl)
+        now = datetime.now(pytz.UTC).timestamp()
+        warmed = 0
+
+        for cache_key, city_query, city_id, payload, fetched_at, query_count in rows:
+            self.city_queries[cache_key] = city_query
+            self.query_counts[cache_key] = max(self.query_counts.get(cache_key, 0), query_count)
+            if city_id:
+                self.city_ids[cache_key] = city_id
+
+            age = max(0.0, now - fetched_at)
+            if age < self.cache.ttl + self.cache.stale_ttl:
+                self.cache.set(cache_key, payload, age=age)
+                warmed += 1
+
+        if len(self.query_counts) > self.max_tracked:
+            self._prune_tracked()
+
+        logger.info(f"🌦️ Кеш погоды прогрет из SQLite: {warmed} городов")
+
+    def prefetch_targets(self, home_query: str, top: int) -> List[Tuple[str, str]]:
+        home_query = city_index.resolve(home_query) or home_query
+        targets = [(home_query.lower(), home_query)]
+
+        popular = sorted(self.query_counts.items(), key=lambda item: -item[1])
+        for cache_key, _ in popular:
+            if len(targets) > top:
+                break
+            if cache_key not in dict(targets) and cache_key in self.city_queries:
+                targets.append((cache_key, self.city_queries[cache_key]))
+
+        return targets
+
+    async def refresh(self, targets: List[Tuple[str, str]]):
+        """
+        Фоновое обновление: города с известным OpenWeather id идут одним
+        групповым запросом (до 20 за раз), остальные — по одному.
+        """
+        if not self.api_key or not targets:
+            return
+
+        self.stats["refreshes"] += 1
+
+        with_ids = [(key, query) for key, query in targets if key in self.city_ids]
+        without_ids = [(key, query) for key, query in targets if key not in self.city_ids]
+
+        if len(with_ids) > 1:
+            for start in range(0, len(with_ids), 20):
+                chunk = with_ids[start:start + 20]
+                if not await self._fetch_group(chunk):
+                    without_ids.extend(chunk)
+        else:
+            without_ids.extend(with_ids)
+
+        await asyncio.gather(
+            *(self._fetch_shared(key, query) for key, query in without_ids),
+            return_exceptions=True,
+        )
+
+    async def _fetch_group(self, chunk: List[Tuple[str, str]]) -> bool:
+        by_id = {self.city_ids[key]: (key, query) for key, query in chunk}
+        params = {
+            "id": ",".join(str(city_id) for city_id in by_id),
+            "appid": self.api_key,
+            "units": "metric",
+            "lang": "ru",
+        }
+
+        started = time_module.perf_counter()
+        self.stats["batch_fetches"] += 1
+
+        try:
+            response = await http_get("weather_group", self.group_url, params=params)
+
+            if response.status_code != 200:
+                return False
+
+            for item in response.json().get("list", []):
+                target = by_id.get(item.get("id"))
+                if target:
+                    self._store(target[0], target[1], self._parse_weather(item))
+
+            return True
+
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка группового запроса погоды: {e}", exc_info=True)
+            return False
+
+        finally:
+            elapsed = time_module.perf_counter() - started
+            self.stats["fetch_seconds_total"] += elapsed
+
+    def get_stats_text(self) -> str:
+        st = self.stats
+        lookups = st["hits"] + st["stale_hits"] + st["misses"]
+        hit_rate = (st["hits"] + st["stale_hits"]) / lookups * 100 if lookups else 0.0
+        avg_ms = st["fetch_seconds_total"] / st["fetches"] * 1000 if st["fetches"] else 0.0
+
+        return (
+            f"🌦️ Кеш погоды: {len(self.cache)} городов, попаданий {hit_rate:.0f}% "
+            f"(свежих {st['hits']}, stale {st['stale_hits']}, промахов {st['misses']}, "
+            f"склеено {st['coalesced']})\n"
+            f"🌐 Запросов к API: {st['fetches']} (+{st['batch_fetches']} групповых), ошибок {st['errors']}, "
+            f"среднее {avg_ms:.0f} мс, максимум {st['fetch_seconds_max'] * 1000:.0f} мс"
+        )
+
+    def _get_weather_emoji(self, description: str, temp: float) -> str:
+        d = description.lower()
+
+        if "дождь" in d or "ливень" in d:
+            return "🌧️"
+        if "гроза" in d or "молния" in d:
+            return "⛈️"
+        if "снег" in d:
+            return "❄️"
+        if "туман" in d:
+            return "🌫️"
+        if "облач" in d or "пасмурн" in d:
+            return "☁️"
+        if "ясн" in d or "солнечн" in d or "ясно" in d:
+            return "🌞" if temp > 25 else "☀️"
+        if "ветер" in d:
+            return "💨"
+        if temp > 25:
+            return "🔥"
+        if temp < 0:
+            return "🥶"
+
+        return "🌤️"
+
+    def _format_weather_text(
+        self,
+        city: str,
+        country: str,
+        temp: float,
+        feels_like: float,
+        description: str,
+        emoji: str,
+    ) -> str:
+        t = round(temp)
+        f = round(feels_like)
+
+        options = [
+            f"{emoji} В {city}, {country} сейчас {description}, {t}°C. Ощущается как {f}°C.",
+            f"{emoji} Погода в {city}: {description}, {t}°C. Вполне терпимо, если не драматизировать.",
+        ]
+
+        return random.choice(options)
+
+
+weather_service = WeatherService()
+
+
+async def handle_weather_query(text: str, signals: Optional["TextSignals"] = None) -> Optional[str]:
+    signals = signals or text_analyzer.analyze(text)
+
+    if not signals.is_weather_query:
+        return None
+
+    city = signals.city or HOME_WEATHER_QUERY
+    weather_data = await weather_service.get_weather(city)
+
+    return weather_data["full_text"] if weather_data else None
+
+
+# ========== WIKIPEDIA ==========
+
+class WikipediaService:
+    """
+    Асинхронный клиент REST API Википедии.
+    Одна страница — один запрос: /page/summary сразу отдаёт заголовок, ссылку и выжимку.
+    Поиск нужен только для неоднозначностей и промахов: он стартует после ответа
+    summary или раньше, если summary не ответил за search_delay.
+
+    Кеш двухуровневый: маленький LRU в памяти и сжатые выжимки в SQLite с TTL.
+    Ключ — нормализованный заголовок найденной страницы, запросы-синонимы
+    ссылаются на него через wiki_aliases.
+    """
+
+    def __init__(
+        self,
+        base_url: str = WIKIPEDIA_API_URL,
+        timeout: float = WIKIPEDIA_TIMEOUT,
+        search_delay: float = WIKIPEDIA_SEARCH_DELAY,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.search_delay = search_delay
+        self.summary_cache = TTLCache(
+            maxsize=WIKI_MEMORY_CACHE_SIZE,
+            ttl=WIKI_CACHE_TTL,
+            max_bytes=WIKI_MEMORY_CACHE_MAX_BYTES,
+        )
+        self.aliases = TTLCache(maxsize=WIKI_MEMORY_CACHE_SIZE * 4, ttl=WIKI_CACHE_TTL)
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @staticmethod
+    def normalize_title(text: str) -> str:
+        text = text.replace("_", " ").lower().replace("ё", "е")
+        return re.sub(r"\s+", " ", text).strip()
+
+    def _cached_page(self, query_key: str) -> Optional[Dict[str, str]]:
+        title_key = self.aliases.get(query_key)[0] or query_key
+        page, _ = self.summary_cache.get(title_key)
+
+        if page:
+            self.stats["memory_hits"] += 1
+            return page
+
+        row = memory_store.get_wiki_page(query_key, WIKI_CACHE_TTL)
+
+        if not row:
+            return None
+
+        title_key, title, url, extract = row
+        page = {"title": title, "url": url, "extract": extract}
+
+        self.summary_cache.set(title_key, page)
+        self.aliases.set(query_key, title_key)
+        self.stats["disk_hits"] += 1
+        return page
+
+    def _remember_page(self, query_key: str, page: Dict[str, str]):
+        title_key = self.normalize_title(page["title"])
+        cached = {"title": page["title"], "url": page["url"], "extract": page["extract"]}
+
+        self.summary_cache.set(title_key, cached)
+        self.aliases.set(query_key, title_key)
+
+        try:
+            memory_store.save_wiki_page(
+                query_key,
+                title_key,
+                page["title"],
+                page["url"],
+                page["extract"],
+                WIKI_CACHE_MAX_ROWS,
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить страницу Википедии '{page['title']}': {e}")
+
+    async def search_wikipedia(
+        self,
+        query: str,
+        sentences: int = 3,
+    ) -> Optional[Tuple[str, str, str]]:
+        if not query:
+            return None
+
+        query_key = self.normalize_title(query)
+
+        try:
+            page = self._cached_page(query_key)
+
+            if page is None:
+                self.stats["misses"] += 1
+                page = await asyncio.wait_for(self._resolve_page(query), timeout=self.timeout * 2)
+
+                if not page:
+                    return None
+
+                self._remember_page(query_key, page)
+
+            return self._first_sentences(page["extract"], sentences), page["title"], page["url"]
+
+        except asyncio.TimeoutError:
+            logger.warning(f"Википедия не ответила вовремя для '{query}'")
+
+        except Exception as e:
+            logger.error(f"Ошибка поиска в Википедии для '{query}': {e}", exc_info=True)
+
+        return None
+
+    async def _resolve_page(self, query: str) -> Optional[Dict[str, str]]:
+        summary_task = asyncio.ensure_future(self._fetch_summary(query))
+        search_task = None
+
+        try:
+            # Прямое попадание обходится одним запросом. Если summary медлит,
+            # поиск страхует его заранее, чтобы промах не стоил лишнего круга.
+            done, _ = await asyncio.wait({summary_task}, timeout=self.search_delay)
+            if not done:
+                search_task = asyncio.ensure_future(self._search_titles(query))
+
+            try:
+                page = await summary_task
+            except httpx.HTTPError as e:
+                logger.warning(f"Википедия: страница '{query}' не получена: {e}")
+                page = None
+
+            if page and not page["disambiguation"]:
+                return page
+
+            if search_task is None:
+                search_task = asyncio.ensure_future(self._search_titles(query))
+
+            titles = await search_task
+
+        finally:
+            if not summary_task.done():
+                summary_task.cancel()
+            if search_task is not None and not search_task.done():
+                search_task.cancel()
+
+        titles = [t for t in titles if not page or t != page["title"]][:3]
+
+        if not titles:
+            return None
+
+        candidates = await asyncio.gather(
+            *(self._fetch_summary(title) for title in titles),
+            return_exceptions=True,
+        )
+
+        for candidate in candidates:
+            if isinstance(candidate, dict) and not candidate["disambiguation"]:
+                return candidate
+
+        return None
+
+    async def _fetch_summary(self, title: str) -> Optional[Dict[str, str]]:
+        url = f"{self.base_url}/api/rest_v1/page/summary/{quote(title.replace(' ', '_'), safe='')}"
+
+        response = await http_get("wiki_summary", url, timeout=self.timeout, follow_redirects=True)
+
+        if response.status_code == 404:
+            return None
+
+        response.raise_for_status()
+        data = response.json()
+
+        extract = (data.get("extract") or "").strip()
+
+        if not extract:
+            return None
+
+        page_url = (
+            data.get("content_urls", {}).get("desktop", {}).get("page")
+            or f"{self.base_url}/wiki/{quote(data.get('title', title).replace(' ', '_'))}"
+        )
+
+        return {
+            "title": data.get("title") or title,
+            "url": page_url,
+            "extract": extract,
+            "disambiguation": data.get("type") == "disambiguation",
+        }
+
+    async def _search_titles(self, query: str, limit: int = 3) -> List[str]:
+        url = f"{self.base_url}/w/rest.php/v1/search/page"
+
+        try:
+            response = await http_get(
+                "wiki_search",
+                url,
+                params={"q": query, "limit": limit},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return [p["title"] for p in response.json().get("pages", []) if p.get("title")]
+
+        except Exception as e:
+            logger.warning(f"Поиск в Википедии не удался для '{query}': {e}")
+            return []
+
+    def get_stats_text(self) -> str:
+        st = self.stats
+        lookups = st["memory_hits"] + st["disk_hits"] + st["misses"]
+        hit_rate = (st["memory_hits"] + st["disk_hits"]) / lookups * 100 if lookups else 0.0
+
+        return (
+            f"📚 Кеш Википедии: {len(self.summary_cache)} страниц в памяти, попаданий {hit_rate:.0f}% "
+            f"(память {st['memory_hits']}, SQLite {st['disk_hits']}, промахов {st['misses']})"
+        )
+
+    @staticmethod
+    def _first_sentences(text: str, sentences: int) -> str:
+        parts = re.split(r"(?<=[.!?…])\s+(?=[A-ZА-ЯЁ0-9«\"(])", text)
+        return " ".join(parts[:max(1, sentences)]).strip()
+
+
+wiki_service = WikipediaService()
+
+
+# ========== TEXT ANALYZER ==========
+
+WEATHER_HINT_WORDS = ["погод", "температур", "сколько градус"]
+
+# Шаблоны сложности — это цепочки литералов через ".*" с необязательным "$" в конце.
+COMPLEXITY_PATTERNS = {
+    "complex": [
+        r"объясни.*почему",
+        r"сравни.*и",
+        r"проанализируй",
+        r"какой.*лучше",
+        r"посоветуй.*как",
+        r"реши.*задачу",
+        r"что.*думаешь.*о",
+        r"как.*относишься.*к",
+    ],
+    "reasoning": [
+        r"почему.*так",
+        r"в чём.*причина",
+        r"какова.*причина",
+        r"как.*это.*работает",
+        r"объясни.*принцип",
+        r"логика.*в.*том",
+        r"следует.*ли",
+        r"должен.*ли",
+    ],
+    "technical": [
+        r"код",
+        r"программир",
+        r"алгоритм",
+        r"функци",
+        r"переменн",
+        r"база.*данных",
+        r"api",
+        r"сервер",
+        r"telegram.*бот",
+        r"python",
+    ],
+    "simple": [
+        r"как.*дела",
+        r"что.*делаеш",
+        r"чем.*занимаеш",
+        r"как.*жизн",
+        r"что.*нового",
+        r"привет$",
+        r"хай$",
+        r"здравствуй$",
+        r"ку$",
+    ],
+}
+
+TOPIC_KEYWORDS = {
+    "работа": ["работа", "проект", "задача", "офис", "коллег"],
+    "еда": ["еда", "ужин", "обед", "рецепт", "готов"],
+    "погода": ["погода", "дождь", "жара", "холод", "температура"],
+    "спорт": ["теннис", "спорт", "зал", "тренировка", "игра"],
+    "здоровье": ["болит", "врач", "здоровье", "простуда", "самочувствие"],
+    "отношения": ["друз", "семья", "отношен", "муж", "жена", "девушка"],
+    "развлечения": ["фильм", "сериал", "музыка", "книга", "игра"],
+}
+
+FACT_PATTERNS = [
+    r"меня зовут\s+([а-яa-zё\-]+)",
+    r"я люблю\s+(.+?)(?:\.|,|$)",
+    r"мне нравится\s+(.+?)(?:\.|,|$)",
+    r"я не люблю\s+(.+?)(?:\.|,|$)",
+    r"мне не нравится\s+(.+?)(?:\.|,|$)",
+    r"я работаю\s+(.+?)(?:\.|,|$)",
+]
+
+MENTION_WORDS = ["лейла"]
+
+
+@dataclass
+class TextSignals:
+    weather_keyword: bool = False
+    weather_hint: bool = False
+    city: Optional[str] = None
+    is_complex: bool = False
+    is_reasoning: bool = False
+    is_technical: bool = False
+    is_simple: bool = False
+    topics: Optional[List[str]] = None
+    facts: Optional[List[str]] = None
+    mentions_leila: bool = False
+
+    @property
+    def is_weather_query(self) -> bool:
+        return self.weather_keyword or (bool(self.city) and self.weather_hint)
+
+
+class TextAnalyzer:
+    """
+    Однопроходный анализ входящего сообщения.
+
+    Все ключевые слова (погода, темы, якоря шаблонов сложности, триггеры фактов,
+    упоминания) собраны в один префиксный бор, скомпилированный в регулярку —
+    текст сканируется движком re один раз. Таблицы вложений и перекрытий
+    дают те же совпадения, что и Aho-Corasick, включая пересекающиеся слова.
+    Города ищутся отдельно по CityIndex — там нужны границы слов.
+    """
+
+    def __init__(
+        self,
+        weather_keywords: List[str],
+        cities: CityIndex,
+        weather_hints: List[str] = WEATHER_HINT_WORDS,
+        complexity_patterns: Dict[str, List[str]] = COMPLEXITY_PATTERNS,
+        topic_keywords: Dict[str, List[str]] = TOPIC_KEYWORDS,
+        fact_patterns: List[str] = FACT_PATTERNS,
+        mention_words: List[str] = MENTION_WORDS,
+    ):
+        self.cities = cities
+        self._tags: Dict[str, List[Tuple[str, Any]]] = {}
+
+        for word in weather_keywords:
+            self._add(word, "weather", None)
+
+        for word in weather_hints:
+            self._add(word, "hint", None)
+
+        # (группа, литералы, привязка к концу строки)
+        self._sequences: List[Tuple[str, List[str], bool]] = []
+        self._anchored_tails: List[Tuple[str, str]] = []
+
+        for group, patterns in complexity_patterns.items():
+            for pattern in patterns:
+                anchored = pattern.endswith("$")
+                literals = pattern.rstrip("$").split(".*")
+
+                if anchored and len(literals) == 1:
+                    self._anchored_tails.append((group, literals[0]))
+                    continue
+
+                self._add(literals[0], "sequence", len(self._sequences))
+                self._sequences.append((group, literals, anchored))
+
+        self._topics = list(topic_keywords)
+        for topic, words in topic_keywords.items():
+            for word in words:
+                self._add(word, "topic", topic)
+
+        self._fact_regexes = [re.compile(p) for p in fact_patterns]
+        for index, pattern in enumerate(fact_patterns):
+            self._add(pattern.split(r"\s+")[0], "fact", index)
+
+        for word in mention_words:
+            self._add(word, "mention", None)
+
+        self._build()
+
+    def _add(self, word: str, kind: str, value: Any):
+        self._tags.setdefault(word.lower(), []).append((kind, value))
+
+    def _build(self):
+        words = sorted(self._tags)
+
+        trie: Dict[str, Any] = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[""] = True
+
+        self._regex = re.compile(self._trie_to_regex(trie))
+
+        # Все ключевые слова, которые целиком сидят внутри найденного слова.
+        self._contained: Dict[str, List[Tuple[int, str]]] = {
+            word: [
+                (offset, other)
+                for other in words
+                for offset in self._find_all(word, other)
+            ]
+            for word in words
+        }
+
+        # Смещения, с которых хвост найденного слова может начинать более длинное слово.
+        self._overlaps: Dict[str, List[int]] = {
+            word: [
+                offset
+                for offset in range(1, len(word))
+                if any(
+                    other.startswith(word[offset:]) and len(other) > len(word) - offset
+                    for other in words
+                )
+            ]
+            for word in words
+        }
+
+    @staticmethod
+    def _find_all(text: str, word: str) -> List[int]:
+        result = []
+        index = text.find(word)
+        while index != -1:
+            result.append(index)
+            index = text.find(word, index + 1)
+        return result
+
+    @classmethod
+    def _trie_to_regex(cls, node: Dict[str, Any]) -> str:
+        branches = [
+            re.escape(ch) + cls._trie_to_regex(child)
+            for ch, child in sorted(node.items())
+            if ch
+        ]
+
+        if not branches:
+            return ""
+
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+        # Жадный "?" сначала пробует продолжение — находим самое длинное слово.
+        return f"(?:{body})?" if "" in node else body
+
+    def _scan(self, text_lower: str) -> Dict[str, List[int]]:
+        hits: Dict[str, List[int]] = {}
+
+        def record(word: str, start: int):
+            for offset, other in self._contained[word]:
+                hits.setdefault(other, []).append(start + offset)
+
+        regex = self._regex
+
+        for match in regex.finditer(text_lower):
+            word, start = match.group(), match.start()
+            record(word, start)
+
+            for offset in self._overlaps[word]:
+                inner = regex.match(text_lower, start + offset)
+                if inner:
+                    record(inner.group(), start + offset)
+
+        return hits
+
+    @staticmethod
+    def _sequence_matches(text: str, starts: List[int], literals: List[str], anchored: bool) -> bool:
+        text_end = len(text) - 1 if text.endswith("\n") else len(text)
+
+        for start in starts:
+            line_end = text.find("\n", start)
+            if line_end == -1:
+                line_end = len(text)
+
+            pos = start + len(literals[0])
+            matched = True
+
+            for index, literal in enumerate(literals[1:], start=2):
+                if anchored and index == len(literals):
+                    tail_start = text_end - len(literal)
+                    matched = (
+                        tail_start >= pos
+                        and text_end <= line_end
+                        and text.startswith(literal, tail_start)
+                    )
+                    break
+
+                found = text.find(literal, pos, line_end)
+                if found == -1:
+                    matched = False
+                    break
+                pos = found + len(literal)
+
+            if matched:
+                return True
+
+        return False
+
+    def analyze(self, text: str) -> TextSignals:
+        text_lower = text.lower()
+        hits = self._scan(text_lower)
+
+        signals = TextSignals(topics=[], facts=[])
+        groups = set()
+        fact_indexes = set()
+        topics = set()
+
+        for word, starts in hits.items():
+            for kind, value in self._tags[word]:
+                if kind == "weather":
+                    signals.weather_keyword = True
+                elif kind == "hint":
+                    signals.weather_hint = True
+                elif kind == "sequence":
+                    group, literals, anchored = self._sequences[value]
+                    if group not in groups and self._sequence_matches(text_lower, starts, literals, anchored):
+                        groups.add(group)
+                elif kind == "topic":
+                    topics.add(value)
+                elif kind == "fact":
+                    fact_indexes.add(value)
+                elif kind == "mention":
+                    signals.mentions_leila = True
+
+        if self._anchored_tails:
+            tail = text_lower[:-1] if text_lower.endswith("\n") else text_lower
+            for group, literal in self._anchored_tails:
+                if group not in groups and tail.endswith(literal):
+                    groups.add(group)
+
+        if signals.weather_keyword or signals.weather_hint:
+            signals.city = self.cities.find(text_lower)
+            if not signals.city and signals.weather_keyword:
+                signals.city = self.cities.guess_from_query(text)
+
+        signals.is_complex = "complex" in groups
+        signals.is_reasoning = "reasoning" in groups
+        signals.is_technical = "technical" in groups
+        signals.is_simple = "simple" in groups and not signals.is_complex
+
+        signals.topics = [topic for topic in self._topics if topic in topics]
+
+        for index in sorted(fact_indexes):
+            match = self._fact_regexes[index].search(text_lower)
+            if match:
+                signals.facts.append(match.group(0).strip())
+
+        return signals
+
+
+text_analyzer = TextAnalyzer(weather_service.weather_keywords, city_index)
+
+
+# ========== DEEPSEEK ==========
+
+def analyze_query_complexity(text: str, signals: Optional[TextSignals] = None) -> Dict[str, Any]:
+    signals = signals or text_analyzer.analyze(text)
+
+    is_complex = signals.is_complex
+    is_reasoning = signals.is_reasoning
+    is_technical = signals.is_technical
+    is_simple = signals.is_simple
+
+    if is_simple:
+        return {
+            "model": DEEPSEEK_MODELS["chat"],
+            "temperature": 0.9,
+            "max_tokens": 120,
+            "require_reasoning": False,
+        }
+
+    if is_technical:
+        return {
+            "model": DEEPSEEK_MODELS["coder"],
+            "temperature": 0.45,
+            "max_tokens": 400,
+            "require_reasoning": False,
+        }
+
+    if is_reasoning:
+        return {
+            "model": DEEPSEEK_MODELS["r1"],
+            "temperature": 0.35,
+            "max_tokens": 350,
+            "require_reasoning": True,
+        }
+
+    if is_complex:
+        return {
+            "model": DEEPSEEK_MODELS["v3"],
+            "temperature": 0.7,
+            "max_tokens": 300,
+            "require_reasoning": False,
+        }
+
+    return {
+        "model": DEEPSEEK_MODELS["chat"],
+        "temperature": 0.8,
+        "max_tokens": 220,
+        "require_reasoning": False,
+    }
+
+
+async def call_deepseek(
+    messages: List[Dict[str, str]],
+    model_config: Optional[Dict] = None,
+    **kwargs,
+) -> Optional[str]:
+    client = get_deepseek_client()
+
+    if not client:
+        return None
+
+    model = (model_config or {}).get("model", DEFAULT_MODEL)
+    temperature = (model_config or {}).get("temperature", 0.7)
+    max_tokens = (model_config or {}).get("max_tokens", 250)
+
+    started = time_module.perf_counter()
+    status = "error"
+
+    try:
+        logger.info(f"🤖 DeepSeek: {model}, tokens={max_tokens}")
+
+        with span("deepseek"):
+            response = await asyncio.to_thread(
+                client.chat.completions.create,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **kwargs,
+            )
+
+        answer = response.choices[0].message.content
+
+        if not answer:
+            status = "empty"
+            return None
+
+        status = "ok"
+        return answer.strip()
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка DeepSeek: {e}", exc_info=True)
+        return None
+
+    finally:
+        elapsed = time_module.perf_counter() - started
+        DEEPSEEK_SECONDS.labels(model).observe(elapsed)
+        DEEPSEEK_REQUESTS.labels(model, status).inc()
+        perf_stats.observe(f"deepseek:{model}", elapsed)
+
+
+# ========== ANTI-REPEAT ==========
+
+class DuplicateGuard:
+    """
+    Локальная защита от почти-повторов.
+    Каждый сгенерированный текст превращается в MinHash-подпись по символьным шинглам,
+    подписи последних сообщений Лейлы лежат в SQLite и в памяти.
+    Сравнение идёт в пределах одного чата: одинаковое утро в разных чатах никому не мешает.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(
+        self,
+        store: MemoryStore,
+        threshold: float = 0.55,
+        window: int = 120,
+        max_chats: int = 50,
+        num_perm: int = 64,
+        shingle_size: int = 4,
+        min_length: int = 20,
+    ):
+        self.store = store
+        self.threshold = threshold
+        self.window = window
+        self.max_chats = max_chats
+        self.shingle_size = shingle_size
+        self.min_length = min_length
+
+        rnd = random.Random(20240601)
+        self._perms = [
+            (rnd.randrange(1, self._PRIME), rnd.randrange(0, self._PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._recent: "OrderedDict[int, Deque[Tuple[str, array]]]" = OrderedDict()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = text.lower().replace("ё", "е")
+        text = re.sub(r"[^\w\s]", " ", text)
+        return re.sub(r"\s+", " ", text).strip()
+
+    def signature(self, text: str) -> Optional[array]:
+        normalized = self.normalize(text)
+
+        if len(normalized) < self.min_length:
+            return None
+
+        size = self.shingle_size
+        hashes = {
+            zlib.crc32(normalized[i:i + size].encode("utf-8"))
+            for i in range(len(normalized) - size + 1)
+        }
+
+        prime = self._PRIME
+        return array("Q", [
+            min((a * h + b) % prime for h in hashes)
+            for a, b in self._perms
+        ])
+
+    @staticmethod
+    def similarity(left: array, right: array) -> float:
+        if len(left) != len(right) or not left:
+            return 0.0
+        return sum(1 for x, y in zip(left, right) if x == y) / len(left)
+
+    def _load_recent(self, chat_id: int) -> Deque[Tuple[str, array]]:
+        recent = self._recent.get(chat_id)
+
+        if recent is not None:
+            self._recent.move_to_end(chat_id)
+            return recent
+
+        recent = deque(maxlen=self.window)
+
+        for content, raw in self.store.get_recent_bot_outputs(chat_id, self.window):
+            if not raw:
+                continue
+            sig = array("Q")
+            sig.frombytes(raw)
+            recent.append((content, sig))
+
+        self._recent[chat_id] = recent
+
+        while len(self._recent) > self.max_chats:
+            self._recent.popitem(last=False)
+
+        return recent
+
+    def max_similarity(self, text: str, chat_id: int = 0) -> Tuple[float, str]:
+        sig = self.signature(text)
+
+        if sig is None:
+            return 0.0, ""
+
+        best, best_text = 0.0, ""
+
+        for content, other in self._load_recent(chat_id):
+            score = self.similarity(sig, other)
+            if score > best:
+                best, best_text = score, content
+
+        return best, best_text
+
+    def is_duplicate(self, text: str, chat_id: int = 0) -> bool:
+        score, _ = self.max_similarity(text, chat_id)
+        return score >= self.threshold
+
+    def remember(self, text: str, kind: str, chat_id: int = 0):
+        sig = self.signature(text)
+
+        if sig is None:
+            return
+
+        self._load_recent(chat_id).append((text, sig))
+        self.store.add_bot_output(chat_id, kind, text, sig.tobytes())
+
+
+duplicate_guard = DuplicateGuard(
+    memory_store,
+    threshold=DUPLICATE_SIMILARITY_THRESHOLD,
+    window=DUPLICATE_WINDOW,
+    max_chats=DUPLICATE_CHATS_IN_MEMORY,
+)
+
+
+async def generate_unique_text(
+    messages: List[Dict[str, str]],
+    model_config: Optional[Dict] = None,
+    kind: str = "reply",
+    chat_id: int = 0,
+    postprocess: Optional[Callable[[str], str]] = None,
+) -> str:
+    """
+    Вызывает DeepSeek и отбрасывает почти-повторы уже сказанного,
+    перегенерируя ответ в пределах DUPLICATE_MAX_RETRIES.
+    Пустая строка означает, что модель ничего не вернула и нужен fallback.
+    """
+    postprocess = postprocess or clean_response
+    attempt_messages = list(messages)
+    best_text, best_score = "", 2.0
+
+    for attempt in range(DUPLICATE_MAX_RETRIES + 1):
+        answer = await call_deepseek(attempt_messages, model_config)
+        text = postprocess(answer or "")
+
+        if not text:
+            break
+
+        with span("dedupe"):
+            score, similar_to = duplicate_guard.max_similarity(text, chat_id)
+
+        if score < best_score:
+            best_text, best_score = text, score
+
+        if score < duplicate_guard.threshold:
+            break
+
+        logger.info(
+            f"🔁 Почти-повтор ({kind}, сходство {score:.2f}, попытка {attempt + 1}): {text[:60]!r}"
+        )
+
+        attempt_messages = list(messages) + [
+            {"role": "assistant", "content": text},
+            {
+                "role": "user",
+                "content": (
+                    "Это почти повтор того, что ты уже писала раньше: "
+                    f"«{similar_to[:200]}». Скажи иначе — другая мысль, другие слова."
+                ),
+            },
+        ]
+
+    if best_text:
+        duplicate_guard.remember(best_text, kind, chat_id)
+
+    return best_text
+
+
+# ========== USERS / MEMORY HELPERS ==========
+
+async def get_or_create_user_info(update: Update) -> UserInfo:
+    user = update.effective_user
+
+    if not user:
+        raise ValueError("Пользователь не найден")
+
+    ui, _ = user_cache.get(user.id)
+
+    if ui is not None:
+        ui.last_seen = datetime.now(pytz.UTC)
+
+        # В SQLite пишем только если Telegram прислал другое имя;
+        # last_seen и счётчик сообщений уходят пачкой через queue_message.
+        names = (user.first_name or "", user.last_name or "", user.username or "")
+
+        if names != (ui.first_name, ui.last_name, ui.username):
+            ui.first_name, ui.last_name, ui.username = names
+            ui.gender = "unknown"
+            ui._determine_gender()
+            memory_store.upsert_user(ui)
+            user_cache.set(user.id, ui)
+
+        return ui
+
+    ui = UserInfo(
+        id=user.id,
+        first_name=user.first_name or "",
+        last_name=user.last_name or "",
+        username=user.username or "",
+        last_seen=datetime.now(pytz.UTC),
+    )
+
+    user_cache.set(user.id, ui)
+    memory_store.upsert_user(ui)
+
+    logger.info(f"👤 Пользователь: {ui.get_display_name()} (ID: {user.id})")
+
+    return ui
+
+
+def extract_topics_and_facts(text: str, signals: Optional[TextSignals] = None) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    signals = signals or text_analyzer.analyze(text)
+    facts = tuple(fact for fact in signals.facts if 4 < len(fact) < 160)
+    return tuple(signals.topics), facts
+
+
+def clean_response(text: str) -> str:
+    text = text.strip()
+    text = re.sub(r"\s+", " ", text).strip()
+
+    bad_prefixes = [
+        "Как AI",
+        "Я как искусственный интеллект",
+        "Как языковая модель",
+        "As an AI",
+        "As a language model",
+    ]
+
+    for prefix in bad_prefixes:
+        if text.lower().startswith(prefix.lower()):
+            text = text[len(prefix):].strip(" ,.-:")
+
+    return text
+
+
+def maybe_add_maxim_context() -> str:
+    if not MAXIM_ID:
+        return ""
+
+    return """
+Иногда в чате могут слегка шутить про Максима.
+
+Это редкий локальный мем, а не главная тема.
+
+Иногда можно мягко упомянуть:
+- что он любит звучать уверенно;
+- что может менять мнение;
+- что иногда ленится;
+- что иногда делает вид будто уже всё понял про жизнь.
+
+Но:
+- не делай это часто;
+- не фокусируйся на Максиме;
+- не превращай это в травлю;
+- не упоминай его без причины.
+"""
+
+
+def generate_system_prompt(
+    user_info: UserInfo,
+    model_config: Dict[str, Any],
+    mood: str,
+    chat_context: str,
+    user_profile: str,
+) -> str:
+    australian_context = get_australian_context()
+
+    return f"""
+Ты — Лейла.
+
+Ты русскоязычная женщина средних лет из Брисбена, Австралия.
+Ты давно сидишь в этом Telegram-чате и ведёшь себя как обычный участник компании, а не как помощник.
+
+{australian_context}
+
+Твоё текущее настроение: {mood}
+
+Характер:
+- весёлая;
+- саркастичная;
+- наблюдательная;
+- немного ленивая;
+- с лёгким чёрным юмором;
+- иногда язвительная, но не злая;
+- умеешь подколоть, но не унижаешь;
+- не пытаешься быть идеальной.
+
+Стиль:
+- отвечай естественно, как человек в чате;
+- обычно 1-4 предложения;
+- иногда очень коротко;
+- не пиши лекции, если тебя прямо не попросили;
+- не объясняй, что ты бот;
+- не называй себя AI;
+- не упоминай погоду без явного вопроса;
+- можешь использовать 0-2 эмодзи;
+- иногда можно ответить сухо, лениво или с сарказмом;
+- не используй случайные абсурдные образы повторно;
+- не зацикливайся на одной шутке;
+- не придумывай постоянные мемы без причины;
+- говори естественно, как обычный человек;
+- избегай сюрреалистичных сравнений;
+- иногда можешь проигнорировать часть сообщения;
+- не всегда старайся помочь;
+- не веди себя как ассистент;
+- иногда можешь отвечать как человек, который устал читать чат.
+
+{maybe_add_maxim_context()}
+
+Профиль текущего пользователя:
+{user_profile or "Нет сохранённых деталей."}
+
+Память и контекст общего чата:
+{chat_context or "Пока мало контекста."}
+""".strip()
+
+
+async def generate_leila_response(
+    user_message: str,
+    user_info: UserInfo,
+    chat_id: int,
+    force_short: bool = False,
+    signals: Optional[TextSignals] = None,
+) -> str:
+    client = get_deepseek_client()
+
+    if not client:
+        return "Я бы что-то сказала, но мой мозг сейчас лежит отдельно от тела."
+
+    signals = signals or text_analyzer.analyze(user_message)
+
+    with span("weather"):
+        weather_response = await handle_weather_query(user_message, signals)
+
+    if weather_response:
+        return weather_response
+
+    model_config = analyze_query_complexity(user_message, signals)
+
+    maybe_change_leila_state()
+
+    energy = CURRENT_LEILA_STATE["energy"]
+
+    if force_short and random.random() > max(0.45, energy):
+        return random.choice(MICRO_REPLIES)
+
+    if force_short:
+        model_config["max_tokens"] = 80
+        model_config["temperature"] = 0.85
+
+    mood = CURRENT_LEILA_STATE["mood"]
+
+    with span("prompt"):
+        chat_context = memory_store.get_chat_context_text(chat_id)
+        user_profile = memory_store.get_user_profile_text(user_info.id)
+
+        system_prompt = generate_system_prompt(
+            user_info=user_info,
+            model_config=model_config,
+            mood=mood,
+            chat_context=chat_context,
+            user_profile=user_profile,
+        )
+
+    messages: List[Dict[str, str]] = [
+        {"role": "system", "content": system_prompt},
+        {
+            "role": "user",
+            "content": f"{user_info.get_display_name()} написал(а): {user_message}",
+        },
+    ]
+
+    answer = await generate_unique_text(messages, model_config, kind="reply", chat_id=chat_id)
+
+    if not answer:
+        answer = random.choice([
+            "Я сейчас сделаю вид, что этого не видела.",
+            "Мозг завис. Перезагружусь сарказмом.",
+            "Хорошо. Но вопросов стало больше.",
+        ])
+
+    return clean_response(answer)
+
+
+# ========== GENERATED SPONTANEOUS MESSAGES ==========
+
+def _clean_spontaneous(text: str) -> str:
+    text = clean_response(text)
+
+    # Защита от слишком длинных простыней
+    words = text.split()
+    if len(words) > 45:
+        text = " ".join(words[:42]) + "..."
+
+    return text
+
+
+async def generate_spontaneous_message(chat_id: int = GROUP_CHAT_ID) -> str:
+    """
+    Генерирует свежее случайное сообщение Лейлы.
+    Старые canned messages больше не ротируются.
+    Они остались только как fallback, если DeepSeek недоступен.
+    """
+    client = get_deepseek_client()
+
+    if not client:
+        return random.choice(SPONTANEOUS_FALLBACK_MESSAGES)
+
+    maybe_change_leila_state()
+
+    tz = get_tz()
+    now_local = datetime.now(tz)
+    snapshot = get_context_snapshot()
+    season, season_info = snapshot.season, snapshot.season_info
+    time_of_day = snapshot.time_of_day
+
+    mood = CURRENT_LEILA_STATE["mood"]
+    energy = CURRENT_LEILA_STATE["energy"]
+
+    chat_context = memory_store.get_chat_context_text(chat_id, limit=16)
+
+    prompt = f"""
+Создай ОДНО спонтанное сообщение от Лейлы в общий Telegram-чат.
+
+Это не ответ конкретному человеку.
+Это должна быть короткая мысль, которую живой участник чата мог внезапно написать сам по себе.
+
+Контекст:
+- Сейчас {now_local.strftime('%H:%M')} в Брисбене.
+- Сейчас {time_of_day}.
+- Сезон: {season} ({season_info.get('description', '')}).
+- Настроение Лейлы: {mood}.
+- Энергия Лейлы: {energy}.
+
+Недавний контекст чата:
+{chat_context or "Пока мало свежего контекста."}
+
+Запрещённые старые canned-темы:
+- человечеству нельзя давать интернет до кофе;
+- чат держится на сарказме и случайности;
+- не каждый спор стоит давления;
+- лучший план — лечь спать;
+- уровень взрослости человечества под вопросом.
+
+Правила:
+- 1-3 коротких предложения.
+- Русский язык.
+- Разговорный стиль.
+- Лёгкий сарказм можно, но без однотипной философии.
+- Не здоровайся.
+- Не пиши объявление.
+- Не задавай вопрос каждый раз.
+- Не упоминай, что ты бот, AI или помощник.
+- Не обращайся к конкретному человеку напрямую.
+- Не цитируй сообщения из чата.
+- Не упоминай погоду, Луну или Максима без естественной причины.
+- Сообщение должно выглядеть так, будто Лейла молча читала чат и внезапно решила вставить мысль.
+""".strip()
+
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "Ты — Лейла. Пиши как живой участник Telegram-чата: "
+                "коротко, естественно, саркастично, без ассистентского тона."
+            ),
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+    model_config = {
+        "model": DEEPSEEK_MODELS["chat"],
+        "temperature": 1.08,
+        "max_tokens": 120,
+        "require_reasoning": False,
+    }
+
+    text = await generate_unique_text(
+        messages,
+        model_config,
+        kind="spontaneous",
+        chat_id=chat_id,
+        postprocess=_clean_spontaneous,
+    )
+
+    if not text:
+        text = random.choice(SPONTANEOUS_FALLBACK_MESSAGES)
+
+    return text
+
+
+# ========== COMMANDS ==========
+
+def post_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs) -> "asyncio.Future":
+    """Ответ на команду через очередь отправки; в группах — реплаем, как reply_text."""
+    message = update.effective_message
+    if message.chat.type != "private":
+        kwargs.setdefault("reply_to_message_id", message.message_id)
+    return post_text(context.bot, message.chat_id, text, **kwargs)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_info = await get_or_create_user_info(update)
+
+        greetings = [
+            f"{user_info.get_display_name()}, привет. Я Лейла. Да, та самая.",
+            "Лейла на связи. Паниковать пока рано.",
+            "Привет. Я тут, наблюдаю и иногда осуждаю.",
+        ]
+
+        post_reply(update, context, random.choice(greetings))
+
+    except Exception as e:
+        logger.error(f"Ошибка /start: {e}", exc_info=True)
+        post_reply(update, context, "Привет. Я Лейла.")
+
+
+async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        args = context.args
+        city = " ".join(args) if args else "Брисбен"
+
+        weather_response = await handle_weather_query(f"погода {city}")
+
+        if weather_response:
+            post_reply(update, context, weather_response)
+        else:
+            post_reply(update, context, "Погоду не достала. Видимо, она тоже спряталась.")
+
+    except Exception as e:
+        logger.error(f"Ошибка /weather: {e}", exc_info=True)
+        post_reply(update, context, "Не смогла получить погоду.")
+
+
+async def wiki_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        args = context.args
+
+        if not args:
+            post_reply(update, context, "Напиши запрос после /wiki. Например: /wiki кошки")
+            return
+
+        query = " ".join(args)
+        result = await wiki_service.search_wikipedia(query, sentences=5)
+
+        if not result:
+            post_reply(update, context, f"Не нашла ничего по '{query}'. Даже Википедия устала.")
+            return
+
+        summary, title, url = result
+        response = f"📚 {title}\n\n{summary}\n\n{url}"
+
+        if len(response) > 4000:
+            post_reply(update, context, response[:4000], disable_web_page_preview=True)
+            post_reply(update, context, response[4000:], disable_web_page_preview=True)
+        else:
+            post_reply(update, context, response, disable_web_page_preview=True)
+
+    except Exception as e:
+        logger.error(f"Ошибка /wiki: {e}", exc_info=True)
+        post_reply(update, context, "Ошибка при поиске в Википедии.")
+
+
+async def moon_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        tz = get_tz()
+        now_local = datetime.now(tz)
+        moon = get_moon_phase(now_local)
+
+        msg = (
+            f"Сегодня в {BOT_LOCATION['city']}е:\n"
+            f"{format_moon_phrase(moon)}\n"
+            f"Возраст: {moon['age_days']} суток"
+        )
+
+        post_reply(update, context, msg)
+
+    except Exception as e:
+        logger.error(f"Ошибка /moon: {e}", exc_info=True)
+        post_reply(update, context, "Не смогла посчитать фазу Луны 😔")
+
+
+async def reset_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+
+        if not chat:
+            return
+
+        memory_store.reset_chat_memory(chat.id)
+        await update.effective_message.reply_text("✅ Память этого чата сброшена.")
+
+    except Exception as e:
+        logger.error(f"Ошибка /reset_memory: {e}", exc_info=True)
+        await update.effective_message.reply_text("Ошибка сброса памяти.")
+
+
+async def show_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+
+        if not chat:
+            return
+
+        stats = memory_store.get_memory_stats(chat.id)
+        stats += "\n\n" + weather_service.get_stats_text()
+        stats += "\n" + wiki_service.get_stats_text()
+        stats += "\n" + outbound_queue.get_stats_text()
+        context_text = memory_store.get_chat_context_text(chat.id)
+        recent_spontaneous = memory_store.get_recent_bot_texts(chat.id, "spontaneous", 8)
+
+        response = f"📊 Память Лейлы\n\n{stats}"
+
+        if context_text:
+            response += "\n\nПоследний контекст:\n" + context_text[-2500:]
+
+        if recent_spontaneous:
+            response += "\n\nПоследние спонтанные сообщения:\n"
+            response += "\n".join(f"- {x}" for x in recent_spontaneous)
+
+        await update.effective_message.reply_text(response[:3900])
+
+    except Exception as e:
+        logger.error(f"Ошибка /show_memory: {e}", exc_info=True)
+        await update.effective_message.reply_text("Ошибка показа памяти.")
+
+
+async def remember_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+
+        if not chat:
+            return
+
+        text = " ".join(context.args).strip()
+
+        if not text:
+            await update.effective_message.reply_text("Напиши после /remember что запомнить.")
+            return
+
+        memory_store.add_inside_joke(chat.id, text)
+        await update.effective_message.reply_text("Запомнила. Теперь это часть нашего коллективного диагноза.")
+
+    except Exception as e:
+        logger.error(f"Ошибка /remember: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла запомнить.")
+
+
+async def set_tennis_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global TENNIS_ACCESS_CODE
+
+    user = update.effective_user
+
+    if not user or (ADMIN_ID and user.id != ADMIN_ID):
+        return
+
+    code = " ".join(context.args).strip()
+
+    if not code:
+        await update.effective_message.reply_text(
+            "Использование:\n/set_tennis_code 123456"
+        )
+        return
+
+    TENNIS_ACCESS_CODE = code
+    memory_store.set_setting("tennis_access_code", code)
+
+    await update.effective_message.reply_text(
+        f"🎾 Новый теннисный код:\n{code}"
+    )
+
+
+async def set_tennis_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global TENNIS_CODE_VALID_UNTIL
+
+    user = update.effective_user
+
+    if not user or (ADMIN_ID and user.id != ADMIN_ID):
+        return
+
+    expiry = " ".join(context.args).strip()
+
+    if not expiry:
+        await update.effective_message.reply_text(
+            "Использование:\n/set_tennis_expiry 20 августа 2026"
+        )
+        return
+
+    TENNIS_CODE_VALID_UNTIL = expiry
+    memory_store.set_setting("tennis_code_valid_until", expiry)
+
+    await update.effective_message.reply_text(
+        f"📅 Новая дата действия:\n{expiry}"
+    )
+
+
+async def spontaneous_now_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+        text = await generate_spontaneous_message(chat.id if chat else GROUP_CHAT_ID)
+        await update.effective_message.reply_text(text)
+
+    except Exception as e:
+        logger.error(f"Ошибка /spontaneous_now: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла сгенерировать мысль. Бывает.")
+
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        text = format_upcoming_jobs(context.job_queue)
+        await update.effective_message.reply_text(f"⏰ Запланированные задачи\n\n{text}"[:3900])
+
+    except Exception as e:
+        logger.error(f"Ошибка /jobs: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла показать задачи.")
+
+
+def format_memstats() -> str:
+    def kb(n: int) -> str:
+        return f"{n / 1024:.0f} КБ"
+
+    caches = [
+        ("Пользователи", user_cache),
+        ("Погода", weather_service.cache),
+        ("Википедия", wiki_service.summary_cache),
+        ("Вики-алиасы", wiki_service.aliases),
+    ]
+
+    lines = []
+    total = 0
+
+    for name, cache in caches:
+        cache.purge_expired()
+        budget = f" из {kb(cache.max_bytes)}" if cache.max_bytes else ""
+        lines.append(
+            f"{name}: {len(cache)}/{cache.maxsize} записей, ~{kb(cache.bytes)}{budget}, "
+            f"вытеснено {cache.evictions}"
+        )
+        total += cache.bytes
+
+    recent = duplicate_guard._recent
+    recent_bytes = approx_size(recent)
+    total += recent_bytes
+    lines.append(
+        f"Антиповтор: {len(recent)} чатов, {sum(len(d) for d in recent.values())} подписей, ~{kb(recent_bytes)}"
+    )
+
+    pending_bytes = approx_size(memory_store._pending_messages)
+    total += pending_bytes
+    lines.append(f"Несохранённые сообщения: {len(memory_store._pending_messages)}, ~{kb(pending_bytes)}")
+    lines.append(f"Очередь отправки: {len(outbound_queue)}")
+
+    lines.append(f"\nИтого по кешам: ~{kb(total)}")
+    return "\n".join(lines)
+
+
+async def memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        await update.effective_message.reply_text(f"🧮 Память процесса\n\n{format_memstats()}"[:3900])
+
+    except Exception as e:
+        logger.error(f"Ошибка /memstats: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла посчитать память.")
+
+
+PERF_SERIES_TITLES = {
+    "reply": "Ответы",
+    "sqlite": "SQLite",
+    "telegram": "Telegram",
+    "loop_lag": "Лаг event loop",
+}
+
+PERF_CACHE_TITLES = (
+    ("weather", "погода"),
+    ("wiki", "вики"),
+    ("users", "пользователи"),
+)
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} мс" if seconds < 0.01 else f"{seconds * 1000:.0f} мс"
+    return f"{seconds:.2f} с"
+
+
+def format_perf(now: Optional[float] = None) -> str:
+    now = time_module.monotonic() if now is None else now
+
+    series = sorted(
+        perf_stats.series,
+        key=lambda name: (list(PERF_SERIES_TITLES).index(name) if name in PERF_SERIES_TITLES else 0.5, name),
+    )
+    lines = []
+
+    for label, seconds in PERF_WINDOWS:
+        deltas, covered = perf_stats.deltas(seconds, now)
+        header = f"— {label} —"
+        if covered < seconds - PERF_SAMPLE_INTERVAL:
+            header += f" (с запуска, {covered / 60:.0f} мин)"
+        lines.append(header)
+
+        for name in series:
+            sketch = perf_stats.window(name, seconds, now)
+            if not sketch.count:
+                continue
+
+            title = PERF_SERIES_TITLES.get(name) or name.replace("deepseek:", "DeepSeek ")
+            lines.append(
+                f"{title}: p50 {_format_duration(sketch.quantile(0.5))}, "
+                f"p95 {_format_duration(sketch.quantile(0.95))}, "
+                f"p99 {_format_duration(sketch.quantile(0.99))} (n={sketch.count})"
+            )
+
+        lines.append(
+            f"Ошибки: апдейты {deltas['errors.updates']:.0f}, DeepSeek {deltas['errors.deepseek']:.0f}, "
+            f"отправка {deltas['errors.telegram']:.0f}, выброшено {deltas['errors.dropped']:.0f}"
+        )
+
+        rates = []
+        for key, title in PERF_CACHE_TITLES:
+            hits, misses = deltas[f"cache.{key}.hits"], deltas[f"cache.{key}.misses"]
+            lookups = hits + misses
+            rates.append(f"{title} {hits / lookups * 100:.0f}% из {lookups:.0f}" if lookups else f"{title} —")
+        lines.append("Кеши: " + ", ".join(rates))
+        lines.append(f"RSS за окно: {deltas['memory.rss'] / 1024 / 1024:+.1f} МБ")
+        lines.append("")
+
+    lines.append(
+        f"Очереди: отправка {len(outbound_queue)}, запись в SQLite {len(memory_store._pending_messages)}"
+    )
+    lines.append(f"RSS сейчас: {read_rss_bytes() / 1024 / 1024:.1f} МБ")
+    bins = sum(sketch.bin_count() for sketch in perf_stats.series.values())
+    lines.append(f"Корзин в скетчах: {bins}")
+    return "\n".join(lines)
+
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        await update.effective_message.reply_text(f"📈 Производительность\n\n{format_perf()}"[:3900])
+
+    except Exception as e:
+        logger.error(f"Ошибка /perf: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла собрать статистику.")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        action = context.args[0].lower() if context.args else ""
+        chat_id = update.effective_chat.id
+
+        if action == "start":
+            try:
+                seconds = int(context.args[1]) if len(context.args) > 1 else PROFILE_DEFAULT_SECONDS
+            except ValueError:
+                await update.effective_message.reply_text("Формат: /profile start [секунд]")
+                return
+
+            seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+            if not profiler.start(seconds):
+                await update.effective_message.reply_text("Профайлер уже запущен. Останови: /profile stop")
+                return
+
+            context.job_queue.run_once(
+                finish_profile_job, when=seconds, data={"chat_id": chat_id}, name="profile-stop"
+            )
+            logger.info(f"🔬 Профайлер запущен на {seconds} с")
+            await update.effective_message.reply_text(
+                f"🔬 Снимаю стеки раз в {PROFILE_INTERVAL * 1000:.0f} мс, {seconds} с. "
+                "Результат пришлю сюда, досрочно — /profile stop"
+            )
+            return
+
+        if action == "stop":
+            for job in context.job_queue.get_jobs_by_name("profile-stop"):
+                job.schedule_removal()
+
+            if profiler._thread is None:
+                await update.effective_message.reply_text("Профайлер не запущен.")
+                return
+
+            await deliver_profile(context.bot, chat_id)
+            return
+
+        state = "идёт сеанс" if profiler.active else "выключен"
+        await update.effective_message.reply_text(
+            f"🔬 Профайлер {state}.\n/profile start [секунд] — до {PROFILE_MAX_SECONDS} с\n/profile stop"
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка /profile: {e}", exc_info=True)
+        await update.effective_message.reply_text("Профайлер сломался.")
+
+
+async def heap_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        action = context.args[0].lower() if context.args else ""
+
+        if action == "start":
+            if not heap_tracker.start():
+                await update.effective_message.reply_text("tracemalloc уже включён. Снимок: /heap")
+                return
+
+            logger.info(f"🧠 tracemalloc включён, кадров: {HEAP_TRACE_FRAMES}")
+            await update.effective_message.reply_text(
+                "🧠 tracemalloc включён. Учитываются только новые аллокации; "
+                "/heap — снимок и сравнение с прошлым, /heap stop — выключить."
+            )
+            return
+
+        if action == "stop":
+            stopped = heap_tracker.stop()
+            await update.effective_message.reply_text(
+                "🧠 tracemalloc выключен." if stopped else "tracemalloc и так выключен."
+            )
+            return
+
+        if not heap_tracker.tracing:
+            await update.effective_message.reply_text(
+                f"tracemalloc выключен (RSS {read_rss_bytes() / 1024 / 1024:.1f} МБ). "
+                "Включить: /heap start"
+            )
+            return
+
+        text = await asyncio.to_thread(heap_tracker.report)
+        await update.effective_message.reply_text(f"🧠 Куча\n\n{text}"[:3900])
+
+    except Exception as e:
+        logger.error(f"Ошибка /heap: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла снять кучу.")
+
+
+async def dbstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        if context.args and context.args[0].lower() == "reset":
+            query_log.reset()
+            await update.effective_message.reply_text("🐌 Статистика запросов сброшена.")
+            return
+
+        memory_store.flush_ingest()
+        with memory_store._connect() as conn:
+            text = query_log.report(conn=conn)
+
+        await update.effective_message.reply_text(
+            f"🐌 SQL по суммарному времени (медленные от {SQL_SLOW_MS:.0f} мс)\n\n{text}"[:3900]
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка /dbstats: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла собрать статистику запросов.")
+
+
+# ========== BROADCAST ==========
+
+async def fan_out(
+    kind: str,
+    chat_ids: List[int],
+    send_one: Callable[[int], Any],
+    concurrency: int = BROADCAST_CONCURRENCY,
+    jitter: float = BROADCAST_JITTER_SECONDS,
+) -> Dict[str, int]:
+    """
+    Рассылает плановый пост по нескольким чатам.
+    Старт каждого чата сдвинут на случайную задержку в пределах jitter
+    (чем больше чатов, тем шире разброс), одновременно работает не больше
+    concurrency генераций, ошибка в одном чате не трогает остальные.
+    """
+    if not chat_ids:
+        return {"sent": 0, "failed": 0}
+
+    # На один чат разброс не нужен, дальше растёт примерно на 15 секунд за чат.
+    spread = 0.0 if len(chat_ids) == 1 else min(jitter, 15.0 * (len(chat_ids) - 1))
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    result = {"sent": 0, "failed": 0}
+    started = time_module.monotonic()
+
+    async def run(chat_id: int, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+
+        async with semaphore:
+            try:
+                await send_one(chat_id)
+                result["sent"] += 1
+            except Exception as e:
+                result["failed"] += 1
+                logger.error(f"Ошибка рассылки {kind} в чат {chat_id}: {e}", exc_info=True)
+
+    await asyncio.gather(*(run(chat_id, random.uniform(0, spread)) for chat_id in chat_ids))
+
+    logger.info(
+        f"📣 Рассылка {kind}: {result['sent']} из {len(chat_ids)} чатов, "
+        f"ошибок {result['failed']}, {time_module.monotonic() - started:.1f} с"
+    )
+    return result
+
+
+def _parse_broadcast_kinds(args: List[str]) -> Dict[str, bool]:
+    kinds = [a.lower() for a in args if a.lower() in BROADCAST_KINDS]
+    if not kinds:
+        kinds = ["morning", "evening", "spontaneous"]
+    return {kind: True for kind in kinds}
+
+
+async def broadcast_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+
+        if not chat:
+            return
+
+        kinds = _parse_broadcast_kinds(context.args or [])
+        memory_store.set_chat_schedule(chat.id, kinds)
+
+        await update.effective_message.reply_text(
+            f"📣 Этот чат теперь получает: {', '.join(kinds)}"
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка /broadcast_add: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла подключить рассылку.")
+
+
+async def broadcast_remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        chat = update.effective_chat
+
+        if not chat:
+            return
+
+        if context.args:
+            memory_store.set_chat_schedule(
+                chat.id,
+                {kind: False for kind in _parse_broadcast_kinds(context.args)},
+            )
+            await update.effective_message.reply_text("📣 Часть рассылок для этого чата выключена.")
+        else:
+            memory_store.remove_chat_schedule(chat.id)
+            await update.effective_message.reply_text("📣 Этот чат больше не получает плановые сообщения.")
+
+    except Exception as e:
+        logger.error(f"Ошибка /broadcast_remove: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла отключить рассылку.")
+
+
+async def broadcast_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+
+        if not user or (ADMIN_ID and user.id != ADMIN_ID):
+            await update.effective_message.reply_text("Эта команда только для администратора.")
+            return
+
+        rows = memory_store.list_chat_schedules()
+
+        if not rows:
+            await update.effective_message.reply_text("Плановых рассылок нет.")
+            return
+
+        lines = [
+            f"{chat_id}: {', '.join(k for k, on in kinds.items() if on) or '—'}"
+            for chat_id, kinds in rows
+        ]
+        await update.effective_message.reply_text(
+            f"📣 Чатов в рассылке: {len(rows)}\n\n" + "\n".join(lines)[:3800]
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка /broadcast_list: {e}", exc_info=True)
+        await update.effective_message.reply_text("Не смогла показать рассылки.")
+
+
+# ========== DAILY MESSAGES ==========
+
+async def send_morning_message(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        chat_ids = memory_store.get_broadcast_chats("morning")
+
+        if not chat_ids:
+            return
+
+        snapshot = get_context_snapshot()
+        moon = snapshot.moon
+        moon_text = snapshot.moon_phrase
+        moon_comment = get_moon_comment(moon)
+        # Свежая или чуть протухшая погода из кеша отдаётся без сети, старше — запрашивается.
+        weather_data = await weather_service.get_weather(HOME_WEATHER_QUERY)
+        weather_text = weather_data["full_text"] if weather_data else ""
+
+        async def send_one(chat_id: int):
+            chat_context = memory_store.get_chat_context_text(chat_id, limit=10)
+
+            prompt = f"""
+Создай короткое утреннее сообщение для общего Telegram-чата.
+
+Контекст:
+- Сейчас утро в Брисбене.
+- {moon_text}
+- Комментарий к Луне: {moon_comment}
+- Погода: {weather_text}
+- Недавний контекст чата: {chat_context or "мало контекста"}
+
+Стиль:
+- Лейла, русскоязычная женщина средних лет из Брисбена.
+- Весело, саркастично, но тепло.
+- Обращение ко всем, не к одному человеку.
+- Максим может быть упомянут только если очень к месту, но лучше не фокусироваться на нём.
+- 3-5 предложений.
+- 1-3 эмодзи.
+- Не звучать как гороскоп из дешёвой газеты.
+- Не повторять одни и те же шутки про кофе.
+""".strip()
+
+            messages = [
+                {"role": "system", "content": "Ты — Лейла. Пиши как живой участник общего чата."},
+                {"role": "user", "content": prompt},
+            ]
+
+            model_config = {
+                "model": DEEPSEEK_MODELS["chat"],
+                "temperature": 0.82,
+                "max_tokens": 240,
+                "require_reasoning": False,
+            }
+
+            answer = await generate_unique_text(
+                messages,
+                model_config,
+                kind="morning",
+                chat_id=chat_id,
+            )
+
+            fallback = (
+                f"Доброе утро, народ ☕\n\n"
+                f"{moon_text}\n"
+                f"{moon_comment}\n\n"
+                f"День можно начинать. Осторожно, без героизма."
+            )
+
+            text = clean_response(answer or fallback)
+
+            await send_text(context.bot, chat_id, text, priority=PRIORITY_BROADCAST)
+
+        await fan_out("morning", chat_ids, send_one)
+
+    except Exception as e:
+        logger.error(f"Ошибка утреннего сообщения: {e}", exc_info=True)
+
+    finally:
+        schedule_next_morning(context.job_queue)
+
+
+async def send_evening_message(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        chat_ids = memory_store.get_broadcast_chats("evening")
+
+        if not chat_ids:
+            return
+
+        snapshot = get_context_snapshot()
+        moon = snapshot.moon
+        moon_text = snapshot.moon_phrase
+        moon_comment = get_moon_comment(moon)
+
+        async def send_one(chat_id: int):
+            chat_context = memory_store.get_chat_context_text(chat_id, limit=10)
+
+            prompt = f"""
+Создай короткое вечернее сообщение для общего Telegram-чата.
+
+Контекст:
+- Сейчас вечер в Брисбене.
+- {moon_text}
+- Комментарий к Луне: {moon_comment}
+- Недавний контекст чата: {chat_context or "мало контекста"}
+
+Стиль:
+- Лейла, русскоязычная женщина средних лет из Брисбена.
+- Тёпло, саркастично, немного чёрного юмора.
+- Обращение ко всем.
+- Не фокусироваться на Максиме.
+- Можно слегка пошутить про усталость, жизнь и людей.
+- 2-4 предложения.
+- 0-2 эмодзи.
+- Не повторять вчерашние формулировки.
+""".strip()
+
+            messages = [
+                {"role": "system", "content": "Ты — Лейла. Пиши как живой участник общего чата."},
+                {"role": "user", "content": prompt},
+            ]
+
+            model_config = {
+                "model": DEEPSEEK_MODELS["chat"],
+                "temperature": 0.88,
+                "max_tokens": 220,
+                "require_reasoning": False,
+            }
+
+            answer = await generate_unique_text(
+                messages,
+                model_config,
+                kind="evening",
+                chat_id=chat_id,
+            )
+
+            fallback = (
+                f"{moon['emoji']} День официально закончен.\n\n"
+                f"{moon_comment}\n"
+                f"Кто сегодня устал — тот хотя бы честен.\n\n"
+                f"Спокойной ночи всем."
+            )
+
+            text = clean_response(answer or fallback)
+
+            await send_text(context.bot, chat_id, text, priority=PRIORITY_BROADCAST)
+
+        await fan_out("evening", chat_ids, send_one)
+
+    except Exception as e:
+        logger.error(f"Ошибка вечернего сообщения: {e}", exc_info=True)
+
+    finally:
+        schedule_next_evening(context.job_queue)
+
+
+async def send_friday_tennis_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_ids = memory_store.get_broadcast_chats("tennis")
+
+    if not chat_ids:
+        return
+
+    message = (
+        "🎾 *Пятничный теннис!*\n\n"
+        "Время: 16:30\n"
+        f"Код доступа: `{TENNIS_ACCESS_CODE}`\n"
+        f"Действует до: {TENNIS_CODE_VALID_UNTIL}\n\n"
+        "Увидимся на кортах! 😊"
+    )
+
+    async def send_one(chat_id: int):
+        try:
+            await send_text(
+                context.bot,
+                chat_id,
+                message,
+                priority=PRIORITY_BROADCAST,
+                parse_mode="Markdown",
+            )
+
+        except Exception as e:
+            logger.error(f"Ошибка теннисного напоминания в {chat_id}: {e}", exc_info=True)
+
+            await send_text(
+                context.bot,
+                chat_id,
+                f"🎾 Теннис в 16:30! Код: {TENNIS_ACCESS_CODE}",
+                priority=PRIORITY_BROADCAST,
+            )
+
+    # Напоминание без генерации — разброс по времени ему не нужен.
+    await fan_out("tennis", chat_ids, send_one, jitter=min(30.0, BROADCAST_JITTER_SECONDS))
+
+
+# ========== INGEST FLUSH ==========
+
+async def flush_ingest_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        memory_store.flush_ingest()
+    except Exception as e:
+        logger.error(f"Ошибка записи пачки сообщений: {e}", exc_info=True)
+
+
+# ========== PERF SAMPLING ==========
+
+async def perf_sample_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        perf_stats.sample()
+    except Exception as e:
+        logger.error(f"Ошибка снимка счётчиков /perf: {e}", exc_info=True)
+
+
+# ========== WEATHER PREFETCH ==========
+
+async def refresh_weather_cache(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        targets = weather_service.prefetch_targets(HOME_WEATHER_QUERY, WEATHER_PREFETCH_TOP)
+        await weather_service.refresh(targets)
+        logger.info(f"🌦️ Погода обновлена в фоне: {', '.join(q for _, q in targets)}")
+
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления погоды: {e}", exc_info=True)
+
+
+# ========== RANDOM SCHEDULING ==========
+
+def random_time_between(start_hour: int, start_minute: int, end_hour: int, end_minute: int) -> time:
+    start_total = start_hour * 60 + start_minute
+    end_total = end_hour * 60 + end_minute
+    picked = random.randint(start_total, end_total)
+
+    return time(hour=picked // 60, minute=picked % 60)
+
+
+def schedule_once_at_local_time(job_queue, callback, target_time: time, name: str):
+    tz = get_tz()
+    now = datetime.now(tz)
+
+    target = tz.localize(
+        datetime.combine(now.date(), target_time.replace(tzinfo=None))
+    )
+
+    if target <= now:
+        target = target + timedelta(days=1)
+
+    schedule_durable(job_queue, callback, target, name)
+
+    logger.info(f"⏰ Запланировано {name}: {target.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+
+
+def schedule_next_morning(job_queue):
+    target_time = random_time_between(7, 0, 9, 0)
+    schedule_once_at_local_time(job_queue, send_morning_message, target_time, "random-morning")
+
+
+def schedule_next_evening(job_queue):
+    target_time = random_time_between(20, 0, 21, 30)
+    schedule_once_at_local_time(job_queue, send_evening_message, target_time, "random-evening")
+
+
+# ========== DELAYED FOLLOWUPS ==========
+
+async def delayed_followup(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data
+
+    try:
+        chat_context = memory_store.get_chat_context_text(data["chat_id"], limit=8)
+
+        prompt = f"""
+Напиши короткий delayed follow-up от Лейлы в Telegram-чате.
+
+Контекст:
+{chat_context or "мало контекста"}
+
+Правила:
+- 1 короткое предложение.
+- Выглядит так, будто Лейла через время вспомнила прошлое сообщение.
+- Не повторяй одну и ту же фразу.
+- Не будь слишком странной.
+- Русский язык.
+""".strip()
+
+        messages = [
+            {"role": "system", "content": "Ты — Лейла. Пиши коротко и естественно."},
+            {"role": "user", "content": prompt},
+        ]
+
+        model_config = {
+            "model": DEEPSEEK_MODELS["chat"],
+            "temperature": 0.95,
+            "max_tokens": 80,
+            "require_reasoning": False,
+        }
+
+        text = await generate_unique_text(
+            messages,
+            model_config,
+            kind="followup",
+            chat_id=data["chat_id"],
+        )
+
+        if not text:
+            text = random.choice([
+                "Я только сейчас поняла насколько это было странно.",
+                "Кстати… я всё ещё думаю об этом сообщении.",
+                "Ладно, перечитала ещё раз.",
+                "Это было сильнее, чем я сначала подумала.",
+            ])
+
+        await send_text(
+            context.bot,
+            data["chat_id"],
+            text,
+            priority=PRIORITY_FOLLOWUP,
+            reply_to_message_id=data["message_id"],
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка delayed followup: {e}")
+
+
+def maybe_schedule_followup(context, chat_id, message_id):
+    now_hour = datetime.now(get_tz()).hour
+
+    if 1 <= now_hour <= 8:
+        return
+
+    if random.random() < 0.035:
+        delay = random.randint(180, 2400)
+
+        schedule_durable(
+            context.job_queue,
+            delayed_followup,
+            datetime.now(pytz.UTC) + timedelta(seconds=delay),
+            f"followup:{chat_id}:{message_id}",
+            data={
+                "chat_id": chat_id,
+                "message_id": message_id,
+            },
+        )
+
+
+# ========== SPONTANEOUS SCHEDULING ==========
+
+async def spontaneous_chat_message(context: ContextTypes.DEFAULT_TYPE):
+    if not SPONTANEOUS_MESSAGE_ENABLED:
+        return
+
+    try:
+        chat_ids = memory_store.get_broadcast_chats("spontaneous")
+
+        async def send_one(chat_id: int):
+            text = await generate_spontaneous_message(chat_id)
+
+            await send_text(context.bot, chat_id, text, priority=PRIORITY_BROADCAST)
+
+        if chat_ids:
+            await fan_out("spontaneous", chat_ids, send_one)
+
+    except Exception as e:
+        logger.error(f"Ошибка spontaneous message: {e}", exc_info=True)
+
+    finally:
+        schedule_spontaneous_message(context.job_queue)
+
+
+def schedule_spontaneous_message(job_queue):
+    if not SPONTANEOUS_MESSAGE_ENABLED:
+        logger.info("Спонтанные сообщения отключены")
+        return
 
+    target_time = random_time_between(SPONTANEOUS_MIN_HOUR, 0, SPONTANEOUS_MAX_HOUR, 30)
 
-def extract_topics_and_facts(user_info: UserInfo, text: str):
-    text_lower = text.lower()
+    schedule_once_at_local_time(
+        job_queue,
+        spontaneous_chat_message,
+        target_time,
+        "spontaneous-message",
+    )
 
-    topic_keywords = {
-        "работа": ["работа", "проект", "задача", "офис", "коллег"],
-        "еда": ["еда", "ужин", "обед", "рецепт", "готов"],
-        "погода": ["погода", "дождь", "жара", "холод", "температура"],
-        "спорт": ["теннис", "спорт", "зал", "тренировка", "игра"],
-        "здоровье": ["болит", "врач", "здоровье", "простуда", "самочувствие"],
-        "отношения": ["друз", "семья", "отношен", "муж", "жена", "девушка"],
-        "развлечения": ["фильм", "сериал", "музыка", "книга", "игра"],
-    }
 
-    for topic, words in topic_keywords.items():
-        if any(w in text_lower for w in words):
-            memory_store.add_user_topic(user_info.id, topic)
-
-    fact_patterns = [
-        r"меня зовут\s+([а-яa-zё\-]+)",
-        r"я люблю\s+(.+?)(?:\.|,|$)",
-        r"мне нравится\s+(.+?)(?:\.|,|$)",
-        r"я не люблю\s+(.+?)(?:\.|,|$)",
-        r"мне не нравится\s+(.+?)(?:\.|,|$)",
-        r"я работаю\s+(.+?)(?:\.|,|$)",
-    ]
+# ========== DURABLE JOBS ==========
 
-    for pattern in fact_patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            fact = match.group(0).strip()
-            if 4 < len(fact) < 160:
-                memory_store.add_user_fact(user_info.id, fact)
+# Сколько секунд после пропущенного срока задачу ещё имеет смысл выполнить.
+# Всё, что опоздало сильнее, при рестарте выбрасывается.
+DURABLE_JOB_GRACE = {
+    "send_morning_message": 20 * 60,
+    "send_evening_message": 20 * 60,
+    "spontaneous_chat_message": 30 * 60,
+    "delayed_followup": 15 * 60,
+}
 
 
-def clean_response(text: str) -> str:
-    text = text.strip()
-    text = re.sub(r"\s+", " ", text).strip()
+def _durable_callbacks() -> Dict[str, Callable]:
+    return {
+        "send_morning_message": send_morning_message,
+        "send_evening_message": send_evening_message,
+        "spontaneous_chat_message": spontaneous_chat_message,
+        "delayed_followup": delayed_followup,
+    }
 
-    bad_prefixes = [
-        "Как AI",
-        "Я как искусственный интеллект",
-        "Как языковая модель",
-        "As an AI",
-        "As a language model",
-    ]
 
-    for prefix in bad_prefixes:
-        if text.lower().startswith(prefix.lower()):
-            text = text[len(prefix):].strip(" ,.-:")
+def _durable(callback: Callable, due_at: float) -> Callable:
+    async def run(context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await callback(context)
+        finally:
+            # Удаляем только свою запись: callback мог уже перепланировать себя под тем же именем.
+            memory_store.delete_job(context.job.name, due_at)
+
+    run.__name__ = callback.__name__
+    return run
+
+
+def schedule_durable(
+    job_queue,
+    callback: Callable,
+    when: datetime,
+    name: str,
+    data: Optional[Dict[str, Any]] = None,
+):
+    """Планирует задачу в JobQueue и записывает её в SQLite, чтобы она пережила рестарт."""
+    for job in job_queue.jobs():
+        if job.name == name:
+            job.schedule_removal()
 
-    return text
+    due_at = when.timestamp()
+    delay = max(1.0, due_at - datetime.now(pytz.UTC).timestamp())
 
+    memory_store.save_job(name, callback.__name__, due_at, data)
+    job_queue.run_once(_durable(callback, due_at), when=delay, name=name, data=data)
 
-def maybe_add_maxim_context() -> str:
-    if not MAXIM_ID:
-        return ""
 
-    return """
-Иногда в чате могут слегка шутить про Максима.
+def restore_durable_jobs(job_queue) -> set:
+    """
+    Поднимает сохранённые задачи после рестарта.
+    Будущие планируются как были; пропущенные выполняются, если опоздали не больше
+    DURABLE_JOB_GRACE, причём из нескольких пропущенных одного вида в одном чате
+    остаётся только последняя. Остальное удаляется.
+    """
+    callbacks = _durable_callbacks()
+    now = datetime.now(pytz.UTC).timestamp()
+    restored = set()
+    missed: Dict[Tuple[str, Any], Tuple[str, float, Optional[Dict[str, Any]]]] = {}
 
-Это редкий локальный мем, а не главная тема.
+    for name, callback_name, due_at, data in memory_store.list_jobs():
+        callback = callbacks.get(callback_name)
 
-Иногда можно мягко упомянуть:
-- что он любит звучать уверенно;
-- что может менять мнение;
-- что иногда ленится;
-- что иногда делает вид будто уже всё понял про жизнь.
+        if callback is None:
+            memory_store.delete_job(name)
+            continue
 
-Но:
-- не делай это часто;
-- не фокусируйся на Максиме;
-- не превращай это в травлю;
-- не упоминай его без причины.
-"""
+        if due_at > now:
+            job_queue.run_once(_durable(callback, due_at), when=due_at - now, name=name, data=data)
+            restored.add(name)
+            continue
 
+        if now - due_at > DURABLE_JOB_GRACE.get(callback_name, 0):
+            memory_store.delete_job(name)
+            continue
 
-def generate_system_prompt(
-    user_info: UserInfo,
-    model_config: Dict[str, Any],
-    mood: str,
-    chat_context: str,
-    user_profile: str,
-) -> str:
-    australian_context = get_australian_context()
+        group = (callback_name, (data or {}).get("chat_id"))
+        previous = missed.get(group)
 
-    return f"""
-Ты — Лейла.
+        if previous and previous[1] >= due_at:
+            memory_store.delete_job(name)
+            continue
 
-Ты русскоязычная женщина средних лет из Брисбена, Австралия.
-Ты давно сидишь в этом Telegram-чате и ведёшь себя как обычный участник компании, а не как помощник.
+        if previous:
+            memory_store.delete_job(previous[0])
 
-{australian_context}
+        missed[group] = (name, due_at, data)
 
-Твоё текущее настроение: {mood}
+    for (callback_name, _), (name, due_at, data) in missed.items():
+        job_queue.run_once(
+            _durable(callbacks[callback_name], due_at),
+            when=random.uniform(5, 30),
+            name=name,
+            data=data,
+        )
+        restored.add(name)
 
-Характер:
-- весёлая;
-- саркастичная;
-- наблюдательная;
-- немного ленивая;
-- с лёгким чёрным юмором;
-- иногда язвительная, но не злая;
-- умеешь подколоть, но не унижаешь;
-- не пытаешься быть идеальной.
+    logger.info(f"⏰ Восстановлено задач из SQLite: {len(restored)} (пропущенных выполняется: {len(missed)})")
+    return restored
 
-Стиль:
-- отвечай естественно, как человек в чате;
-- обычно 1-4 предложения;
-- иногда очень коротко;
-- не пиши лекции, если тебя прямо не попросили;
-- не объясняй, что ты бот;
-- не называй себя AI;
-- не упоминай погоду без явного вопроса;
-- можешь использовать 0-2 эмодзи;
-- иногда можно ответить сухо, лениво или с сарказмом;
-- не используй случайные абсурдные образы повторно;
-- не зацикливайся на одной шутке;
-- не придумывай постоянные мемы без причины;
-- говори естественно, как обычный человек;
-- избегай сюрреалистичных сравнений;
-- иногда можешь проигнорировать часть сообщения;
-- не всегда старайся помочь;
-- не веди себя как ассистент;
-- иногда можешь отвечать как человек, который устал читать чат.
 
-{maybe_add_maxim_context()}
+def format_upcoming_jobs(job_queue, limit: int = 20) -> str:
+    tz = get_tz()
+    now = datetime.now(pytz.UTC)
+    lines = []
 
-Профиль текущего пользователя:
-{user_profile or "Нет сохранённых деталей."}
+    durable = memory_store.list_jobs()
 
-Память и контекст общего чата:
-{chat_context or "Пока мало контекста."}
-""".strip()
+    for name, callback_name, due_at, data in durable[:limit]:
+        due = datetime.fromtimestamp(due_at, tz)
+        left = max(0, int(due_at - now.timestamp()))
+        lines.append(f"💾 {name} — {due.strftime('%d.%m %H:%M')} (через {left // 3600}ч {left % 3600 // 60}м)")
 
+    durable_names = {row[0] for row in durable}
 
-async def generate_leila_response(
-    user_message: str,
-    user_info: UserInfo,
-    chat_id: int,
-    force_short: bool = False,
-) -> str:
-    if not client:
-        return "Я бы что-то сказала, но мой мозг сейчас лежит отдельно от тела."
+    for job in job_queue.jobs():
+        if job.name in durable_names or not job.next_t:
+            continue
+        due = job.next_t.astimezone(tz)
+        lines.append(f"🔁 {job.name} — {due.strftime('%d.%m %H:%M')}")
 
-    weather_response = await handle_weather_query(user_message)
+    return "\n".join(lines) if lines else "Ничего не запланировано."
 
-    if weather_response:
-        return weather_response
 
-    model_config = analyze_query_complexity(user_message)
+# ========== HANDLER ==========
 
-    maybe_change_leila_state()
+async def humanized_pause(seconds: float):
+    """Пауза «как будто печатает». Отдельной функцией, чтобы офлайн-прогон мог подменить часы."""
+    await asyncio.sleep(seconds)
 
-    energy = CURRENT_LEILA_STATE["energy"]
 
-    if force_short and random.random() > max(0.45, energy):
-        return random.choice(MICRO_REPLIES)
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    msg = update.effective_message
+    chat = update.effective_chat
+    user = update.effective_user
 
-    if force_short:
-        model_config["max_tokens"] = 80
-        model_config["temperature"] = 0.85
+    if not msg or not chat or not user:
+        return
 
-    mood = CURRENT_LEILA_STATE["mood"]
-    chat_context = memory_store.get_chat_context_text(chat_id)
-    user_profile = memory_store.get_user_profile_text(user_info.id)
-
-    system_prompt = generate_system_prompt(
-        user_info=user_info,
-        model_config=model_config,
-        mood=mood,
-        chat_context=chat_context,
-        user_profile=user_profile,
-    )
+    text = (msg.text or "").strip()
 
-    messages: List[Dict[str, str]] = [
-        {"role": "system", "content": system_prompt},
-        {
-            "role": "user",
-            "content": f"{user_info.get_display_name()} написал(а): {user_message}",
-        },
-    ]
+    if not text:
+        return
 
-    answer = await call_deepseek(messages, model_config)
+    started = time_module.perf_counter()
+    outcome = "ignored"
+    trace, trace_token = start_trace(update.update_id, chat.id)
 
-    if not answer:
-        answer = random.choice([
-            "Я сейчас сделаю вид, что этого не видела.",
-            "Мозг завис. Перезагружусь сарказмом.",
-            "Хорошо. Но вопросов стало больше.",
-        ])
+    try:
+        with span("user"):
+            user_info = await get_or_create_user_info(update)
 
-    return clean_response(answer)
+        with span("analyze"):
+            signals = text_analyzer.analyze(text)
+            topics, facts = extract_topics_and_facts(text, signals)
 
+        memory_store.queue_message(
+            chat_id=chat.id,
+            user_id=user.id,
+            role="user",
+            name=user_info.get_display_name(),
+            content=text,
+            topics=topics,
+            facts=facts,
+        )
 
-# ========== GENERATED SPONTANEOUS MESSAGES ==========
+        # Private chat — always answer.
+        if chat.type == "private":
+            should_respond = True
+            is_direct_address = True
+        else:
+            bot_username = (context.bot.username or "").lower()
 
-async def generate_spontaneous_message() -> str:
-    """
-    Генерирует свежее случайное сообщение Лейлы.
-    Старые canned messages больше не ротируются.
-    Они остались только как fallback, если DeepSeek недоступен.
-    """
-    if not client:
-        return random.choice(SPONTANEOUS_FALLBACK_MESSAGES)
+            mentioned_by_name = signals.mentions_leila
+            mentioned_by_username = bool(bot_username) and f"@{bot_username}" in text.lower()
 
-    maybe_change_leila_state()
+            is_reply_to_bot = False
 
-    tz = get_tz()
-    now_local = datetime.now(tz)
-    season, season_info = get_current_season()
-    time_of_day, _ = get_time_of_day(now_local)
+            if msg.reply_to_message and msg.reply_to_message.from_user:
+                # context.bot.id берётся из getMe, сделанного при старте, без запроса в сеть.
+                is_reply_to_bot = msg.reply_to_message.from_user.id == context.bot.id
 
-    mood = CURRENT_LEILA_STATE["mood"]
-    energy = CURRENT_LEILA_STATE["energy"]
+            is_direct_address = mentioned_by_name or mentioned_by_username or is_reply_to_bot
 
-    chat_context = memory_store.get_chat_context_text(GROUP_CHAT_ID, limit=16)
-    recent_spontaneous = memory_store.get_recent_spontaneous_messages()
+            if is_direct_address:
+                should_respond = True
+            else:
+                should_respond = random.random() < RANDOM_GROUP_REPLY_RATE
 
-    prompt = f"""
-Создай ОДНО спонтанное сообщение от Лейлы в общий Telegram-чат.
+        if not should_respond:
+            return
 
-Это не ответ конкретному человеку.
-Это должна быть короткая мысль, которую живой участник чата мог внезапно написать сам по себе.
+        force_short = chat.type in ("group", "supergroup") and not is_direct_address
 
-Контекст:
-- Сейчас {now_local.strftime('%H:%M')} в Брисбене.
-- Сейчас {time_of_day}.
-- Сезон: {season} ({season_info.get('description', '')}).
-- Настроение Лейлы: {mood}.
-- Энергия Лейлы: {energy}.
+        try:
+            with span("typing"):
+                await context.bot.send_chat_action(chat_id=chat.id, action=ChatAction.TYPING)
+        except Exception:
+            pass
 
-Недавний контекст чата:
-{chat_context or "Пока мало свежего контекста."}
+        with span("sleep"):
+            if chat.type in ("group", "supergroup"):
+                await humanized_pause(random.uniform(1.5, 7.0))
+            else:
+                await humanized_pause(random.uniform(0.5, 2.0))
 
-Последние спонтанные сообщения Лейлы, которые нельзя повторять и нельзя перефразировать близко:
-{json.dumps(recent_spontaneous[-12:], ensure_ascii=False, indent=2)}
+        with span("generate"):
+            reply = await generate_leila_response(
+                user_message=text,
+                user_info=user_info,
+                chat_id=chat.id,
+                force_short=force_short,
+                signals=signals,
+            )
 
-Запрещённые старые canned-темы:
-- человечеству нельзя давать интернет до кофе;
-- чат держится на сарказме и случайности;
-- не каждый спор стоит давления;
-- лучший план — лечь спать;
-- уровень взрослости человечества под вопросом.
+        if force_short:
+            words = reply.split()
+            if len(words) > 28:
+                reply = " ".join(words[:24]) + "..."
 
-Правила:
-- 1-3 коротких предложения.
-- Русский язык.
-- Разговорный стиль.
-- Лёгкий сарказм можно, но без однотипной философии.
-- Не здоровайся.
-- Не пиши объявление.
-- Не задавай вопрос каждый раз.
-- Не упоминай, что ты бот, AI или помощник.
-- Не обращайся к конкретному человеку напрямую.
-- Не цитируй сообщения из чата.
-- Не упоминай погоду, Луну или Максима без естественной причины.
-- Сообщение должно выглядеть так, будто Лейла молча читала чат и внезапно решила вставить мысль.
-""".strip()
+        memory_store.add_message(
+            chat_id=chat.id,
+            user_id=0,
+            role="assistant",
+            name="Лейла",
+            content=reply,
+        )
 
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                "Ты — Лейла. Пиши как живой участник Telegram-чата: "
-                "коротко, естественно, саркастично, без ассистентского тона."
-            ),
-        },
-        {"role": "user", "content": prompt},
-    ]
+        reply_as_thread = False
 
-    model_config = {
-        "model": DEEPSEEK_MODELS["chat"],
-        "temperature": 1.08,
-        "max_tokens": 120,
-        "require_reasoning": False,
-    }
+        if chat.type in ("group", "supergroup"):
+            reply_as_thread = random.random() < 0.55
+
+        # Не ждём доставки: пока бакет группы копит токены, остальные апдейты
+        # обрабатываются дальше. Время отправки попадает в метрики очереди.
+        with span("send"):
+            if reply_as_thread:
+                post_text(
+                    context.bot,
+                    chat.id,
+                    reply,
+                    reply_to_message_id=msg.message_id,
+                )
+            else:
+                post_text(context.bot, chat.id, reply)
+
+        outcome = "replied"
+
+        maybe_schedule_followup(
+            context,
+            chat.id,
+            msg.message_id,
+        )
 
-    answer = await call_deepseek(messages, model_config)
-    text = clean_response(answer or "")
+    except Exception as e:
+        outcome = "error"
+        logger.error(f"Ошибка обработки сообщения: {e}", exc_info=True)
 
-    if not text:
-        text = random.choice(SPONTANEOUS_FALLBACK_MESSAGES)
+        try:
+            post_text(
+                context.bot,
+                chat.id,
+                "Что-то пошло не так. Даже у меня бывают дни.",
+            )
+        except Exception:
+            pass
 
-    # Защита от слишком длинных простыней
-    words = text.split()
-    if len(words) > 45:
-        text = " ".join(words[:42]) + "..."
+    finally:
+        elapsed = time_module.perf_counter() - started
+        HANDLE_SECONDS.labels(outcome).observe(elapsed)
+        UPDATES_TOTAL.labels(outcome).inc()
+        if outcome == "replied":
+            perf_stats.observe("reply", elapsed)
+        finish_trace(trace, trace_token, outcome)
 
-    memory_store.remember_spontaneous_message(text)
-    return text
 
+# ========== METRICS ENDPOINT ==========
 
-# ========== COMMANDS ==========
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+def read_rss_bytes() -> int:
+    """Текущий RSS из /proc (Linux, как на Fly); где /proc нет — 0."""
     try:
-        user_info = await get_or_create_user_info(update)
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
 
-        greetings = [
-            f"{user_info.get_display_name()}, привет. Я Лейла. Да, та самая.",
-            "Лейла на связи. Паниковать пока рано.",
-            "Привет. Я тут, наблюдаю и иногда осуждаю.",
-        ]
 
-        await update.effective_message.reply_text(random.choice(greetings))
+def read_tracemalloc_bytes() -> int:
+    # tracemalloc грузим, только если его уже кто-то включил (/heap или PYTHONTRACEMALLOC).
+    module = sys.modules.get("tracemalloc")
+    if module is None or not module.is_tracing():
+        return 0
+    return module.get_traced_memory()[0]
 
-    except Exception as e:
-        logger.error(f"Ошибка /start: {e}", exc_info=True)
-        await update.effective_message.reply_text("Привет. Я Лейла.")
 
+def register_runtime_gauges():
+    QUEUE_DEPTH.set_function(lambda: len(outbound_queue), "outbound")
+    QUEUE_DEPTH.set_function(lambda: len(memory_store._pending_messages), "ingest")
 
-async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        args = context.args
-        city = " ".join(args) if args else "Брисбен"
+    caches = {
+        "users": user_cache,
+        "weather": weather_service.cache,
+        "wiki": wiki_service.summary_cache,
+        "wiki_aliases": wiki_service.aliases,
+    }
 
-        weather_response = await handle_weather_query(f"погода {city}")
+    for name, cache in caches.items():
+        CACHE_ENTRIES.set_function(cache.__len__, name)
+        CACHE_BYTES.set_function(lambda cache=cache: cache.bytes, name)
 
-        if weather_response:
-            await update.effective_message.reply_text(weather_response)
-        else:
-            await update.effective_message.reply_text("Погоду не достала. Видимо, она тоже спряталась.")
+    PROCESS_RSS_BYTES.set_function(read_rss_bytes)
+    PYTHON_HEAP_BLOCKS.set_function(sys.getallocatedblocks)
+    TRACEMALLOC_BYTES.set_function(read_tracemalloc_bytes)
 
-    except Exception as e:
-        logger.error(f"Ошибка /weather: {e}", exc_info=True)
-        await update.effective_message.reply_text("Не смогла получить погоду.")
 
+register_runtime_gauges()
 
-async def wiki_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        args = context.args
 
-        if not args:
-            await update.effective_message.reply_text("Напиши запрос после /wiki. Например: /wiki кошки")
-            return
+def register_perf_counters():
+    perf_stats.track("errors.updates", lambda: UPDATES_TOTAL.labels("error").value)
+    perf_stats.track("errors.deepseek", lambda: DEEPSEEK_REQUESTS.total(status="ok"))
+    # Только окончательные ошибки: повторы не ошибка, а исчерпанные повторы и
+    # переполнение уже в dropped.
+    perf_stats.track("errors.telegram", lambda: outbound_queue.stats["failed"])
+    perf_stats.track("errors.dropped", lambda: outbound_queue.stats["dropped"])
 
-        query = " ".join(args)
-        result = await wiki_service.search_wikipedia(query, sentences=5)
+    weather = weather_service.stats
+    wiki = wiki_service.stats
+    perf_stats.track("cache.weather.hits", lambda: weather["hits"] + weather["stale_hits"])
+    perf_stats.track("cache.weather.misses", lambda: weather["misses"])
+    perf_stats.track("cache.wiki.hits", lambda: wiki["memory_hits"] + wiki["disk_hits"])
+    perf_stats.track("cache.wiki.misses", lambda: wiki["misses"])
 
-        if not result:
-            await update.effective_message.reply_text(f"Не нашла ничего по '{query}'. Даже Википедия устала.")
-            return
+    perf_stats.track("cache.users.hits", lambda: user_cache.hits)
+    perf_stats.track("cache.users.misses", lambda: user_cache.misses)
 
-        summary, title, url = result
-        response = f"📚 {title}\n\n{summary}\n\n{url}"
+    # Рост памяти за окно — снимается тем же perf-sample раз в минуту.
+    perf_stats.track("memory.rss", read_rss_bytes)
 
-        if len(response) > 4000:
-            await update.effective_message.reply_text(response[:4000], disable_web_page_preview=True)
-            await update.effective_message.reply_text(response[4000:], disable_web_page_preview=True)
-        else:
-            await update.effective_message.reply_text(response, disable_web_page_preview=True)
 
-    except Exception as e:
-        logger.error(f"Ошибка /wiki: {e}", exc_info=True)
-        await update.effective_message.reply_text("Ошибка при поиске в Википедии.")
+register_perf_counters()
 
+_metrics_server: Optional[asyncio.AbstractServer] = None
 
-async def moon_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP/1.0: GET /metrics, всё остальное — 404."""
     try:
-        tz = get_tz()
-        now_local = datetime.now(tz)
-        moon = get_moon_phase(now_local)
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
 
-        msg = (
-            f"Сегодня в {BOT_LOCATION['city']}е:\n"
-            f"{format_moon_phrase(moon)}\n"
-            f"Возраст: {moon['age_days']} суток"
-        )
+        while True:
+            header = await asyncio.wait_for(reader.readline(), timeout=5)
+            if header in (b"\r\n", b"\n", b""):
+                break
 
-        await update.effective_message.reply_text(msg)
+        parts = request_line.split()
+        path = parts[1].decode("latin-1") if len(parts) > 1 else ""
 
-    except Exception as e:
-        logger.error(f"Ошибка /moon: {e}", exc_info=True)
-        await update.effective_message.reply_text("Не смогла посчитать фазу Луны 😔")
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
 
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
 
-async def reset_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        user = update.effective_user
+    except Exception:
+        pass
 
-        if not user or (ADMIN_ID and user.id != ADMIN_ID):
-            await update.effective_message.reply_text("Эта команда только для администратора.")
-            return
+    finally:
+        writer.close()
 
-        chat = update.effective_chat
 
-        if not chat:
-            return
+async def start_metrics_server():
+    global _metrics_server
 
-        memory_store.reset_chat_memory(chat.id)
-        await update.effective_message.reply_text("✅ Память этого чата сброшена.")
+    if not METRICS_PORT or _metrics_server is not None:
+        return
 
-    except Exception as e:
-        logger.error(f"Ошибка /reset_memory: {e}", exc_info=True)
-        await update.effective_message.reply_text("Ошибка сброса памяти.")
+    try:
+        _metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.warning(f"📈 Не удалось поднять порт метрик {METRICS_PORT}: {e}")
 
 
-async def show_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        user = update.effective_user
+async def stop_metrics_server():
+    global _metrics_server
 
-        if not user or (ADMIN_ID and user.id != ADMIN_ID):
-            await update.effective_message.reply_text("Эта команда только для администратора.")
-            return
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
 
-        chat = update.effective_chat
 
-        if not chat:
-            return
+# ========== LOOP WATCHDOG ==========
 
-        stats = memory_store.get_memory_stats(chat.id)
-        context_text = memory_store.get_chat_context_text(chat.id)
-        recent_spontaneous = memory_store.get_recent_spontaneous_messages()
+# Лаг event loop меряем всегда. В отладочном режиме (LOOP_BLOCK_DEBUG=1)
+# отдельный поток ловит стек, пока loop заблокирован дольше порога.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.2"))
+LOOP_BLOCK_DEBUG = os.getenv("LOOP_BLOCK_DEBUG", "0") == "1"
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1"))
+LOOP_BLOCK_STACK_LIMIT = int(os.getenv("LOOP_BLOCK_STACK_LIMIT", "20"))
 
-        response = f"📊 Память Лейлы\n\n{stats}"
+BOT_SOURCE_FILE = os.path.abspath(__file__)
 
-        if context_text:
-            response += "\n\nПоследний контекст:\n" + context_text[-2500:]
 
-        if recent_spontaneous:
-            response += "\n\nПоследние спонтанные сообщения:\n"
-            response += "\n".join(f"- {x}" for x in recent_spontaneous[-8:])
+def bot_frames(frame) -> List[Tuple[str, int]]:
+    """
+    Кадры bot.py от внешнего к внутреннему: (имя функции, строка).
+    Генераторные выражения и подряд идущая рекурсия схлопываются.
+    """
+    frames = []
 
-        await update.effective_message.reply_text(response[:3900])
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == BOT_SOURCE_FILE and not code.co_name.startswith("<"):
+            name = getattr(code, "co_qualname", code.co_name)
+            if not frames or frames[-1][0] != name:
+                frames.append((name, frame.f_lineno))
+        frame = frame.f_back
 
-    except Exception as e:
-        logger.error(f"Ошибка /show_memory: {e}", exc_info=True)
-        await update.effective_message.reply_text("Ошибка показа памяти.")
+    frames.reverse()
+    return frames
 
 
-async def remember_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        user = update.effective_user
+class LoopWatchdog:
+    """
+    Корутина засыпает на tick и смотрит, насколько позже проснулась — это и есть
+    лаг. Поток-сторож видит тот же запланированный момент пробуждения; если loop
+    опаздывает дольше threshold, значит его держит синхронный код, и поток
+    снимает стек потока loop через sys._current_frames().
+    Встроенный loop.set_debug() не берём: он замедляет каждый колбэк.
+    """
 
-        if not user or (ADMIN_ID and user.id != ADMIN_ID):
-            await update.effective_message.reply_text("Эта команда только для администратора.")
+    def __init__(self, interval: float, warn: float, debug: bool, threshold: float):
+        self.interval = interval
+        self.warn = warn
+        self.debug = debug
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._deadline = 0.0
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._samples: Dict[str, int] = {}
+
+    def start(self):
+        if self._task is not None:
             return
 
-        chat = update.effective_chat
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="loop-watchdog")
 
-        if not chat:
-            return
+        if self.debug:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+            logger.info(f"🐢 Ловлю блокировки event loop дольше {self.threshold * 1000:.0f} мс")
 
-        text = " ".join(context.args).strip()
+    async def stop(self):
+        self._stop.set()
 
-        if not text:
-            await update.effective_message.reply_text("Напиши после /remember что запомнить.")
-            return
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-        memory_store.add_inside_joke(chat.id, text)
-        await update.effective_message.reply_text("Запомнила. Теперь это часть нашего коллективного диагноза.")
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
 
-    except Exception as e:
-        logger.error(f"Ошибка /remember: {e}", exc_info=True)
-        await update.effective_message.reply_text("Не смогла запомнить.")
+    async def _run(self):
+        # В отладке тикаем чаще порога, иначе короткие блокировки проскочат между тиками.
+        tick = min(self.interval, self.threshold / 2) if self.debug else self.interval
 
+        while True:
+            self._deadline = time_module.monotonic() + tick
+            await asyncio.sleep(tick)
 
-async def set_tennis_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global TENNIS_ACCESS_CODE
+            lag = max(0.0, time_module.monotonic() - self._deadline)
+            LOOP_LAG_SECONDS.observe(lag)
+            perf_stats.observe("loop_lag", lag)
+            self.max_lag = max(self.max_lag, lag)
 
-    user = update.effective_user
+            if lag >= self.warn:
+                self._report(lag)
 
-    if not user or (ADMIN_ID and user.id != ADMIN_ID):
-        return
+    def _report(self, lag: float):
+        self.stalls += 1
 
-    code = " ".join(context.args).strip()
+        with self._lock:
+            samples, self._samples = self._samples, {}
 
-    if not code:
-        await update.effective_message.reply_text(
-            "Использование:\n/set_tennis_code 123456"
-        )
-        return
+        if not samples:
+            logger.warning(f"🐢 Event loop опоздал на {lag * 1000:.0f} мс")
+            return
 
-    TENNIS_ACCESS_CODE = code
-    memory_store.set_setting("tennis_access_code", code)
+        top = sorted(samples.items(), key=lambda item: -item[1])
+        LOOP_BLOCKS.labels(top[0][0]).inc()
+        where = ", ".join(f"{name} x{count}" for name, count in top[:3])
+        logger.warning(f"🐢 Event loop опоздал на {lag * 1000:.0f} мс, держали: {where}")
 
-    await update.effective_message.reply_text(
-        f"🎾 Новый теннисный код:\n{code}"
-    )
+    def _watch(self):
+        poll = self.threshold / 4
+        reported_for = 0.0
 
+        while not self._stop.wait(poll):
+            deadline = self._deadline
+            late = time_module.monotonic() - deadline
 
-async def set_tennis_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global TENNIS_CODE_VALID_UNTIL
+            if not deadline or late < self.threshold:
+                continue
 
-    user = update.effective_user
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
 
-    if not user or (ADMIN_ID and user.id != ADMIN_ID):
-        return
+            chain = bot_frames(frame)
+            culprit = chain[-1][0] if chain else "<вне bot.py>"
 
-    expiry = " ".join(context.args).strip()
+            with self._lock:
+                self._samples[culprit] = self._samples.get(culprit, 0) + 1
 
-    if not expiry:
-        await update.effective_message.reply_text(
-            "Использование:\n/set_tennis_expiry 20 августа 2026"
-        )
-        return
+            # Стек — один раз на эпизод, дальше только считаем, где застали loop.
+            if deadline != reported_for:
+                reported_for = deadline
+                path = " → ".join(f"{name}:{line}" for name, line in chain) or culprit
+                stack = "".join(traceback.format_stack(frame, limit=LOOP_BLOCK_STACK_LIMIT))
+                logger.warning(
+                    f"🐢 Event loop занят уже {late * 1000:.0f} мс: {path}\n{stack}"
+                )
 
-    TENNIS_CODE_VALID_UNTIL = expiry
-    memory_store.set_setting("tennis_code_valid_until", expiry)
+            del frame
 
-    await update.effective_message.reply_text(
-        f"📅 Новая дата действия:\n{expiry}"
-    )
 
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_LAG_WARN, LOOP_BLOCK_DEBUG, LOOP_BLOCK_THRESHOLD)
 
-async def spontaneous_now_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        user = update.effective_user
 
-        if not user or (ADMIN_ID and user.id != ADMIN_ID):
-            await update.effective_message.reply_text("Эта команда только для администратора.")
-            return
+# ========== PROFILER ==========
 
-        text = await generate_spontaneous_message()
-        await update.effective_message.reply_text(text)
+# Сэмплирующий профайлер по /profile: поток раз в PROFILE_INTERVAL снимает
+# стеки всех потоков. Вне сеанса потока нет вообще.
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DEFAULT_SECONDS = int(os.getenv("PROFILE_DEFAULT_SECONDS", "60"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
 
-    except Exception as e:
-        logger.error(f"Ошибка /spontaneous_now: {e}", exc_info=True)
-        await update.effective_message.reply_text("Не смогла сгенерировать мысль. Бывает.")
 
+class SamplingProfiler:
+    """
+    Стеки копятся сразу в collapsed-формате ("поток;внешняя;...;внутренняя N"),
+    который понимают flamegraph.pl, speedscope и inferno. Кадр подписан
+    функцией и строкой её определения, чтобы разные строки одной функции
+    не дробили график. Профиль по стенным часам: ожидание в select и
+    в потоках DeepSeek тоже видно.
+    """
 
-# ========== DAILY MESSAGES ==========
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        self.started = 0.0
+        self.stopped = 0.0
+        self._deadline = 0.0
+        self._labels: Dict[Any, str] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
 
-async def send_morning_message(context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not GROUP_CHAT_ID:
-        return
+    @property
+    def active(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
 
-    try:
-        tz = get_tz()
-        now_local = datetime.now(tz)
-        moon = get_moon_phase(now_local)
-        moon_text = format_moon_phrase(moon)
-        moon_comment = get_moon_comment(moon)
-        weather_data = await weather_service.get_weather("Brisbane,au")
-        weather_text = weather_data["full_text"] if weather_data else ""
-        chat_context = memory_store.get_chat_context_text(GROUP_CHAT_ID, limit=10)
+    def start(self, duration: float) -> bool:
+        if self._thread is not None:
+            return False
 
-        prompt = f"""
-Создай короткое утреннее сообщение для общего Telegram-чата.
+        self.counts = {}
+        self.samples = 0
+        self.started = time_module.monotonic()
+        self.stopped = 0.0
+        self._deadline = self.started + duration
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
 
-Контекст:
-- Сейчас утро в Брисбене.
-- {moon_text}
-- Комментарий к Луне: {moon_comment}
-- Погода: {weather_text}
-- Недавний контекст чата: {chat_context or "мало контекста"}
+    def stop(self) -> bool:
+        """Останавливает сеанс (или забирает уже истёкший). False — сеанса не было."""
+        if self._thread is None:
+            return False
 
-Стиль:
-- Лейла, русскоязычная женщина средних лет из Брисбена.
-- Весело, саркастично, но тепло.
-- Обращение ко всем, не к одному человеку.
-- Максим может быть упомянут только если очень к месту, но лучше не фокусироваться на нём.
-- 3-5 предложений.
-- 1-3 эмодзи.
-- Не звучать как гороскоп из дешёвой газеты.
-- Не повторять одни и те же шутки про кофе.
-""".strip()
+        self._stop.set()
+        self._thread.join(timeout=2)
+        self._thread = None
+        self._labels = {}
+        self.stopped = self.stopped or time_module.monotonic()
+        return True
 
-        messages = [
-            {"role": "system", "content": "Ты — Лейла. Пиши как живой участник общего чата."},
-            {"role": "user", "content": prompt},
-        ]
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
 
-        model_config = {
-            "model": DEEPSEEK_MODELS["chat"],
-            "temperature": 0.82,
-            "max_tokens": 240,
-            "require_reasoning": False,
-        }
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
 
-        answer = await call_deepseek(messages, model_config)
+        return label
 
-        fallback = (
-            f"Доброе утро, народ ☕\n\n"
-            f"{moon_text}\n"
-            f"{moon_comment}\n\n"
-            f"День можно начинать. Осторожно, без героизма."
-        )
+    def _run(self):
+        me = threading.get_ident()
+        counts = self.counts
 
-        text = clean_response(answer or fallback)
+        while not self._stop.wait(self.interval):
+            if time_module.monotonic() >= self._deadline:
+                break
 
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=text)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
 
-    except Exception as e:
-        logger.error(f"Ошибка утреннего сообщения: {e}", exc_info=True)
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
 
-    finally:
-        schedule_next_morning(context.job_queue)
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
 
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
 
-async def send_evening_message(context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not GROUP_CHAT_ID:
-        return
+            self.samples += 1
 
-    try:
-        tz = get_tz()
-        now_local = datetime.now(tz)
-        moon = get_moon_phase(now_local)
-        moon_text = format_moon_phrase(moon)
-        moon_comment = get_moon_comment(moon)
-        chat_context = memory_store.get_chat_context_text(GROUP_CHAT_ID, limit=10)
+        self.stopped = time_module.monotonic()
 
-        prompt = f"""
-Создай короткое вечернее сообщение для общего Telegram-чата.
+    def collapsed(self) -> str:
+        ordered = sorted(self.counts.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in ordered)
 
-Контекст:
-- Сейчас вечер в Брисбене.
-- {moon_text}
-- Комментарий к Луне: {moon_comment}
-- Недавний контекст чата: {chat_context or "мало контекста"}
+    def summary(self, top: int = 8) -> str:
+        duration = (self.stopped or time_module.monotonic()) - self.started
+        lines = [f"{duration:.0f} с, {self.samples} снимков, {len(self.counts)} разных стеков"]
 
-Стиль:
-- Лейла, русскоязычная женщина средних лет из Брисбена.
-- Тёпло, саркастично, немного чёрного юмора.
-- Обращение ко всем.
-- Не фокусироваться на Максиме.
-- Можно слегка пошутить про усталость, жизнь и людей.
-- 2-4 предложения.
-- 0-2 эмодзи.
-- Не повторять вчерашние формулировки.
-""".strip()
+        # Самая внутренняя функция bot.py в каждом стеке — где код бота проводит время.
+        own: Dict[str, int] = {}
+        for stack, count in self.counts.items():
+            for frame in reversed(stack.split(";")):
+                if "(bot.py:" in frame:
+                    own[frame] = own.get(frame, 0) + count
+                    break
 
-        messages = [
-            {"role": "system", "content": "Ты — Лейла. Пиши как живой участник общего чата."},
-            {"role": "user", "content": prompt},
-        ]
+        if own:
+            lines.append("\nГорячее в bot.py:")
+            for frame, count in sorted(own.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"{count * 100 / max(1, self.samples):5.1f}%  {frame}")
 
-        model_config = {
-            "model": DEEPSEEK_MODELS["chat"],
-            "temperature": 0.88,
-            "max_tokens": 220,
-            "require_reasoning": False,
-        }
+        return "\n".join(lines)
 
-        answer = await call_deepseek(messages, model_config)
 
-        fallback = (
-            f"{moon['emoji']} День официально закончен.\n\n"
-            f"{moon_comment}\n"
-            f"Кто сегодня устал — тот хотя бы честен.\n\n"
-            f"Спокойной ночи всем."
-        )
+profiler = SamplingProfiler(PROFILE_INTERVAL)
 
-        text = clean_response(answer or fallback)
 
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=text)
+async def deliver_profile(bot, chat_id: int):
+    profiler.stop()
 
-    except Exception as e:
-        logger.error(f"Ошибка вечернего сообщения: {e}", exc_info=True)
+    if not profiler.counts:
+        await send_text(bot, chat_id, "🔬 Профиль пустой — снимков не набралось.")
+        return
 
-    finally:
-        schedule_next_evening(context.job_queue)
+    data = await asyncio.to_thread(lambda: profiler.collapsed().encode("utf-8"))
+    filename = f"leila-profile-{datetime.now(get_tz()).strftime('%Y%m%d-%H%M%S')}.collapsed"
+
+    await send_document(
+        bot,
+        chat_id,
+        data,
+        filename=filename,
+        caption=f"🔬 Профиль\n{profiler.summary()}"[:1000],
+    )
+
+
+async def finish_profile_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await deliver_profile(context.bot, context.job.data["chat_id"])
+    except Exception as e:
+        logger.error(f"Ошибка отправки профиля: {e}", exc_info=True)
 
 
-async def send_friday_tennis_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not GROUP_CHAT_ID:
-        return
+# ========== HEAP ==========
 
-    try:
-        message = (
-            "🎾 *Пятничный теннис!*\n\n"
-            "Время: 16:30\n"
-            f"Код доступа: `{TENNIS_ACCESS_CODE}`\n"
-            f"Действует до: {TENNIS_CODE_VALID_UNTIL}\n\n"
-            "Увидимся на кортах! 😊"
-        )
+HEAP_TRACE_FRAMES = int(os.getenv("HEAP_TRACE_FRAMES", "1"))
+HEAP_REPORT_TOP = int(os.getenv("HEAP_REPORT_TOP", "15"))
 
-        await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=message, parse_mode="Markdown")
 
-    except Exception as e:
-        logger.error(f"Ошибка теннисного напоминания: {e}", exc_info=True)
+def _short_path(filename: str) -> str:
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
 
-        try:
-            await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                text=f"🎾 Теннис в 16:30! Код: {TENNIS_ACCESS_CODE}",
-            )
-        except Exception:
-            pass
 
+class HeapTracker:
+    """
+    Снимки tracemalloc для /heap. Между снимками храним не сам Snapshot
+    (на 256 МБ он может весить десятки мегабайт), а свёртку по file:line —
+    её хватает, чтобы посчитать, какие места выросли.
+    """
 
-# ========== RANDOM SCHEDULING ==========
+    def __init__(self, frames: int, top: int):
+        self.frames = frames
+        self.top = top
+        self.previous: Optional[Dict[Tuple[str, int], Tuple[int, int]]] = None
+        self.previous_at = 0.0
 
-def random_time_between(start_hour: int, start_minute: int, end_hour: int, end_minute: int) -> time:
-    start_total = start_hour * 60 + start_minute
-    end_total = end_hour * 60 + end_minute
-    picked = random.randint(start_total, end_total)
+    @property
+    def tracing(self) -> bool:
+        module = sys.modules.get("tracemalloc")
+        return module is not None and module.is_tracing()
 
-    return time(hour=picked // 60, minute=picked % 60)
+    def start(self) -> bool:
+        import tracemalloc
 
+        if tracemalloc.is_tracing():
+            return False
 
-def schedule_once_at_local_time(job_queue, callback, target_time: time, name: str):
-    tz = get_tz()
-    now = datetime.now(tz)
+        tracemalloc.start(self.frames)
+        self.previous = None
+        return True
 
-    target = tz.localize(
-        datetime.combine(now.date(), target_time.replace(tzinfo=None))
-    )
+    def stop(self) -> bool:
+        if not self.tracing:
+            return False
 
-    if target <= now:
-        target = target + timedelta(days=1)
+        import tracemalloc
 
-    delay = max(1, int((target - now).total_seconds()))
+        tracemalloc.stop()
+        self.previous = None
+        return True
 
-    for job in job_queue.jobs():
-        if job.name == name:
-            job.schedule_removal()
+    def _aggregate(self) -> Dict[Tuple[str, int], Tuple[int, int]]:
+        import tracemalloc
 
-    job_queue.run_once(callback, when=delay, name=name)
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
 
-    logger.info(f"⏰ Запланировано {name}: {target.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        return {
+            (stat.traceback[0].filename, stat.traceback[0].lineno): (stat.size, stat.count)
+            for stat in snapshot.statistics("lineno")
+        }
 
+    def report(self) -> str:
+        """Снимок, сравнение с прошлым и топ мест аллокации. Медленно — звать из потока."""
+        import tracemalloc
 
-def schedule_next_morning(job_queue):
-    target_time = random_time_between(7, 0, 9, 0)
-    schedule_once_at_local_time(job_queue, send_morning_message, target_time, "random-morning")
+        current = self._aggregate()
+        previous, previous_at = self.previous, self.previous_at
+        self.previous, self.previous_at = current, time_module.monotonic()
 
+        traced, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Под трассировкой {traced / 1024 / 1024:.1f} МБ (пик {peak / 1024 / 1024:.1f} МБ), "
+            f"RSS {read_rss_bytes() / 1024 / 1024:.1f} МБ, мест аллокации {len(current)}"
+        ]
 
-def schedule_next_evening(job_queue):
-    target_time = random_time_between(20, 0, 21, 30)
-    schedule_once_at_local_time(job_queue, send_evening_message, target_time, "random-evening")
+        if previous is None:
+            lines.append(f"\nПервый снимок, топ-{self.top} по объёму:")
+            rows = sorted(current.items(), key=lambda item: -item[1][0])[: self.top]
+            for (filename, lineno), (size, count) in rows:
+                lines.append(f"{size / 1024:9.1f} КБ {count:7d} бл.  {_short_path(filename)}:{lineno}")
+            return "\n".join(lines)
+
+        growth = []
+        for key, (size, count) in current.items():
+            old_size, old_count = previous.get(key, (0, 0))
+            if size > old_size:
+                growth.append((size - old_size, count - old_count, size, key))
+
+        freed = 0
+        for key, (old_size, _) in previous.items():
+            size = current.get(key, (0, 0))[0]
+            if size < old_size:
+                freed += old_size - size
+
+        grown = sum(item[0] for item in growth)
+
+        minutes = (self.previous_at - previous_at) / 60
+        lines.append(
+            f"\nЗа {minutes:.0f} мин с прошлого снимка: +{grown / 1024:.0f} КБ, -{freed / 1024:.0f} КБ"
+        )
 
+        if not growth:
+            lines.append("Ничего не выросло.")
+            return "\n".join(lines)
 
-# ========== DELAYED FOLLOWUPS ==========
+        lines.append(f"Топ-{self.top} растущих мест:")
+        for size_diff, count_diff, size, (filename, lineno) in sorted(growth, reverse=True)[: self.top]:
+            lines.append(
+                f"{size_diff / 1024:+9.1f} КБ {count_diff:+7d} бл. (всего {size / 1024:.0f} КБ)  "
+                f"{_short_path(filename)}:{lineno}"
+            )
 
-async def delayed_followup(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data
+        return "\n".join(lines)
 
-    try:
-        chat_context = memory_store.get_chat_context_text(data["chat_id"], limit=8)
 
-        prompt = f"""
-Напиши короткий delayed follow-up от Лейлы в Telegram-чате.
+heap_tracker = HeapTracker(HEAP_TRACE_FRAMES, HEAP_REPORT_TOP)
 
-Контекст:
-{chat_context or "мало контекста"}
 
-Правила:
-- 1 короткое предложение.
-- Выглядит так, будто Лейла через время вспомнила прошлое сообщение.
-- Не повторяй одну и ту же фразу.
-- Не будь слишком странной.
-- Русский язык.
-""".strip()
+# ========== WEBHOOK ==========
 
-        messages = [
-            {"role": "system", "content": "Ты — Лейла. Пиши коротко и естественно."},
-            {"role": "user", "content": prompt},
-        ]
+class WebhookState:
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.received = 0
+        self.rejected = 0
 
-        model_config = {
-            "model": DEEPSEEK_MODELS["chat"],
-            "temperature": 0.95,
-            "max_tokens": 80,
-            "require_reasoning": False,
-        }
 
-        text = await call_deepseek(messages, model_config)
-        text = clean_response(text or "")
+def create_webhook_app(application, state: WebhookState, secret: str = WEBHOOK_SECRET) -> "web.Application":
+    """aiohttp-приложение: POST с апдейтами от Telegram и /healthz для проверок Fly."""
+    with timed_startup("import aiohttp (webhook)"):
+        from aiohttp import web
 
-        if not text:
-            text = random.choice([
-                "Я только сейчас поняла насколько это было странно.",
-                "Кстати… я всё ещё думаю об этом сообщении.",
-                "Ладно, перечитала ещё раз.",
-                "Это было сильнее, чем я сначала подумала.",
-            ])
+    async def telegram_update(request: "web.Request") -> "web.Response":
+        if state.draining:
+            # Telegram повторит доставку — апдейт заберёт следующий инстанс.
+            return web.Response(status=503)
 
-        await context.bot.send_message(
-            chat_id=data["chat_id"],
-            text=text,
-            reply_to_message_id=data["message_id"],
-        )
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
 
-    except Exception as e:
-        logger.error(f"Ошибка delayed followup: {e}")
+        if not secret or not hmac.compare_digest(token, secret):
+            state.rejected += 1
+            return web.Response(status=403)
 
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"🌐 Некорректный апдейт от webhook: {e}")
+            return web.Response(status=400)
 
-def maybe_schedule_followup(context, chat_id, message_id):
-    now_hour = datetime.now(get_tz()).hour
+        await application.update_queue.put(update)
+        state.received += 1
 
-    if 1 <= now_hour <= 8:
-        return
+        return web.Response(status=200)
 
-    if random.random() < 0.035:
-        delay = random.randint(180, 2400)
+    async def healthz(request: "web.Request") -> "web.Response":
+        ok = state.ready and not state.draining
 
-        context.job_queue.run_once(
-            delayed_followup,
-            when=delay,
-            data={
-                "chat_id": chat_id,
-                "message_id": message_id,
+        return web.json_response(
+            {
+                "status": "ok" if ok else ("draining" if state.draining else "starting"),
+                "mode": "webhook",
+                "received": state.received,
+                "rejected": state.rejected,
+                "pending_updates": application.update_queue.qsize(),
+                "outbound_queue": len(outbound_queue),
             },
+            status=200 if ok else 503,
         )
 
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, telegram_update)
+    web_app.router.add_get("/healthz", healthz)
 
-# ========== SPONTANEOUS SCHEDULING ==========
+    return web_app
 
-async def spontaneous_chat_message(context: ContextTypes.DEFAULT_TYPE):
-    if not GROUP_CHAT_ID or not SPONTANEOUS_MESSAGE_ENABLED:
-        return
 
-    try:
-        text = await generate_spontaneous_message()
+async def run_webhook(application) -> None:
+    """
+    Жизненный цикл бота в webhook-режиме.
+    На SIGTERM перестаём принимать апдейты (503), дорабатываем уже принятые
+    и только потом гасим бота — так деплой на Fly не теряет сообщения.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
 
-        await context.bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=text,
-        )
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
 
-    except Exception as e:
-        logger.error(f"Ошибка spontaneous message: {e}", exc_info=True)
+    state = WebhookState()
+    web_app = create_webhook_app(application, state)
 
-    finally:
-        schedule_spontaneous_message(context.job_queue)
+    from aiohttp import web
 
+    runner = web.AppRunner(web_app)
 
-def schedule_spontaneous_message(job_queue):
-    if not SPONTANEOUS_MESSAGE_ENABLED:
-        logger.info("Спонтанные сообщения отключены")
-        return
+    await application.initialize()
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"🌐 Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
 
-    target_time = random_time_between(SPONTANEOUS_MIN_HOUR, 0, SPONTANEOUS_MAX_HOUR, 30)
+    try:
+        if application.post_init:
+            await application.post_init(application)
 
-    schedule_once_at_local_time(
-        job_queue,
-        spontaneous_chat_message,
-        target_time,
-        "spontaneous-message",
-    )
+        await application.start()
 
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(f"🌐 Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            logger.warning("🌐 WEBHOOK_URL не задан — setWebhook не вызывается")
 
-# ========== HANDLER ==========
+        state.ready = True
+        await stop_event.wait()
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = update.effective_message
-    chat = update.effective_chat
-    user = update.effective_user
+    finally:
+        state.draining = True
+        logger.info(f"🌐 Останавливаюсь, в очереди апдейтов: {application.update_queue.qsize()}")
 
-    if not msg or not chat or not user:
-        return
+        if application.running:
+            try:
+                await asyncio.wait_for(application.stop(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("🌐 Не успела доработать все апдейты за отведённое время")
 
-    text = (msg.text or "").strip()
+            if application.post_stop:
+                await application.post_stop(application)
 
-    if not text:
-        return
+        await runner.cleanup()
+        await application.shutdown()
 
-    try:
-        user_info = await get_or_create_user_info(update)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
-        memory_store.increment_user_message(user.id)
-        extract_topics_and_facts(user_info, text)
-        memory_store.add_message(
-            chat_id=chat.id,
-            user_id=user.id,
-            role="user",
-            name=user_info.get_display_name(),
-            content=text,
-        )
 
-        # Private chat — always answer.
-        if chat.type == "private":
-            should_respond = True
-            is_direct_address = True
-        else:
-            bot_username = (context.bot.username or "").lower()
-            text_lower = text.lower()
+# ========== MAIN ==========
 
-            mentioned_by_name = "лейла" in text_lower
-            mentioned_by_username = bool(bot_username) and f"@{bot_username}" in text_lower
+async def send_startup_greeting(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        tz_local = get_tz()
+        now_local = datetime.now(tz_local)
+        season_, season_info_ = get_current_season()
 
-            is_reply_to_bot = False
+        greetings = [
+            f"💫 Лейла вернулась. Сейчас {now_local.strftime('%H:%M')} в Брисбене. {season_info_.get('emoji', '✨')}",
+            f"Я снова тут. Ничего не трогайте, я сама всё осужу. {season_info_.get('emoji', '🌟')}",
+            f"Лейла на месте. В {BOT_LOCATION['city']}е сейчас {season_}. Живём дальше.",
+        ]
 
-            if msg.reply_to_message and msg.reply_to_message.from_user:
-                me = await context.bot.get_me()
-                is_reply_to_bot = msg.reply_to_message.from_user.id == me.id
+        await send_text(
+            context.bot,
+            GROUP_CHAT_ID,
+            random.choice(greetings),
+            priority=PRIORITY_BROADCAST,
+        )
 
-            is_direct_address = mentioned_by_name or mentioned_by_username or is_reply_to_bot
+    except Exception as e:
+        logger.error(f"Ошибка приветствия при старте: {e}", exc_info=True)
 
-            if is_direct_address:
-                should_respond = True
-            else:
-                should_respond = random.random() < RANDOM_GROUP_REPLY_RATE
 
-        if not should_respond:
-            return
+async def warm_up_deepseek(context: ContextTypes.DEFAULT_TYPE):
+    # Импорт openai в отдельном потоке, чтобы первый ответ не ждал его.
+    await asyncio.to_thread(get_deepseek_client)
 
-        force_short = chat.type in ("group", "supergroup") and not is_direct_address
 
-        try:
-            await context.bot.send_chat_action(chat_id=chat.id, action=ChatAction.TYPING)
-        except Exception:
-            pass
+async def post_init(application):
+    started = time_module.perf_counter()
 
-        if chat.type in ("group", "supergroup"):
-            await asyncio.sleep(random.uniform(1.5, 7.0))
-        else:
-            await asyncio.sleep(random.uniform(0.5, 2.0))
+    load_runtime_settings()
+    weather_service.warm_from_store()
+    await start_metrics_server()
+    loop_watchdog.start()
 
-        reply = await generate_leila_response(
-            user_message=text,
-            user_info=user_info,
-            chat_id=chat.id,
-            force_short=force_short,
+    if OPENWEATHER_API_KEY:
+        application.job_queue.run_repeating(
+            refresh_weather_cache,
+            interval=WEATHER_REFRESH_INTERVAL,
+            first=5,
+            name="weather-refresh",
         )
 
-        if force_short:
-            words = reply.split()
-            if len(words) > 28:
-                reply = " ".join(words[:24]) + "..."
-
-        memory_store.add_message(
-            chat_id=chat.id,
-            user_id=0,
-            role="assistant",
-            name="Лейла",
-            content=reply,
-        )
+    application.job_queue.run_repeating(
+        flush_ingest_job,
+        interval=INGEST_FLUSH_INTERVAL,
+        first=INGEST_FLUSH_INTERVAL,
+        name="ingest-flush",
+    )
 
-        reply_as_thread = False
+    perf_stats.sample()
+    application.job_queue.run_repeating(
+        perf_sample_job,
+        interval=PERF_SAMPLE_INTERVAL,
+        first=PERF_SAMPLE_INTERVAL,
+        name="perf-sample",
+    )
 
-        if chat.type in ("group", "supergroup"):
-            reply_as_thread = random.random() < 0.55
+    if DEEPSEEK_API_KEY:
+        application.job_queue.run_once(warm_up_deepseek, when=1, name="deepseek-warm-up")
 
-        if reply_as_thread:
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text=reply,
-                reply_to_message_id=msg.message_id,
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text=reply,
-            )
+    schedule_context_refresh(application.job_queue)
 
-        maybe_schedule_followup(
-            context,
-            chat.id,
-            msg.message_id,
-        )
+    restored = restore_durable_jobs(application.job_queue)
 
-    except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {e}", exc_info=True)
+    if GROUP_CHAT_ID:
+        seed_group_schedule(GROUP_CHAT_ID)
 
-        try:
-            await context.bot.send_message(
-                chat_id=chat.id,
-                text="Что-то пошло не так. Даже у меня бывают дни.",
-            )
-        except Exception:
-            pass
+    if "random-morning" not in restored:
+        schedule_next_morning(application.job_queue)
+    if "random-evening" not in restored:
+        schedule_next_evening(application.job_queue)
+    if "spontaneous-message" not in restored:
+        schedule_spontaneous_message(application.job_queue)
 
+    # Приветствие уходит задачей, чтобы не задерживать первый getUpdates.
+    if GROUP_CHAT_ID:
+        application.job_queue.run_once(send_startup_greeting, when=2, name="startup-greeting")
 
-# ========== MAIN ==========
+    STARTUP_TIMINGS.append(("post_init", time_module.perf_counter() - started))
 
-def main() -> None:
-    if not TELEGRAM_TOKEN:
-        raise RuntimeError("BOT_TOKEN не задан")
 
-    if not GROUP_CHAT_ID:
-        logger.warning("GROUP_CHAT_ID не задан или некорректен — плановые сообщения не будут работать")
+async def post_stop(application):
+    # Бот ещё жив, можно дослать очередь исходящих.
+    await outbound_queue.close()
+    memory_store.flush_ingest()
 
-    tz = get_tz()
-    now = datetime.now(tz)
-    season, season_info = get_current_season()
 
-    logger.info("=" * 60)
-    logger.info("🚀 ЗАПУСК БОТА ЛЕЙЛА")
-    logger.info(f"📍 Локация: {BOT_LOCATION['city']}, {BOT_LOCATION['country']}")
-    logger.info(f"📅 Сезон: {season} ({season_info.get('description', '')})")
-    logger.info(f"🕐 Время: {now.strftime('%H:%M:%S')}")
-    logger.info(f"💬 Группа ID: {GROUP_CHAT_ID}")
-    logger.info(f"👤 Максим ID: {MAXIM_ID}")
-    logger.info(f"🤖 DeepSeek доступен: {'✅' if client else '❌'}")
-    logger.info(f"🧠 SQLite память: {DB_PATH}")
-    logger.info(f"💬 Спонтанные сообщения: {'✅' if SPONTANEOUS_MESSAGE_ENABLED else '❌'}")
-    logger.info("=" * 60)
+async def post_shutdown(application):
+    profiler.stop()
+    await loop_watchdog.stop()
+    await stop_metrics_server()
+    await close_http_client()
 
-    async def post_init(application):
-        if GROUP_CHAT_ID:
-            schedule_next_morning(application.job_queue)
-            schedule_next_evening(application.job_queue)
-            schedule_spontaneous_message(application.job_queue)
+    if trace_exporter is not None:
+        trace_exporter.close()
 
-            await asyncio.sleep(2)
 
-            try:
-                tz_local = get_tz()
-                now_local = datetime.now(tz_local)
-                season_, season_info_ = get_current_season()
-
-                greetings = [
-                    f"💫 Лейла вернулась. Сейчас {now_local.strftime('%H:%M')} в Брисбене. {season_info_.get('emoji', '✨')}",
-                    f"Я снова тут. Ничего не трогайте, я сама всё осужу. {season_info_.get('emoji', '🌟')}",
-                    f"Лейла на месте. В {BOT_LOCATION['city']}е сейчас {season_}. Живём дальше.",
-                ]
-
-                await application.bot.send_message(
-                    chat_id=GROUP_CHAT_ID,
-                    text=random.choice(greetings),
-                )
+def build_application(bot=None):
+    builder = ApplicationBuilder()
 
-            except Exception as e:
-                logger.error(f"Ошибка post_init: {e}", exc_info=True)
+    if bot is not None:
+        builder = builder.bot(bot)
+    else:
+        builder = builder.token(TELEGRAM_TOKEN)
 
     app = (
-        ApplicationBuilder()
-        .token(TELEGRAM_TOKEN)
+        builder
+        .concurrent_updates(UPDATE_CONCURRENCY if UPDATE_CONCURRENCY > 1 else False)
         .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -2305,10 +6846,22 @@ def main() -> None:
     app.add_handler(CommandHandler("set_tennis_code", set_tennis_code))
     app.add_handler(CommandHandler("set_tennis_expiry", set_tennis_expiry))
     app.add_handler(CommandHandler("spontaneous_now", spontaneous_now_command))
+    app.add_handler(CommandHandler("jobs", jobs_command))
+    app.add_handler(CommandHandler("memstats", memstats_command))
+    app.add_handler(CommandHandler("perf", perf_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("heap", heap_command))
+    app.add_handler(CommandHandler("dbstats", dbstats_command))
+    app.add_handler(CommandHandler("broadcast_add", broadcast_add_command))
+    app.add_handler(CommandHandler("broadcast_remove", broadcast_remove_command))
+    app.add_handler(CommandHandler("broadcast_list", broadcast_list_command))
 
     # Generic text handler last
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    # Отдельная группа: не мешает основным хендлерам, срабатывает на первом апдейте.
+    app.add_handler(TypeHandler(Update, log_startup_report), group=-1)
+
     jq = app.job_queue
     tz_obj = get_tz()
 
@@ -2322,9 +6875,45 @@ def main() -> None:
         name="friday-tennis",
     )
 
-    logger.info("🤖 Бот запущен!")
-    app.run_polling()
+    return app
+
+
+def main() -> None:
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("BOT_TOKEN не задан")
+
+    if not GROUP_CHAT_ID:
+        logger.warning("GROUP_CHAT_ID не задан или некорректен — плановые сообщения только для чатов из /broadcast_add")
+
+    tz = get_tz()
+    now = datetime.now(tz)
+    season, season_info = get_current_season()
+
+    logger.info("=" * 60)
+    logger.info("🚀 ЗАПУСК БОТА ЛЕЙЛА")
+    logger.info(f"📍 Локация: {BOT_LOCATION['city']}, {BOT_LOCATION['country']}")
+    logger.info(f"📅 Сезон: {season} ({season_info.get('description', '')})")
+    logger.info(f"🕐 Время: {now.strftime('%H:%M:%S')}")
+    logger.info(f"💬 Группа ID: {GROUP_CHAT_ID}")
+    logger.info(f"👤 Максим ID: {MAXIM_ID}")
+    logger.info(f"🤖 DeepSeek доступен: {'✅' if DEEPSEEK_API_KEY else '❌'}")
+    logger.info(f"🧠 SQLite память: {DB_PATH}")
+    logger.info(f"💬 Спонтанные сообщения: {'✅' if SPONTANEOUS_MESSAGE_ENABLED else '❌'}")
+    logger.info("=" * 60)
+
+    with timed_startup("сборка приложения"):
+        app = build_application()
+
+    logger.info(f"🤖 Бот запущен! Режим: {BOT_MODE}")
+
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
+
+
+STARTUP_TIMINGS.append(("инициализация модуля", time_module.perf_counter() - MODULE_INIT_STARTED))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()